@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for comparing two benchmark
+reports, for example from before and after a change.
+
+    python -m benchmarks.compare base.json head.json --threshold 0.10
+
+Exits with status 1 when any measurement got slower by more than the threshold.
+ """
+#----------------------------------
+#
+#
+from argparse import ArgumentParser
+import sys
+
+from benchmarks.report import read_report
+
+# Which statistic of a measurement is compared, and whether bigger is better
+COMPARED_STATISTICS = (('seconds', 'median', False), ('jobsPerSecond', None, True))
+
+
+def comparable_value(result: dict) -> tuple[float, bool] | None:
+    for key, statistic, higher_is_better in COMPARED_STATISTICS:
+        value = result.get(key)
+        if isinstance(value, dict):
+            value = value.get(statistic)
+        if value is not None:
+            return float(value), higher_is_better
+
+    return None
+
+
+def compare_reports(base: dict, head: dict, threshold: float) -> list:
+    """Pairs up the measurements of two reports by name
+
+    Args:
+        base (dict): The report to compare against
+
+        head (dict): The report of the change
+
+        threshold (float): Relative slow down above which a measurement is a regression
+
+    Returns:
+        list: One dict per measurement in both reports, with the change and whether it regressed
+    """
+    if base['suite'] != head['suite']:
+        raise ValueError(f'Can not compare a {base["suite"]} report to a {head["suite"]} report')
+
+    base_results = {result['name']: result for result in base['results']}
+    comparisons = []
+    for head_result in head['results']:
+        base_result = base_results.get(head_result['name'])
+        if base_result is None:
+            continue
+
+        base_value, head_value = comparable_value(base_result), comparable_value(head_result)
+        if base_value is None or head_value is None or base_value[0] == 0:
+            continue
+
+        (base_value, higher_is_better), (head_value, _) = base_value, head_value
+
+        # Positive is slower, whichever way round the statistic goes
+        slowdown = (base_value - head_value) / base_value if higher_is_better else (head_value - base_value) / base_value
+        comparisons.append({'name': head_result['name'],
+                            'base': base_value,
+                            'head': head_value,
+                            'slowdown': slowdown,
+                            'regressed': slowdown > threshold
+                            })
+
+    return comparisons
+
+
+def main(argv: list | None = None):
+    parser = ArgumentParser(description='Compares two benchmark reports')
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Relative slow down counted as a regression')
+    args = parser.parse_args(argv)
+
+    base, head = read_report(args.base), read_report(args.head)
+    if base['environment']['cpus'] != head['environment']['cpus'] or base['environment']['machine'] != head['environment']['machine']:
+        print('Warning: the reports were made on different machines', file=sys.stderr)
+
+    if base['parameters'] != head['parameters']:
+        print('Warning: the reports were made with different parameters', file=sys.stderr)
+
+    comparisons = compare_reports(base, head, args.threshold)
+    if not comparisons:
+        print('The reports have no measurements in common', file=sys.stderr)
+
+    for comparison in comparisons:
+        marker = 'REGRESSED' if comparison['regressed'] else ''
+        print(f'{comparison["name"]:<40} {comparison["base"]:>12.4f} {comparison["head"]:>12.4f} {comparison["slowdown"]:>+8.1%} {marker}')
+
+    if any(comparison['regressed'] for comparison in comparisons):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+""" This file contains a load generator that drives the core
+API with concurrent simulated clients and reports the
+throughput and latency of each step of a job.
+
+Start the core with a local execution backend first, for example
+    EXECUTOR_BACKEND=subprocess ROOT_WORKER_URL=http://127.0.0.1 MIN_PORT=18001 MAX_PORT=18004
+then run from the root of the repository
+    python -m benchmarks.load_generator --clients 4 --jobs-per-client 5 --output load.json
+
+In 'session' mode each client goes through the same steps as the front end used to:
+fetchtoken, postjob, status polling, postDataFile to its worker and getResults.
+'upload' mode goes through them as the front end does now, uploading the dataset
+to the core in compressed chunks while the job waits for and boots its worker,
+then reading the results the core fetched. 'batch' mode uploads the dataset to the core once and runs the jobs as batches,
+which is the only mode the inprocess backend supports.
+ """
+#----------------------------------
+#
+#
+from argparse import ArgumentParser, BooleanOptionalAction
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import monotonic, perf_counter, sleep
+from hashlib import sha256
+from urllib.parse import urlparse
+import sys
+import threading
+import zlib
+
+import requests
+
+from benchmarks.report import make_report, summarize, write_report
+from benchmarks.synthetic import make_dataset, make_job_spec
+
+# Statuses a session can't leave
+TERMINAL_STATUSES = ('FINISHED', 'KILLED', 'ERROR', 'COMPLETED')
+
+# Steps of a session mode job, in the order a client goes through them
+SESSION_STEPS = ('fetchtoken', 'postjob', 'queued', 'postdata', 'training', 'getresults', 'total')
+UPLOAD_STEPS = ('fetchtoken', 'upload', 'postjob', 'training', 'getresults', 'total')
+BATCH_STEPS = ('postbatch', 'total')
+
+
+class JobFailed(Exception):
+    pass
+
+
+class LoadGenerator():
+    """Runs the simulated clients and collects the seconds each step of each job took"""
+
+    def __init__(self, args, dataset_bytes: bytes, job_spec: dict):
+        self.args = args
+        self.dataset_bytes = dataset_bytes
+        self.dataset_digest = sha256(dataset_bytes).hexdigest()
+        self.job_spec = job_spec
+
+        # Step mapped to the seconds it took in every job that got that far
+        self.step_seconds = {}
+        self.failures = {}
+        self.rejections = 0
+        self.completed_jobs = 0
+        self.lock = threading.Lock()
+
+
+    def run(self) -> dict:
+        dataset_digest = self.post_dataset() if self.args.mode == 'batch' else None
+
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.clients) as executor:
+            futures = [executor.submit(self.run_client, client_number, dataset_digest) for client_number in range(self.args.clients)]
+            for future in futures:
+                future.result()
+        wall_seconds = perf_counter() - start
+
+        steps = {'session': SESSION_STEPS, 'upload': UPLOAD_STEPS, 'batch': BATCH_STEPS}[self.args.mode]
+        results = [{'name': f'{self.args.mode}.{step}', 'step': step, 'seconds': summarize(self.step_seconds.get(step, []))} for step in steps]
+        results.append({'name': f'{self.args.mode}.throughput', 'jobsPerSecond': self.completed_jobs / wall_seconds if wall_seconds > 0 else None})
+
+        return {'results': results,
+                'summary': {'wallSeconds': wall_seconds,
+                            'completedJobs': self.completed_jobs,
+                            'failedJobs': sum(self.failures.values()),
+                            'failures': self.failures,
+                            'rejections': self.rejections
+                            }
+                }
+
+
+    def run_client(self, client_number: int, dataset_digest: str | None):
+        session = requests.Session()
+        if self.args.mode == 'batch':
+            jobs = [lambda: self.run_batch(session, client_number, dataset_digest)]
+        elif self.args.mode == 'upload':
+            jobs = [lambda: self.run_upload_job(session, client_number)] * self.args.jobs_per_client
+        else:
+            jobs = [lambda: self.run_session_job(session, client_number)] * self.args.jobs_per_client
+
+        for job in jobs:
+            job_start = perf_counter()
+            try:
+                steps = job()
+            except (JobFailed, requests.RequestException) as e:
+                reason = str(e) if isinstance(e, JobFailed) else type(e).__name__
+                with self.lock:
+                    self.failures[reason] = self.failures.get(reason, 0) + 1
+                print(f'Client {client_number}: {e}', file=sys.stderr)
+                continue
+
+            steps['total'] = perf_counter() - job_start
+            with self.lock:
+                self.completed_jobs += self.args.jobs_per_client if self.args.mode == 'batch' else 1
+                for step, seconds in steps.items():
+                    self.step_seconds.setdefault(step, []).append(seconds)
+
+
+    def run_session_job(self, session: requests.Session, client_number: int) -> dict:
+        steps = {}
+
+        with self.timed(steps, 'fetchtoken'):
+            token = self.check(session.get(f'{self.args.core_url}/api/fetchtoken', timeout=self.args.request_timeout)).json()['token']
+
+        with self.timed(steps, 'postjob'):
+            self.post_with_retry(session, f'{self.args.core_url}/api/postjob/',
+                                 {'session_token': token, 'job_spec': self.job_spec, 'user': f'client-{client_number}'})
+
+        # Queued until a worker has been leased, started and given the job
+        with self.timed(steps, 'queued'):
+            self.wait_for_status(session, token, ('PENDING_DATA_TRANSFER',))
+
+        worker_url = self.get_worker_url(session, token)
+        with self.timed(steps, 'postdata'):
+            files = {'data_file': ('dataset.csv', self.dataset_bytes, 'text/csv')}
+            self.check(session.post(f'{worker_url}/api/postDataFile/', files=files, timeout=self.args.job_timeout))
+
+        # The trainer answers the upload straight away and trains in the background until it reports to the core
+        with self.timed(steps, 'training'):
+            self.wait_for_status(session, token, ('PENDING_RESPONSE_FETCH',))
+
+        with self.timed(steps, 'getresults'):
+            self.check(session.get(f'{worker_url}/api/getResults', timeout=self.args.request_timeout)).json()
+
+        return steps
+
+
+    def run_upload_job(self, session: requests.Session, client_number: int) -> dict:
+        steps = {}
+
+        with self.timed(steps, 'fetchtoken'):
+            token = self.check(session.get(f'{self.args.core_url}/api/fetchtoken', timeout=self.args.request_timeout)).json()['token']
+
+        # The upload runs alongside the job being queued and its worker booting
+        upload_errors = []
+        upload_thread = threading.Thread(target=self.upload_dataset, args=(token, steps, upload_errors))
+        upload_thread.start()
+
+        try:
+            with self.timed(steps, 'postjob'):
+                self.post_with_retry(session, f'{self.args.core_url}/api/postjob/',
+                                     {'session_token': token, 'job_spec': self.job_spec, 'user': f'client-{client_number}'})
+
+            # The core hands the dataset over and fetches the results, then lets the worker go
+            with self.timed(steps, 'training'):
+                self.wait_for_status(session, token, ('FINISHED', 'KILLED'))
+        finally:
+            upload_thread.join()
+        if upload_errors:
+            raise upload_errors[0]
+
+        with self.timed(steps, 'getresults'):
+            results = self.check(session.get(f'{self.args.core_url}/api/getresults/', params={'token': token}, timeout=self.args.request_timeout)).json()['results']
+        if results is None:
+            raise JobFailed('no results')
+
+        return steps
+
+
+    def upload_dataset(self, token: str, steps: dict, errors: list):
+        """Uploads the dataset to the core in compressed chunks, skipped if the core already holds it"""
+        session = requests.Session()
+        try:
+            with self.timed(steps, 'upload'):
+                body = {'session_token': token, 'digest': self.dataset_digest, 'content_type': 'text/csv', 'file_name': 'dataset.csv'}
+                upload = self.check(session.post(f'{self.args.core_url}/api/uploads/', json=body, timeout=self.args.request_timeout)).json()
+                if not upload['complete']:
+                    for offset in range(0, len(self.dataset_bytes), self.args.upload_chunk_bytes):
+                        chunk = self.dataset_bytes[offset:offset + self.args.upload_chunk_bytes]
+                        headers = {'content-encoding': 'gzip'} if self.args.upload_gzip else {}
+                        if self.args.upload_gzip:
+                            chunk = gzip_chunk(chunk)
+                        self.check(session.put(f'{self.args.core_url}/api/uploads/{upload["upload_id"]}', params={'offset': offset},
+                                               data=chunk, headers=headers, timeout=self.args.job_timeout))
+                    upload = self.check(session.post(f'{self.args.core_url}/api/uploads/{upload["upload_id"]}/complete', timeout=self.args.request_timeout)).json()
+
+            if not upload['attached']:
+                raise JobFailed('not attached')
+        except (JobFailed, requests.RequestException) as e:
+            errors.append(e)
+
+
+    def run_batch(self, session: requests.Session, client_number: int, dataset_digest: str) -> dict:
+        steps = {}
+
+        with self.timed(steps, 'postbatch'):
+            body = {'dataset': dataset_digest, 'job_specs': [self.job_spec] * self.args.jobs_per_client, 'user': f'client-{client_number}'}
+            batch_id = self.post_with_retry(session, f'{self.args.core_url}/api/postbatch/', body).json()['batch_id']
+
+        deadline = monotonic() + self.args.job_timeout
+        while True:
+            progress = self.check(session.get(f'{self.args.core_url}/api/batchstatus/', params={'batch_id': batch_id}, timeout=self.args.request_timeout)).json()['progress']
+            if progress['done'] == progress['total']:
+                break
+            if monotonic() > deadline:
+                raise JobFailed('timeout')
+            sleep(self.args.poll_interval)
+
+        if progress['statuses'].get('ERROR'):
+            raise JobFailed('ERROR')
+
+        return steps
+
+
+    def post_dataset(self) -> str:
+        response = self.check(requests.post(f'{self.args.core_url}/api/postdataset/', data=self.dataset_bytes,
+                                            headers={'content-type': 'text/csv', 'x-file-name': 'dataset.csv'}, timeout=self.args.job_timeout))
+        return response.json()['dataset']
+
+
+    def post_with_retry(self, session: requests.Session, url: str, body: dict) -> requests.Response:
+        # A full queue answers 429 with how long to wait, which counts towards the step
+        deadline = monotonic() + self.args.job_timeout
+        while True:
+            response = session.post(url, json=body, timeout=self.args.request_timeout)
+            if response.status_code != 429:
+                return self.check(response)
+
+            with self.lock:
+                self.rejections += 1
+            if monotonic() > deadline:
+                raise JobFailed('rejected')
+            sleep(float(response.headers.get('Retry-After', 1)))
+
+
+    def wait_for_status(self, session: requests.Session, token: str, statuses: tuple):
+        deadline = monotonic() + self.args.job_timeout
+        while True:
+            status = self.check(session.get(f'{self.args.core_url}/api/pollstatus/', params={'token': token}, timeout=self.args.request_timeout)).json()['status']
+            if status in statuses:
+                return
+            if status in TERMINAL_STATUSES or status is None:
+                raise JobFailed(str(status))
+            if monotonic() > deadline:
+                raise JobFailed('timeout')
+            sleep(self.args.poll_interval)
+
+
+    def get_worker_url(self, session: requests.Session, token: str) -> str:
+        response = self.check(session.get(f'{self.args.core_url}/api/getworkerport/', params={'token': token}, timeout=self.args.request_timeout)).json()
+        if response.get('workerUrl'):
+            return response['workerUrl']
+
+        # Like the front end, a worker without a URL of its own is on the core's host
+        core_url = urlparse(self.args.core_url)
+        return f'{core_url.scheme}://{core_url.hostname}:{response["workerPort"]}'
+
+
+    def check(self, response: requests.Response) -> requests.Response:
+        if not response.ok:
+            raise JobFailed(f'HTTP {response.status_code}')
+        return response
+
+
+    @contextmanager
+    def timed(self, steps: dict, step: str):
+        # Only steps that finished are timed, a failed job is counted in failures instead
+        start = perf_counter()
+        yield
+        steps[step] = perf_counter() - start
+
+
+def gzip_chunk(chunk: bytes) -> bytes:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(chunk) + compressor.flush()
+
+
+def main(argv: list | None = None):
+    parser = ArgumentParser(description='Drives the core API with concurrent simulated clients')
+    parser.add_argument('--core-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--mode', choices=('session', 'upload', 'batch'), default='session')
+    parser.add_argument('--clients', type=int, default=4, help='Concurrent simulated clients')
+    parser.add_argument('--jobs-per-client', type=int, default=3, help='Jobs each client runs, one after another or as one batch')
+    parser.add_argument('--rows', type=int, default=20_000, help='Rows of the synthetic dataset every job trains on')
+    parser.add_argument('--features', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--models', type=int, default=1, help='Models per job')
+    parser.add_argument('--algorithm', default='Random Forest')
+    parser.add_argument('--n-estimators', type=int, default=10)
+    parser.add_argument('--use-cache', action='store_true', help="Let the trainer's result cache answer repeated jobs")
+    parser.add_argument('--upload-chunk-bytes', type=int, default=1024 * 1024, help='Bytes of the dataset in each chunk of an upload mode upload')
+    parser.add_argument('--upload-gzip', action=BooleanOptionalAction, default=True, help='Compress each upload chunk')
+    parser.add_argument('--poll-interval', type=float, default=0.1)
+    parser.add_argument('--request-timeout', type=float, default=30)
+    parser.add_argument('--job-timeout', type=float, default=600, help='Seconds a single job may take before it counts as failed')
+    parser.add_argument('--output', default='-', help="JSON report path, '-' for stdout")
+    args = parser.parse_args(argv)
+
+    df = make_dataset(args.rows, args.features, args.seed)
+    model_params = {'n_estimators': args.n_estimators, 'n_jobs': 1} if args.algorithm == 'Random Forest' else {}
+    job_spec = make_job_spec(df, args.models, args.algorithm, model_params, args.use_cache)
+
+    load_generator = LoadGenerator(args, df.to_csv().encode(), job_spec)
+    outcome = load_generator.run()
+
+    # The core's own view of the run, for the queue wait times and dispatch counts
+    try:
+        queue_metrics = requests.get(f'{args.core_url}/api/queuemetrics/', timeout=args.request_timeout).json()
+    except (requests.RequestException, ValueError):
+        queue_metrics = None
+
+    summary = outcome['summary']
+    print(f'{summary["completedJobs"]} jobs in {summary["wallSeconds"]:.2f}s, {summary["failedJobs"]} failed, {summary["rejections"]} rejected', file=sys.stderr)
+
+    write_report(make_report('load', vars(args), outcome['results'], summary=summary, queueMetrics=queue_metrics), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for the machine readable
+reports benchmarks write, so revisions can be compared.
+ """
+#----------------------------------
+#
+#
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+import json
+import os
+import platform
+import subprocess
+import sys
+
+import numpy as np
+
+REPORT_FORMAT_VERSION = 1
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Libraries whose version changes how fast the pipeline runs
+REPORTED_LIBRARIES = ('numpy', 'pandas', 'scikit-learn', 'pyarrow', 'fastapi', 'uvicorn', 'requests')
+
+
+def summarize(samples: list) -> dict:
+    """Summary statistics of repeated timings, in seconds"""
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.size == 0:
+        return {'count': 0}
+
+    return {'count': int(samples.size),
+            'min': float(samples.min()),
+            'median': float(np.median(samples)),
+            'mean': float(samples.mean()),
+            'p95': float(np.percentile(samples, 95)),
+            'max': float(samples.max())
+            }
+
+
+def environment() -> dict:
+    """What the benchmark ran on, so results from different machines are not compared by mistake"""
+    cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+    libraries = {}
+    for library in REPORTED_LIBRARIES:
+        try:
+            libraries[library] = version(library)
+        except PackageNotFoundError:
+            libraries[library] = None
+
+    return {'revision': git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpus': cpu_count,
+            'libraries': libraries
+            }
+
+
+def git_revision() -> dict | None:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_DIRECTORY, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPOSITORY_DIRECTORY, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return {'commit': commit, 'dirty': bool(status.strip())}
+
+
+def make_report(suite: str, parameters: dict, results: list, **extra) -> dict:
+    """Wraps the results of a suite with what is needed to compare it against another run
+
+    Args:
+        suite (str): Name of the suite, only reports of the same suite are compared
+
+        parameters (dict): The arguments the suite ran with
+
+        results (list): One dict per measurement, each with a 'name' unique in the report
+
+    Returns:
+        dict: The report
+    """
+    return {'formatVersion': REPORT_FORMAT_VERSION,
+            'suite': suite,
+            'createdAt': datetime.now(timezone.utc).isoformat(),
+            'environment': environment(),
+            'parameters': parameters,
+            'results': results,
+            **extra
+            }
+
+
+def write_report(report: dict, path: str | None):
+    """Writes the report as JSON to path, or to stdout when path is None or '-'"""
+    text = json.dumps(report, indent=2, default=str)
+    if path is None or path == '-':
+        print(text)
+        return
+
+    with open(path, 'w') as file:
+        file.write(text + '\n')
+    print(f'Wrote {path}', file=sys.stderr)
+
+
+def read_report(path: str) -> dict:
+    with open(path) as file:
+        report = json.load(file)
+
+    if report.get('formatVersion') != REPORT_FORMAT_VERSION:
+        raise ValueError(f'{path} has report format {report.get("formatVersion")}, expected {REPORT_FORMAT_VERSION}')
+    return report
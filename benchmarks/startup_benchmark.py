@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+""" This file contains a benchmark of how a trainer is
+started, timing how long it takes to answer its first
+request and to run its first and second job, and how much
+memory it holds once it has.
+
+Run from the root of the repository, for example
+    python -m benchmarks.startup_benchmark --modes uvicorn serve --repeats 3 --output startup.json
+ """
+#----------------------------------
+#
+#
+from argparse import ArgumentParser
+from time import monotonic, perf_counter, sleep
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+
+import requests
+
+from benchmarks.report import REPOSITORY_DIRECTORY, make_report, summarize, write_report
+from benchmarks.synthetic import make_dataset, make_job_spec
+
+TRAINER_DIRECTORY = os.path.join(REPOSITORY_DIRECTORY, 'ml-pipe-trainer')
+
+# How each mode starts a trainer on a port, from the directory it is started in.
+# uvicorn is the app served without preloading, serve is the production startup
+# and dev is the reloading server the trainer containers used to be started with
+STARTUP_MODES = {'uvicorn': (lambda port: [sys.executable, '-m', 'uvicorn', 'src.main:app', '--host', '127.0.0.1', '--port', str(port)], TRAINER_DIRECTORY),
+                 'serve': (lambda port: [sys.executable, '-m', 'src.serve', '--host', '127.0.0.1', '--port', str(port)], TRAINER_DIRECTORY),
+                 'dev': (lambda port: ['fastapi', 'dev', './main.py', '--host', '127.0.0.1', '--port', str(port)], os.path.join(TRAINER_DIRECTORY, 'src'))
+                 }
+
+STAGES = ('ready', 'first_job', 'second_job')
+POLL_SECONDS = 0.02
+
+
+class StartupFailed(Exception):
+    pass
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_trainer(mode: str, port: int, environment: dict) -> subprocess.Popen:
+    command, directory = STARTUP_MODES[mode]
+
+    # A session of its own, so the trainer and every process it forks are stopped together
+    return subprocess.Popen(command(port), cwd=directory, env=environment, start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop_trainer(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(10)
+    except ProcessLookupError:
+        return
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def wait_until_ready(process: subprocess.Popen, url: str, timeout: float):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if process.poll() is not None:
+            raise StartupFailed(f'Trainer exited with {process.returncode} before it was ready')
+        try:
+            if requests.get(f'{url}/api/health', timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        sleep(POLL_SECONDS)
+
+    raise StartupFailed('Trainer was not ready in time')
+
+
+def run_job(http: requests.Session, url: str, dataset_bytes: bytes, job_spec: dict, token: str, timeout: float):
+    """Gives the trainer a job as the core and a client would and waits for it to finish"""
+    http.post(f'{url}/api/reset/').raise_for_status()
+    http.post(f'{url}/api/init', json={'session_token': token}).raise_for_status()
+    http.post(f'{url}/api/postJob/', json=job_spec).raise_for_status()
+    http.post(f'{url}/api/postDataFile/', files={'data_file': ('dataset.csv', dataset_bytes, 'text/csv')}).raise_for_status()
+
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        progress = http.get(f'{url}/api/progress').json()
+        if progress['status'] == 'finished':
+            return
+        if progress['status'] in ('cancelled', 'error'):
+            raise StartupFailed(f"Job ended with {progress['status']}: {progress.get('error')}")
+        sleep(POLL_SECONDS)
+
+    raise StartupFailed('Job did not finish in time')
+
+
+def process_tree(pid: int) -> list:
+    pids = [pid]
+    for child in _read_proc(f'/proc/{pid}/task/{pid}/children').split():
+        pids.extend(process_tree(int(child)))
+    return pids
+
+
+def memory_kilobytes(pid: int) -> dict | None:
+    """Resident and proportional set size of a process and its children, None off Linux.
+    PSS counts pages shared between processes once across them, so it shows what forking saves.
+    """
+    totals = {'rss': 0, 'pss': 0}
+    for tree_pid in process_tree(pid):
+        for line in _read_proc(f'/proc/{tree_pid}/smaps_rollup').splitlines():
+            field, _, value = line.partition(':')
+            if field.lower() in totals:
+                totals[field.lower()] += int(value.split()[0])
+
+    return totals if totals['rss'] else None
+
+
+def _read_proc(path: str) -> str:
+    try:
+        with open(path) as file:
+            return file.read()
+    except OSError:
+        return ''
+
+
+def run_mode(mode: str, args, dataset_bytes: bytes, job_spec: dict, environment: dict) -> list:
+    samples = {stage: [] for stage in STAGES}
+    memory = []
+    for repeat in range(args.repeats):
+        port = free_port()
+        url = f'http://127.0.0.1:{port}'
+        http = requests.Session()
+
+        start = perf_counter()
+        process = start_trainer(mode, port, environment)
+        try:
+            wait_until_ready(process, url, args.timeout)
+            samples['ready'].append(perf_counter() - start)
+
+            for stage in STAGES[1:]:
+                job_start = perf_counter()
+                run_job(http, url, dataset_bytes, job_spec, f'{mode}-{repeat}-{stage}', args.timeout)
+                samples[stage].append(perf_counter() - job_start)
+
+            memory.append(memory_kilobytes(process.pid))
+        except (StartupFailed, requests.RequestException) as e:
+            print(f'{mode} repeat {repeat}: {e}', file=sys.stderr)
+        finally:
+            stop_trainer(process)
+
+        print(f'{mode:>8} repeat {repeat}  ' + '  '.join(f'{stage} {samples[stage][-1]:.3f}s' for stage in STAGES if len(samples[stage]) > repeat), file=sys.stderr)
+
+    results = [{'name': f'{mode}.{stage}', 'mode': mode, 'stage': stage, 'seconds': summarize(samples[stage])} for stage in STAGES]
+
+    memory = [sample for sample in memory if sample is not None]
+    if memory:
+        results.append({'name': f'{mode}.memory', 'mode': mode,
+                        'rssKilobytes': max(sample['rss'] for sample in memory),
+                        'pssKilobytes': max(sample['pss'] for sample in memory)})
+
+    return results
+
+
+def main(argv: list | None = None):
+    parser = ArgumentParser(description='Startup time and memory of the trainer started each way')
+    parser.add_argument('--modes', nargs='+', choices=tuple(STARTUP_MODES), default=['uvicorn', 'serve'])
+    parser.add_argument('--repeats', type=int, default=3, help='Trainers started in each mode')
+    parser.add_argument('--rows', type=int, default=5_000, help='Rows of the dataset each job trains on')
+    parser.add_argument('--models', type=int, default=1)
+    parser.add_argument('--algorithm', default='Random Forest')
+    parser.add_argument('--n-estimators', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for the trainer to start and for each job')
+    parser.add_argument('--output', default='-', help="JSON report path, '-' for stdout")
+    args = parser.parse_args(argv)
+
+    if 'dev' in args.modes and shutil.which('fastapi') is None:
+        parser.error('the dev mode needs the fastapi command line')
+
+    df = make_dataset(args.rows)
+    dataset_bytes = df.to_csv().encode()
+    model_params = {'n_estimators': args.n_estimators, 'n_jobs': 1} if args.algorithm == 'Random Forest' else {}
+    job_spec = make_job_spec(df, args.models, args.algorithm, model_params)
+
+    # The trainers keep their files apart from any other trainer's, and their reports to the core go nowhere
+    with tempfile.TemporaryDirectory() as directory:
+        environment = {**os.environ,
+                       'PYTHONPATH': TRAINER_DIRECTORY,
+                       'ARTIFACT_DIRECTORY': os.path.join(directory, 'artifacts'),
+                       'RESULT_CACHE_DIRECTORY': os.path.join(directory, 'results'),
+                       'CORE_URL': f'http://127.0.0.1:{free_port()}',
+                       'NOTIFY_ATTEMPTS': '1'}
+
+        results = []
+        for mode in args.modes:
+            results.extend(run_mode(mode, args, dataset_bytes, job_spec, environment))
+
+    write_report(make_report('startup', vars(args), results), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for generating synthetic
+time indexed datasets and job specifications for benchmarks.
+ """
+#----------------------------------
+#
+#
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+TARGET = 'y'
+
+
+def make_dataset(rows: int, features: int = 8, seed: int = 0, start: str = '2015-01-01', years: int = 4, nan_fraction: float = 0.01) -> DataFrame:
+    """Makes a dataset shaped like the ones the pipeline is built for: an evenly
+    spaced datetime index, numeric features with a few gaps in them and a
+    target that is a noisy linear mix of the features. The same arguments always
+    give the same dataset.
+
+    Args:
+        rows (int): Number of rows
+
+        features (int): Number of feature columns, named f0, f1, ...
+
+        seed (int): Seed of the random number generator
+
+        start (str): Timestamp of the first row
+
+        years (int): Years the rows are spread over, so every size has the same cross validation years
+
+        nan_fraction (float): Share of the values of each feature that are NaN
+
+    Returns:
+        DataFrame: The features and the target column 'y'
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start)
+    index = pd.date_range(start, start + pd.DateOffset(years=years) - pd.Timedelta(seconds=1), periods=rows, name='t')
+
+    # Random walks so interpolating over the gaps means something
+    X = np.cumsum(rng.normal(0, 0.1, size=(rows, features)), axis=0)
+    y = X @ rng.normal(0, 1, size=features) + rng.normal(0, 0.5, size=rows)
+
+    X[rng.random(size=(rows, features)) < nan_fraction] = np.nan
+
+    df = DataFrame(X, index=index, columns=[f'f{feature}' for feature in range(features)])
+    df[TARGET] = y
+
+    return df
+
+
+def feature_columns(df: DataFrame) -> list:
+    return [column for column in df.columns if column != TARGET]
+
+
+def make_cross_validation(df: DataFrame) -> dict:
+    """Trains on every year but the last and tests on the last"""
+    years = sorted({int(year) for year in pd.to_datetime(df.index).year})
+    if len(years) < 2:
+        raise ValueError('The dataset needs to span at least two years')
+
+    return {'type': 'year', 'trainingYears': years[:-1], 'validationYears': None, 'testingYears': years[-1:]}
+
+
+def make_preprocessing_tasks(df: DataFrame) -> list:
+    return [{'task': 'Interpolation', 'args': {'dataSeries': feature_columns(df), 'method': 'linear', 'limit_direction': 'both'}},
+            {'task': 'DropNaNs', 'args': {}}]
+
+
+def make_model_definitions(df: DataFrame, models: int = 1, algorithm: str = 'Random Forest', model_params: dict | None = None) -> list:
+    cross_validation = make_cross_validation(df)
+
+    return [{'id': f'model-{model_number}',
+             'mlFramework': 'scikit-learn',
+             'mlAlgorithm': algorithm,
+             'predictionProblem': 'regression',
+             'modelParams': {**(model_params or {}), 'random_state': model_number},
+             'crossValidation': cross_validation,
+             'target': [TARGET]
+             } for model_number in range(models)]
+
+
+def make_job_spec(df: DataFrame, models: int = 1, algorithm: str = 'Random Forest', model_params: dict | None = None, use_cache: bool = False) -> dict:
+    """A job preprocessing and training on a dataset from make_dataset. The result
+    cache is off by default, so repeated jobs are trained every time.
+    """
+    return {'preprocessingTasks': make_preprocessing_tasks(df),
+            'modelDefinitions': make_model_definitions(df, models, algorithm, model_params),
+            'execution': {'useCache': use_cache}
+            }
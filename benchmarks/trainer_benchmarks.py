@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+""" This file contains micro benchmarks of the trainer's
+preprocessing, splitting and training on synthetic datasets
+of growing size.
+
+Run from the root of the repository, for example
+    python -m benchmarks.trainer_benchmarks --rows 10000 100000 --output trainer.json
+ """
+#----------------------------------
+#
+#
+from argparse import ArgumentParser
+from time import perf_counter
+import gc
+import os
+import sys
+
+from benchmarks.report import REPOSITORY_DIRECTORY, make_report, summarize, write_report
+from benchmarks.synthetic import make_cross_validation, make_dataset, make_model_definitions, make_preprocessing_tasks, TARGET
+
+# The trainer is imported as the in process executor does, with its directory on the path
+sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, 'ml-pipe-trainer'))
+
+from src.data_manipulation import SplitCache, cross_validation, get_XY
+from src.pipeline_manager import preprocess_data, train_models
+from src.preprocessing import compile_preprocessing_plan
+
+BENCHMARKS = ('preprocess_data', 'cross_validation', 'get_XY', 'split_cache', 'train_models')
+
+
+def time_calls(function, setup, repeats: int, warmup: int) -> list:
+    """Times function(setup()) repeats times after warmup untimed calls.
+    setup runs outside the timing, for example to copy a dataset the function changes.
+    """
+    samples = []
+    for call_number in range(warmup + repeats):
+        argument = setup()
+
+        # Garbage left by the last call is collected before, not during, the next one
+        gc.collect()
+        start = perf_counter()
+        function(argument)
+        seconds = perf_counter() - start
+
+        if call_number >= warmup:
+            samples.append(seconds)
+
+    return samples
+
+
+def run_benchmarks(rows: int, args) -> list:
+    df = make_dataset(rows, args.features, args.seed)
+    preprocessing_tasks = make_preprocessing_tasks(df)
+    cross_validation_information = make_cross_validation(df)
+
+    # Compiled once up front, as it is cached across jobs in the trainer
+    compile_preprocessing_plan(preprocessing_tasks)
+    df_clean = preprocess_data(preprocessing_tasks, df.copy())
+    df_training = cross_validation(df_clean, cross_validation_information)['training']
+
+    model_params = {'n_estimators': args.n_estimators, 'n_jobs': 1} if args.algorithm == 'Random Forest' else {}
+    model_definitions = make_model_definitions(df_clean, args.models, args.algorithm, model_params)
+
+    calls = {'preprocess_data': (lambda df_copy: preprocess_data(preprocessing_tasks, df_copy), lambda: df.copy()),
+             'cross_validation': (lambda df_clean: cross_validation(df_clean, cross_validation_information), lambda: df_clean),
+             'get_XY': (lambda df_training: get_XY(df_training, [TARGET]), lambda: df_training),
+             'split_cache': (lambda split_cache: split_cache.get_split(cross_validation_information, [TARGET]), lambda: SplitCache(df_clean)),
+             'train_models': (lambda df_copy: train_models(model_definitions, df_copy, args.max_workers), lambda: df_clean.copy())
+             }
+
+    results = []
+    for benchmark in args.benchmarks:
+        if benchmark == 'train_models' and rows > args.max_train_rows:
+            print(f'Skipping train_models at {rows} rows, above --max-train-rows', file=sys.stderr)
+            continue
+
+        function, setup = calls[benchmark]
+        repeats = args.train_repeats if benchmark == 'train_models' else args.repeats
+        seconds = summarize(time_calls(function, setup, repeats, args.warmup))
+        results.append({'name': f'{benchmark}[rows={rows}]',
+                        'benchmark': benchmark,
+                        'rows': rows,
+                        'seconds': seconds,
+                        'rowsPerSecond': rows / seconds['median'] if seconds['median'] > 0 else None
+                        })
+        print(f'{benchmark:>16} {rows:>10} rows  median {seconds["median"]:.4f}s  min {seconds["min"]:.4f}s', file=sys.stderr)
+
+    return results
+
+
+def main(argv: list | None = None):
+    parser = ArgumentParser(description='Micro benchmarks of the trainer on synthetic time indexed datasets')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 500_000], help='Dataset sizes to run every benchmark at')
+    parser.add_argument('--features', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--train-repeats', type=int, default=3, help='Repeats of train_models, which is much slower than the rest')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed calls before the timed ones')
+    parser.add_argument('--models', type=int, default=2, help='Models per job in train_models')
+    parser.add_argument('--algorithm', default='Random Forest')
+    parser.add_argument('--n-estimators', type=int, default=10)
+    parser.add_argument('--max-workers', type=int, default=1, help='Models trained at once in train_models')
+    parser.add_argument('--max-train-rows', type=int, default=100_000, help='train_models is skipped on larger datasets')
+    parser.add_argument('--output', default='-', help="JSON report path, '-' for stdout")
+    args = parser.parse_args(argv)
+
+    results = []
+    for rows in args.rows:
+        results.extend(run_benchmarks(rows, args))
+
+    write_report(make_report('trainer', vars(args), results), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic and datastructures
+for batches of jobs sharing one dataset
+ """
+#----------------------------------
+#
+#
+#Imports
+from secrets import token_urlsafe
+from session import Session_Manager, Session_Status, Session
+from session_store import Session_Store
+from jobs import Job, Job_Manager, validate_job_spec
+from scheduler import PRIORITY_CLASSES
+
+# A job in the batch is done once its session reaches one of these
+DONE_STATUSES = (Session_Status.FINISHED, Session_Status.KILLED, Session_Status.ERROR)
+
+
+class Batch:
+    def __init__(self, batch_id: str, dataset_digest: str, session_tokens: list[str]):
+        self.batch_id = batch_id
+        self.dataset_digest = dataset_digest
+        self.session_tokens = session_tokens
+
+
+class Batch_Manager:
+    def __init__(self, session_manager: Session_Manager, job_manager: Job_Manager, session_store: Session_Store | None = None):
+        self.TOKEN_LENGTH = 18
+        self.__session_manager = session_manager
+        self.__job_manager = job_manager
+        self.__session_store = session_store
+        self.batch_registry: dict[str:Batch] = {}
+
+        # Session tokens mapped to the batch they belong to, a batch goes once its first session is evicted
+        self.__batch_ids: dict[str:str] = {}
+        self.__session_manager.add_eviction_listener(self.__evict_batches)
+
+        if self.__session_store is not None:
+            for batch_id, dataset_digest, session_tokens in self.__session_store.load_batches():
+                batch = Batch(batch_id, dataset_digest, session_tokens)
+                if self.__get_sessions(batch) is None:
+                    self.__session_store.delete_batch(batch_id)
+                else:
+                    self.__register(batch)
+
+    def new_batch(self, dataset_digest: str, job_specs: list, priority: str | None = None, user: str | None = None) -> str | None:
+        """ Fans the job specs out as one session each. The sessions all point at the
+        same stored dataset, which the core hands to each worker itself. The whole batch
+        shares one fair share of the queue, the users if one is named. Returns None,
+        queueing nothing, if the job queue has no room for the whole batch.
+        Raises ValueError, before any session is made, for an empty batch, a malformed job spec or an unknown priority.
+        """
+        if not isinstance(job_specs, list) or not job_specs:
+            raise ValueError('A batch needs a non empty list of job specs')
+        if priority is not None and priority not in PRIORITY_CLASSES:
+            raise ValueError(f'Unknown priority {priority}, expected one of {PRIORITY_CLASSES}')
+        for job_spec in job_specs:
+            validate_job_spec(job_spec)
+
+        batch_id = token_urlsafe(self.TOKEN_LENGTH)
+
+        session_tokens = []
+        for job_spec in job_specs:
+            token = self.__session_manager.new_session()
+            self.__session_manager.session_registry[token].dataset_digest = dataset_digest
+            session_tokens.append(token)
+
+        jobs = [Job(token, job_spec, priority, user or batch_id) for token, job_spec in zip(session_tokens, job_specs)]
+        if not self.__job_manager.queue_jobs(jobs):
+            for token in session_tokens:
+                self.__session_manager.remove_session(token)
+            return None
+
+        batch = Batch(batch_id, dataset_digest, session_tokens)
+        self.__register(batch)
+        if self.__session_store is not None:
+            self.__session_store.save_batch(batch)
+        return batch_id
+
+    def get_progress(self, batch_id: str) -> dict | None:
+        batch: Batch | None = self.batch_registry.get(batch_id)
+        sessions = self.__get_sessions(batch) if batch is not None else None
+        if sessions is None: return None
+
+        status_counts = {}
+        done = 0
+        for session in sessions:
+            status_counts[session.status.name] = status_counts.get(session.status.name, 0) + 1
+            if session.status in DONE_STATUSES:
+                done += 1
+
+        return {'total': len(batch.session_tokens), 'done': done, 'statuses': status_counts}
+
+    def get_results(self, batch_id: str) -> list | None:
+        """ Results of each job in the order the job specs were given, None for jobs still running """
+        batch: Batch | None = self.batch_registry.get(batch_id)
+        sessions = self.__get_sessions(batch) if batch is not None else None
+        if sessions is None: return None
+
+        return [{'job_index': job_index, 'session_token': session.token, 'status': session.status.name, 'results': session.results}
+                for job_index, session in enumerate(sessions)]
+
+    def __get_sessions(self, batch: Batch) -> list[Session] | None:
+        """ The sessions of the batch, None once any of them has been evicted """
+        sessions = [self.__session_manager.session_registry.get(token) for token in batch.session_tokens]
+        return None if None in sessions else sessions
+
+    def __register(self, batch: Batch):
+        self.batch_registry[batch.batch_id] = batch
+        for token in batch.session_tokens:
+            self.__batch_ids[token] = batch.batch_id
+
+    def __evict_batches(self, tokens: list[str]):
+        for token in tokens:
+            batch: Batch | None = self.batch_registry.pop(self.__batch_ids.pop(token, None), None)
+            if batch is None: continue
+
+            for batch_token in batch.session_tokens:
+                self.__batch_ids.pop(batch_token, None)
+            if self.__session_store is not None:
+                self.__session_store.delete_batch(batch.batch_id)
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic and datastructures
+for datasets uploaded to the core
+ """
+#----------------------------------
+#
+#
+#Imports
+from hashlib import sha256
+from os import getenv
+from secrets import token_urlsafe
+from tempfile import gettempdir, mkstemp
+from time import time
+import json
+import os
+import zlib
+from metrics import METRICS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DATASET_BYTES_INGESTED = METRICS.counter('ml_pipe_dataset_bytes_ingested_total', 'Bytes of datasets uploaded to the core')
+UPLOAD_BYTES_RECEIVED = METRICS.counter('ml_pipe_upload_bytes_received_total', 'Bytes of upload chunks as they were sent, by content encoding', ('encoding',))
+UPLOADS_DEDUPLICATED = METRICS.counter('ml_pipe_uploads_deduplicated_total', 'Uploads skipped as the core already held their dataset')
+
+DATASET_DIRECTORY = getenv('DATASET_DIRECTORY', os.path.join(gettempdir(), 'ml-pipe-datasets'))
+
+# An upload nobody has sent a chunk to for this long is dropped, they are looked for at most this often
+UPLOAD_TTL_SECONDS = float(getenv('UPLOAD_TTL_SECONDS', 24 * 3600))
+UPLOAD_EVICTION_INTERVAL_SECONDS = 600
+
+# Encodings an upload chunk can be compressed with, zstd needs the zstandard package
+UPLOAD_ENCODINGS = ('identity', 'gzip', 'zstd')
+DECOMPRESSION_ERRORS = (zlib.error, zstandard.ZstdError) if zstandard is not None else (zlib.error,)
+UPLOAD_ID_LENGTH = 18
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class Dataset:
+    def __init__(self, digest: str, path: str, content_type: str | None, file_name: str | None, size: int):
+        self.digest = digest
+        self.path = path
+        self.content_type = content_type
+        self.file_name = file_name
+        self.size = size
+
+
+class Upload:
+    def __init__(self, upload_id: str, path: str, content_type: str | None, file_name: str | None, digest: str | None, session_token: str | None):
+        self.upload_id = upload_id
+        self.path = path
+        self.content_type = content_type
+        self.file_name = file_name
+
+        # What the client says the dataset hashes to, and the session it is for
+        self.digest = digest
+        self.session_token = session_token
+
+        # Bytes of the dataset received so far and their running hash
+        self.offset = 0
+        self.hash = sha256()
+        self.busy = False
+
+
+class Upload_Offset_Error(ValueError):
+    """ A chunk did not start where the upload has got to """
+    def __init__(self, offset: int):
+        super().__init__(f'The upload is at offset {offset}')
+        self.offset = offset
+
+
+class Dataset_Store:
+    """ Datasets stored on disk under the sha256 of their bytes, so the
+    same data is only ever kept once however many jobs use it
+    """
+
+    def __init__(self, directory: str = DATASET_DIRECTORY):
+        self.__directory = directory
+        os.makedirs(self.__directory, exist_ok= True)
+
+        # Upload ids mapped to the uploads still being sent
+        self.__uploads: dict[str:Upload] = {}
+        self.__last_eviction = time()
+
+    async def put_stream(self, chunks, content_type: str | None = None, file_name: str | None = None) -> Dataset:
+        """ Streams an upload into the store chunk by chunk, hashing it on the way """
+        digest = sha256()
+        size = 0
+        file_descriptor, temporary_path = mkstemp(prefix= 'upload-', dir= self.__directory)
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                async for chunk in chunks:
+                    file.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                    DATASET_BYTES_INGESTED.inc(len(chunk))
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+        return self.__commit(temporary_path, digest.hexdigest(), content_type, file_name, size)
+
+    def start_upload(self, content_type: str | None = None, file_name: str | None = None, digest: str | None = None, session_token: str | None = None) -> Upload | Dataset:
+        """ Starts a chunked upload. If the client names the digest of a dataset
+        we already hold, nothing is uploaded and that dataset is returned instead
+        """
+        self.__evict_uploads()
+
+        digest = digest.lower() if digest else None
+        if digest is not None:
+            dataset = self.get(digest)
+            if dataset is not None:
+                UPLOADS_DEDUPLICATED.inc()
+                return dataset
+
+        upload_id = token_urlsafe(UPLOAD_ID_LENGTH)
+        upload = Upload(upload_id, self.__upload_path(upload_id), content_type, file_name, digest, session_token)
+        open(upload.path, 'wb').close()
+        with open(self.__upload_metadata_path(upload_id), 'w') as file:
+            json.dump({'content_type': content_type, 'file_name': file_name, 'digest': digest, 'session_token': session_token}, file)
+
+        self.__uploads[upload_id] = upload
+        return upload
+
+    def get_upload(self, upload_id: str) -> Upload | None:
+        upload = self.__uploads.get(upload_id)
+        if upload is None:
+            upload = self.__restore_upload(upload_id)
+        return upload
+
+    async def append_chunk(self, upload: Upload, offset: int, chunks, encoding: str | None = None) -> int:
+        """ Appends the next chunk of an upload, decompressing it as it streams in.
+        A chunk that does not arrive whole is dropped so the client can send it again
+        from the same offset. Returns the offset the upload is at after the chunk.
+        """
+        encoding = (encoding or 'identity').lower()
+        if not supports_encoding(encoding):
+            raise ValueError(f'Unsupported content encoding {encoding}')
+
+        # Two requests sending chunks at once, or a chunk sent again after it arrived
+        if upload.busy or offset != upload.offset:
+            raise Upload_Offset_Error(upload.offset)
+
+        decompressor = new_decompressor(encoding)
+        chunk_hash = upload.hash.copy()
+        size = 0
+        upload.busy = True
+        try:
+            with open(upload.path, 'r+b') as file:
+                file.seek(upload.offset)
+                try:
+                    async for data in chunks:
+                        UPLOAD_BYTES_RECEIVED.inc(len(data), encoding= encoding)
+                        if decompressor is not None:
+                            data = decompressor.decompress(data)
+                        file.write(data)
+                        chunk_hash.update(data)
+                        size += len(data)
+
+                    if decompressor is not None and not getattr(decompressor, 'eof', True):
+                        raise ValueError('The chunk ended before its compressed stream did')
+                except BaseException:
+                    file.truncate(upload.offset)
+                    raise
+        except DECOMPRESSION_ERRORS as e:
+            raise ValueError(f'The chunk could not be decompressed: {e}')
+        finally:
+            upload.busy = False
+
+        DATASET_BYTES_INGESTED.inc(size)
+        upload.hash = chunk_hash
+        upload.offset += size
+        os.utime(self.__upload_metadata_path(upload.upload_id))
+        return upload.offset
+
+    def finish_upload(self, upload: Upload) -> Dataset:
+        """ Stores the uploaded bytes as a dataset under their digest """
+        if upload.busy:
+            raise Upload_Offset_Error(upload.offset)
+
+        digest = upload.hash.hexdigest()
+        if upload.digest is not None and upload.digest != digest:
+            raise ValueError(f'The upload hashes to {digest}, not {upload.digest}')
+
+        self.__uploads.pop(upload.upload_id, None)
+        os.remove(self.__upload_metadata_path(upload.upload_id))
+        return self.__commit(upload.path, digest, upload.content_type, upload.file_name, upload.offset)
+
+    def get(self, digest: str) -> Dataset | None:
+        # Digests are hex, anything else can't be in the store
+        if not digest or not all(character in '0123456789abcdef' for character in digest):
+            return None
+
+        try:
+            with open(self.__metadata_path(digest)) as file:
+                metadata = json.load(file)
+        except FileNotFoundError:
+            return None
+
+        return Dataset(digest, self.__data_path(digest), metadata['content_type'], metadata['file_name'], metadata['size'])
+
+    def __commit(self, temporary_path: str, digest: str, content_type: str | None, file_name: str | None, size: int) -> Dataset:
+        # If we already hold these bytes the new copy is dropped
+        if os.path.exists(self.__metadata_path(digest)):
+            os.remove(temporary_path)
+            return self.get(digest)
+
+        os.replace(temporary_path, self.__data_path(digest))
+        with open(self.__metadata_path(digest), 'w') as file:
+            json.dump({'content_type': content_type, 'file_name': file_name, 'size': size}, file)
+
+        return Dataset(digest, self.__data_path(digest), content_type, file_name, size)
+
+    def __restore_upload(self, upload_id: str) -> Upload | None:
+        """ An upload left by an earlier run of the core, its hash is rebuilt from what had arrived """
+        if not upload_id or not all(character.isalnum() or character in '-_' for character in upload_id):
+            return None
+
+        try:
+            with open(self.__upload_metadata_path(upload_id)) as file:
+                metadata = json.load(file)
+        except FileNotFoundError:
+            return None
+
+        upload = Upload(upload_id, self.__upload_path(upload_id), metadata['content_type'], metadata['file_name'], metadata['digest'], metadata['session_token'])
+        with open(upload.path, 'rb') as file:
+            while block := file.read(HASH_BLOCK_SIZE):
+                upload.hash.update(block)
+                upload.offset += len(block)
+
+        self.__uploads[upload_id] = upload
+        return upload
+
+    def __evict_uploads(self):
+        """ Drops the uploads abandoned part way through """
+        now = time()
+        if now - self.__last_eviction < UPLOAD_EVICTION_INTERVAL_SECONDS: return
+        self.__last_eviction = now
+
+        for file_name in os.listdir(self.__directory):
+            if not (file_name.startswith('upload-') and file_name.endswith('.json')): continue
+
+            upload_id = file_name[len('upload-'):-len('.json')]
+            upload = self.__uploads.get(upload_id)
+            try:
+                if upload is not None and upload.busy: continue
+                if now - os.path.getmtime(self.__upload_metadata_path(upload_id)) < UPLOAD_TTL_SECONDS: continue
+
+                os.remove(self.__upload_metadata_path(upload_id))
+                os.remove(self.__upload_path(upload_id))
+            except FileNotFoundError:
+                pass
+            self.__uploads.pop(upload_id, None)
+
+    def __data_path(self, digest: str) -> str:
+        return os.path.join(self.__directory, digest)
+
+    def __metadata_path(self, digest: str) -> str:
+        return os.path.join(self.__directory, f'{digest}.json')
+
+    def __upload_path(self, upload_id: str) -> str:
+        return os.path.join(self.__directory, f'upload-{upload_id}.part')
+
+    def __upload_metadata_path(self, upload_id: str) -> str:
+        return os.path.join(self.__directory, f'upload-{upload_id}.json')
+
+
+def supports_encoding(encoding: str | None) -> bool:
+    encoding = (encoding or 'identity').lower()
+    return encoding in UPLOAD_ENCODINGS and (encoding != 'zstd' or zstandard is not None)
+
+
+def new_decompressor(encoding: str):
+    """ Streaming decompressor for one chunk, each chunk is compressed on its own """
+    match encoding:
+        case 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        case 'zstd':
+            return zstandard.ZstdDecompressor().decompressobj()
+        case _:
+            return None
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+""" This file contains the logic for running jobs
+on a local process pool instead of trainer workers
+ """
+#----------------------------------
+#
+#
+#Imports
+import multiprocessing
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from os import getenv
+from session import Session_Manager, Session_Status, Session
+from datasets import Dataset_Store
+from workers import TRAINER_DIRECTORY
+
+# How many jobs run at once, 0 means one per core
+IN_PROCESS_MAX_WORKERS = int(getenv('IN_PROCESS_MAX_WORKERS', 0))
+
+# A job posted before its dataset has reached the core waits this long for it
+IN_PROCESS_DATASET_TIMEOUT_SECONDS = float(getenv('IN_PROCESS_DATASET_TIMEOUT_SECONDS', 600))
+
+
+class In_Process_Executor:
+    """ Runs jobs by calling the trainers run_pipeline on a pool of local processes.
+    There is no container or HTTP hop so small jobs start straight away, but only
+    jobs whose dataset the core holds can run here, as there is no worker for a
+    client to send its data to. A job whose dataset is still being uploaded is
+    parked until it is attached and then queued again.
+    """
+
+    def __init__(self, session_manager: Session_Manager, dataset_store: Dataset_Store, requeue, max_workers: int = IN_PROCESS_MAX_WORKERS,
+                 trainer_directory: str = TRAINER_DIRECTORY, dataset_timeout: float = IN_PROCESS_DATASET_TIMEOUT_SECONDS):
+        self.__session_manager = session_manager
+        self.__dataset_store = dataset_store
+        self.__trainer_directory = trainer_directory
+        self.__max_workers = max_workers or multiprocessing.cpu_count()
+
+        # One slot per process so the dispatcher only hands us what we can start now
+        self.__slots = threading.Semaphore(self.__max_workers)
+        self.__slots_used = 0
+        self.__lock = threading.Lock()
+        self.__process_pool = self.__new_process_pool()
+
+        # Session tokens mapped to their jobs waiting for a dataset, which requeue(job) puts back in the queue
+        self.__parked: dict[str:object] = {}
+        self.__requeue = requeue
+        self.__dataset_timeout = dataset_timeout
+        self.__session_manager.add_dataset_listener(self.__unpark)
+
+    def dispatch(self, job, timeout: float | None = None) -> bool:
+        """ Starts the job on a free process, waiting up to timeout seconds
+        for one. Returns False if none became free.
+        """
+        related_session: Session = self.__session_manager.session_registry[job.session_token]
+        if not self.__slots.acquire(timeout= timeout):
+            return False
+        self.__count_slot(1)
+
+        related_session.job = job
+
+        # Looked for under the lock so a dataset attached meanwhile either is seen here or finds the job parked
+        with self.__lock:
+            dataset = self.__dataset_store.get(related_session.dataset_digest) if related_session.dataset_digest is not None else None
+            if dataset is None:
+                self.__parked[job.session_token] = job
+        if dataset is None:
+            self.__free_slot()
+            timer = threading.Timer(self.__dataset_timeout, self.__expire, (job,))
+            timer.daemon = True
+            timer.start()
+            return True
+
+        related_session.status = Session_Status.TRAINING
+        with self.__lock:
+            process_pool = self.__process_pool
+        try:
+            future = process_pool.submit(run_job, job.job_spec, dataset.path, dataset.content_type, dataset.file_name, dataset.digest)
+        except Exception as e:
+            print(f'Could not start the job: {e}\n\nToken: {related_session.token}')
+            self.__free_slot()
+            related_session.status = Session_Status.ERROR
+            if isinstance(e, BrokenProcessPool):
+                self.__replace_process_pool(process_pool)
+            return True
+
+        future.add_done_callback(lambda future: self.__finish_job(related_session, process_pool, future))
+        return True
+
+    def fail(self, job):
+        related_session: Session | None = self.__session_manager.session_registry.get(job.session_token)
+        if related_session is not None:
+            related_session.status = Session_Status.ERROR
+
+    def utilization(self) -> dict:
+        with self.__lock:
+            slots_used = self.__slots_used
+        return {'inprocess': {'slots': self.__max_workers, 'slots_used': slots_used, 'leased': slots_used, 'idle': self.__max_workers - slots_used}}
+
+    def stop(self):
+        with self.__lock:
+            self.__process_pool.shutdown(wait= True, cancel_futures= True)
+
+    def __finish_job(self, related_session: Session, process_pool: ProcessPoolExecutor, future):
+        self.__free_slot()
+
+        exception = future.exception()
+        if exception is None:
+            related_session.results = future.result()
+            related_session.status = Session_Status.FINISHED
+            return
+
+        print(f'{exception}\n\nToken: {related_session.token}')
+        related_session.status = Session_Status.ERROR
+
+        if isinstance(exception, BrokenProcessPool):
+            self.__replace_process_pool(process_pool)
+
+    def __replace_process_pool(self, process_pool: ProcessPoolExecutor):
+        # A process that died takes the whole pool with it, so start a new one unless another job already has
+        with self.__lock:
+            if self.__process_pool is process_pool:
+                process_pool.shutdown(wait= False)
+                self.__process_pool = self.__new_process_pool()
+
+    def __unpark(self, token: str):
+        with self.__lock:
+            parked = self.__parked.pop(token, None)
+        if parked is not None:
+            self.__requeue(parked)
+
+    def __expire(self, job):
+        with self.__lock:
+            if self.__parked.get(job.session_token) is not job: return
+            del self.__parked[job.session_token]
+
+        related_session: Session | None = self.__session_manager.session_registry.get(job.session_token)
+        if related_session is not None:
+            print(f'No dataset was attached within {self.__dataset_timeout} seconds, Token: {job.session_token}')
+            related_session.status = Session_Status.ERROR
+
+    def __count_slot(self, change: int):
+        with self.__lock:
+            self.__slots_used += change
+
+    def __free_slot(self):
+        self.__count_slot(-1)
+        self.__slots.release()
+
+    def __new_process_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers= self.__max_workers,
+                                   mp_context= multiprocessing.get_context('spawn'),
+                                   initializer= attach_trainer,
+                                   initargs= (self.__trainer_directory,))
+
+
+def attach_trainer(trainer_directory: str):
+    """ Makes the trainer importable in a pool process and imports its training libraries up front """
+    sys.path.insert(0, trainer_directory)
+
+    from src.training import warm_up
+    warm_up()
+
+
+def run_job(job_spec: dict, dataset_path: str, content_type: str | None, file_name: str | None, dataset_digest: str) -> list:
+    from src.data_ingest import DatasetFile, detect_format
+    from src.pipeline_manager import run_pipeline
+
+    data_format = detect_format(content_type, file_name, dataset_path)
+    job_results = run_pipeline(DatasetFile(dataset_path, data_format), job_spec, dataset_digest)
+
+    # Only the models table is kept by the core, predictions are served by trainer workers
+    return job_results.to_records()
@@ -13,63 +13,246 @@ jobs and the multithreaded load balancer
 #Imports
 from pydantic import BaseModel
 import threading
-from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 from session import Session_Manager, Session_Status, Session
+from scheduler import Job_Scheduler, DEFAULT_PRIORITY, PRIORITY_CLASSES
+from workers import Worker_Pool, Worker
+from nodes import estimate_resources, load_node_registry
+from datasets import Dataset_Store
+from in_process import In_Process_Executor
 from os import getenv
-import docker
+from metrics import METRICS
+import json
 import requests
 
-JOB_QUEUE_SIZE = 200
+# Where jobs run: 'docker' containers, local 'subprocess' trainers or an 'inprocess' process pool
+EXECUTOR_BACKEND = getenv('EXECUTOR_BACKEND', 'docker')
+EXECUTOR_BACKENDS = ('docker', 'subprocess', 'inprocess')
+
+# How often Overwatch looks over the active workers and how many it may talk to at once
+OVERWATCH_TICK_SECONDS = float(getenv('OVERWATCH_TICK_SECONDS', 0.25))
+OVERWATCH_MAX_WORKERS = int(getenv('OVERWATCH_MAX_WORKERS', 16))
+
+# Timeouts (connect, read) for requests made to a worker
+WORKER_REQUEST_TIMEOUT = (float(getenv('WORKER_CONNECT_TIMEOUT', 1)), float(getenv('WORKER_READ_TIMEOUT', 10)))
+
+# The trainer answers a data transfer once it has written the whole dataset to disk, so by default there is no read timeout
+DATA_TRANSFER_TIMEOUT = (WORKER_REQUEST_TIMEOUT[0], float(getenv('DATA_TRANSFER_READ_TIMEOUT', 0)) or None)
+
+# Answer of a trainer to a job spec it can't run
+JOB_REFUSED_CODE = 422
+
+# Answers of a trainer that can't read the dataset from our dataset directory, which is then sent to it instead
+SHARED_PATH_UNAVAILABLE_CODES = (404, 405)
+
+# Backoff used while waiting for a booting container to respond
+BOOT_BACKOFF_INITIAL_SECONDS = float(getenv('BOOT_BACKOFF_INITIAL_SECONDS', 0.25))
+BOOT_BACKOFF_MAX_SECONDS = float(getenv('BOOT_BACKOFF_MAX_SECONDS', 5))
+
+DISPATCHER_ITERATIONS = METRICS.counter('ml_pipe_dispatcher_iterations_total', 'Times the dispatcher went round its loop')
+DISPATCH_ATTEMPTS = METRICS.counter('ml_pipe_dispatch_attempts_total', 'Jobs handed to the executor, by whether it took them', ('outcome',))
+OVERWATCH_TICKS = METRICS.counter('ml_pipe_overwatch_ticks_total', 'Times Overwatch looked over the workers')
+HANDOFF_SECONDS = METRICS.histogram('ml_pipe_handoff_seconds', 'Seconds Overwatch spent on one handoff to a worker', ('handoff',))
+DATA_TRANSFERS = METRICS.counter('ml_pipe_data_transfers_total', 'Datasets handed to trainers, by whether they read it from a shared directory or were sent it', ('method',))
+HANDOFF_RETRIES = METRICS.counter('ml_pipe_handoff_retries_total', 'Handoffs that failed and were backed off')
+
+
+def validate_job_spec(job_spec: any):
+    """ Checks the parts of a job spec the core reads itself are the right shape, raising
+    ValueError if not. Everything else is left for the trainer to check.
+    """
+    if not isinstance(job_spec, dict):
+        raise ValueError('A job spec must be an object')
+
+    model_definitions = job_spec.get('modelDefinitions') or []
+    if not isinstance(model_definitions, list) or not all(isinstance(model_definition, dict) for model_definition in model_definitions):
+        raise ValueError('modelDefinitions must be a list of objects')
+    for model_definition in model_definitions:
+        model_params = model_definition.get('modelParams') or {}
+        if not isinstance(model_params, dict):
+            raise ValueError('modelParams must be an object')
+        if not is_number(model_params.get('n_jobs') or 1):
+            raise ValueError(f'n_jobs must be a number, not {model_params["n_jobs"]!r}')
+
+    execution = job_spec.get('execution') or {}
+    if not isinstance(execution, dict):
+        raise ValueError('execution must be an object')
+    if not is_number(execution.get('maxWorkers') or 1):
+        raise ValueError(f'execution.maxWorkers must be a number, not {execution["maxWorkers"]!r}')
+    resources = execution.get('resources') or {}
+    if not isinstance(resources, dict) or not all(is_number(resources[key]) for key in ('cpus', 'memoryBytes') if key in resources):
+        raise ValueError('execution.resources must be an object with numeric cpus and memoryBytes')
+
+
+def is_number(value: any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class Job_Conflict_Error(ValueError):
+    """ A job was posted for a session that already has one, or is no longer waiting for one """
 
 
 class Job:
 
-    def __init__(self, session_token: str, job_spec: any):
+    def __init__(self, session_token: str, job_spec: any, priority: str | None = None, tenant: str | None = None):
+        if priority is not None and priority not in PRIORITY_CLASSES:
+            raise ValueError(f'Unknown priority {priority}, expected one of {PRIORITY_CLASSES}')
+
         self.session_token = session_token
         self.job_spec = job_spec
+        self.priority = priority or DEFAULT_PRIORITY
+
+        # Who the job is shared fairly on behalf of, the session itself unless a user is named
+        self.tenant = tenant or session_token
+        self.queued_at = None
 
 
 class Job_Manager:
-    def __init__(self, session_manager: Session_Manager):
+    def __init__(self, session_manager: Session_Manager, dataset_store: Dataset_Store):
         self.__session_manager = session_manager
-        self.__job_queue = Queue(JOB_QUEUE_SIZE)
+        self.__job_scheduler = Job_Scheduler()
 
-        # The port registry holds what ports we are allowed to give out and 
-        # if something is already holding it
-        MIN_PORT = int(getenv('MIN_PORT'))
-        MAX_PORT = int(getenv('MAX_PORT'))
+        # Checking a session is waiting for its job and handing it the job happen together
+        self.__queue_lock = threading.Lock()
 
-        # Port numbers are mapped to owning session tokens
-        self.__port_registry = {port_number : '' for port_number in range(MIN_PORT, MAX_PORT + 1)}
-        self.__dispatcher = Dispatcher(self.__job_queue, self.__session_manager, self.__port_registry).start()
-        self.__overwatch = Overwatch(self.__session_manager, self.__port_registry).start()
+        if EXECUTOR_BACKEND not in EXECUTOR_BACKENDS:
+            raise ValueError(f'Unknown EXECUTOR_BACKEND {EXECUTOR_BACKEND}, expected one of {EXECUTOR_BACKENDS}')
 
-    def __del__(self):
-        self.__job_queue.join()
+        if EXECUTOR_BACKEND == 'inprocess':
+            # Jobs are run straight away on local processes, there are no workers to supervise
+            self.__executor = In_Process_Executor(self.__session_manager, dataset_store, self.__job_scheduler.requeue)
+            self.__overwatch = None
+        else:
+            # Each node holds what ports we are allowed to give out on it and 
+            # what CPUs and memory the jobs placed on it have been given
+            self.__node_registry = load_node_registry(EXECUTOR_BACKEND)
+            self.__worker_pool = Worker_Pool(self.__node_registry)
+            self.__executor = Worker_Pool_Executor(self.__session_manager, self.__worker_pool, dataset_store)
+            self.__overwatch = Overwatch(self.__session_manager, self.__worker_pool, dataset_store)
+
+        # Sessions an earlier run of the core left in flight pick up where they were,
+        # before Overwatch starts any new workers on the ports of the old ones
+        self.__recover_sessions(dataset_store)
+
+        if self.__overwatch is not None:
+            self.__overwatch.start()
 
+        self.__dispatcher = Dispatcher(self.__job_scheduler, self.__executor)
+        self.__dispatcher.start()
+
+    def __del__(self):
         self.__dispatcher.stop()
         self.__dispatcher.join()
 
-        self.__overwatch.stop()
-        self.__overwatch.join()
+        if self.__overwatch is not None:
+            self.__overwatch.stop()
+            self.__overwatch.join()
+        else:
+            self.__executor.stop()
+
+    def queue_job(self, job: Job) -> bool:
+        return self.queue_jobs([job])
+
+    def queue_jobs(self, jobs: list[Job]) -> bool:
+        """ Queues all of the jobs, or none of them if the queue has no room for them all.
+        Never blocks, jobs for unknown sessions are dropped. Raises Job_Conflict_Error,
+        queueing none of them, if a session already has a job or a worker or is not in PENDING_JOB.
+        """
+        with self.__queue_lock:
+            jobs = [job for job in jobs if job.session_token in self.__session_manager.session_registry]
+            for job in jobs:
+                related_session: Session = self.__session_manager.session_registry[job.session_token]
+                if related_session.job is not None or related_session.worker_port is not None or related_session.status != Session_Status.PENDING_JOB:
+                    raise Job_Conflict_Error(f'Session {job.session_token} already has a job, it is {related_session.status.name}')
+
+            return self.__queue_jobs(jobs)
+
+    def __queue_jobs(self, jobs: list[Job]) -> bool:
+        if not self.__job_scheduler.try_put(jobs):
+            return False
+
+        # The job goes with the session from here on, so it is stored with it
+        for job in jobs:
+            related_session: Session = self.__session_manager.session_registry[job.session_token]
+            related_session.job = job
+            related_session.status = Session_Status.PENDING_AVAILABLE_TRAINER
+        return True
 
-    def queue_job(self, job: Job):
-        related_session: Session | None = self.__session_manager.session_registry.get(job.session_token)
-        if related_session is None: return 
-        related_session.status = Session_Status.PENDING_AVAILABLE_TRAINER
-        self.__job_queue.put(job)
+    def retry_after(self) -> int:
+        return self.__job_scheduler.retry_after()
+
+    def utilization(self) -> dict:
+        """ Per node (or the local process pool) its slots and how many are in use """
+        return self.__executor.utilization()
+
+    def queue_metrics(self) -> dict:
+        return self.__job_scheduler.metrics()
+
+    def __recover_sessions(self, dataset_store: Dataset_Store):
+        """ Workers still running a restored session are adopted and every other
+        worker left running is stopped. Sessions whose job was queued or whose worker
+        is gone are queued again, while a client driving its own session sees it go
+        back to waiting for a trainer and sends its data again once one is ready.
+        """
+        restored_jobs = self.__session_manager.take_restored_jobs()
+        for token, restored_job in restored_jobs.items():
+            related_session: Session | None = self.__session_manager.session_registry.get(token)
+            if related_session is not None:
+                related_session.job = Job(token, restored_job['job_spec'], restored_job['priority'], restored_job['tenant'])
+
+        adopted = set()
+        if self.__overwatch is not None:
+            leases = {}
+            for related_session in self.__session_manager.session_registry.values():
+                if related_session.worker_port is None or related_session.job is None: continue
+
+                dataset = dataset_store.get(related_session.dataset_digest) if related_session.dataset_digest is not None else None
+                resources = estimate_resources(related_session.job.job_spec, dataset.size if dataset is not None else 0)
+                leases[(related_session.worker_node, related_session.worker_port)] = (related_session.token, resources)
+            adopted = self.__worker_pool.reconcile(leases)
+
+        requeued = []
+        for related_session in list(self.__session_manager.session_registry.values()):
+            if related_session.token in adopted:
+                # The core was sending this dataset when it stopped, so it is sent again
+                if related_session.dataset_digest is not None and related_session.status == Session_Status.TRAINING:
+                    related_session.status = Session_Status.PENDING_DATA_TRANSFER
+                continue
+
+            had_worker = related_session.worker_port is not None
+            related_session.worker_node = None
+            related_session.worker_port = None
+            related_session.worker_url = None
+
+            if related_session.status in (Session_Status.FINISHED, Session_Status.KILLED, Session_Status.ERROR, Session_Status.COMPLETED):
+                if related_session.status == Session_Status.FINISHED and had_worker:
+                    related_session.status = Session_Status.KILLED
+                elif had_worker:
+                    self.__session_manager.save(related_session)
+            elif related_session.job is not None:
+                requeued.append(related_session.job)
+
+        # Oldest first, each on its own so one that doesn't fit doesn't hold back the rest.
+        # These sessions already hold their job, so they skip the checks made on a newly posted one
+        for job in sorted(requeued, key= lambda job: self.__session_manager.session_registry[job.session_token].status_changed_at):
+            if not self.__queue_jobs([job]):
+                print(f'No room to queue the job of restored session {job.session_token}')
+                self.__session_manager.session_registry[job.session_token].status = Session_Status.ERROR
+
+        if adopted or requeued:
+            print(f'Recovered {len(adopted)} sessions on running workers and queued {len(requeued)} again')
 
 
 class Dispatcher(threading.Thread):
 
-    def __init__(self, queue: Queue, session_manager: Session_Manager, port_registry: dict[int:bool], *args, **kwargs):
-        self.__queue = queue
-        self.__session_manager = session_manager
+    def __init__(self, job_scheduler: Job_Scheduler, executor: 'Worker_Pool_Executor | In_Process_Executor', *args, **kwargs):
+        self.__job_scheduler = job_scheduler
         self.__stop_event = threading.Event()
 
-        self.__docker_client = docker.from_env()
-
-        self.__port_registry = port_registry
+        # Anything with dispatch(job, timeout) -> bool that says whether it took the job,
+        # and fail(job) for a job whose dispatch raised
+        self.__executor = executor
 
         super().__init__(*args, **kwargs)
 
@@ -82,60 +265,115 @@ class Dispatcher(threading.Thread):
             if self.__stop_event.is_set():
                 break
 
-            try:
+            DISPATCHER_ITERATIONS.inc()
+            job: Job | None = self.__job_scheduler.get(timeout= 5)
+            if job is None:
+                continue
 
-                job: Job = self.__queue.get(block=True, timeout= 5)
-                
-                was_successful = self.__def_try_dispatch_job(job, self.__session_manager)
-                if not  was_successful:
-                    self.__queue.put_nowait(job)
-                self.__queue.task_done()
+            # Wait a while for the executor to take the job, this sleeps rather than spinning
+            # while the cluster is full. If it can't, the job goes back so anything more
+            # urgent queued in the meantime is dispatched first
+            try:
+                dispatched = self.__executor.dispatch(job, timeout= 5)
+            except Exception as e:
+                # A job that breaks its dispatch fails on its own instead of taking the dispatcher down with it
+                print(f'Could not dispatch the job: {e}\n\nToken: {job.session_token}')
+                DISPATCH_ATTEMPTS.inc(outcome= 'failed')
+                self.__executor.fail(job)
+                continue
+
+            if dispatched:
+                DISPATCH_ATTEMPTS.inc(outcome= 'dispatched')
+                self.__job_scheduler.mark_dispatched(job)
+            else:
+                DISPATCH_ATTEMPTS.inc(outcome= 'requeued')
+                self.__job_scheduler.requeue(job)
+
+
+class Worker_Pool_Executor:
+    """ Runs jobs on workers leased from the worker pool, Overwatch takes each job from there """
+
+    def __init__(self, session_manager: Session_Manager, worker_pool: Worker_Pool, dataset_store: Dataset_Store):
+        self.__session_manager = session_manager
+        self.__worker_pool = worker_pool
+        self.__dataset_store = dataset_store
 
-            except Empty:
-                pass
- 
-    def __def_try_dispatch_job(self, job: Job, session_manager: Session_Manager) -> bool: 
+    def dispatch(self, job: Job, timeout: float | None = None) -> bool:
+        related_session: Session =  self.__session_manager.session_registry[job.session_token]
 
-        # Identify a valid port we can raise this container at
-        valid_port = None
-        for port, mapped_token in self.__port_registry.items():
-            if not mapped_token:
-                valid_port = port
-                self.__port_registry[port] = job.session_token # Claim the port
+        # The job is placed on a node with room for what it is expected to need
+        dataset = self.__dataset_store.get(related_session.dataset_digest) if related_session.dataset_digest is not None else None
+        resources = estimate_resources(job.job_spec, dataset.size if dataset is not None else 0)
 
-        # If there are no valid ports we wont spin up a new container
-        # The job should be requeued
-        if valid_port is None: return False
+        worker = self.__worker_pool.lease(job.session_token, resources, timeout= timeout)
+        if worker is None:
+            return False
 
         # Update the session from the session registry such that overwatch can take over from here
-        related_session: Session =  session_manager.session_registry[job.session_token]
-        related_session.worker_port = valid_port
-        related_session.job = job
-        related_session.status = Session_Status.PENDING_HEALTHY_RESPONSE
-
-        # Start up a worker container
-        self.__docker_client.containers.run(
-            image= "machine-learning-pipeline-orchestrator-trainer:latest", 
-            command= ["fastapi", "dev", "./main.py", "--host", "0.0.0.0", "--port", "80"],
-            ports= {80:valid_port},
-            name= related_session.token,
-            detach= True
-        )
-
+        # A warm worker answers the health check straight away, a new one once it has booted
+        try:
+            related_session.worker_node = worker.node.name
+            related_session.worker_port = worker.port
+            related_session.worker_url = worker.public_url
+            related_session.job = job
+            related_session.status = Session_Status.PENDING_HEALTHY_RESPONSE
+        except Exception:
+            # The session never got the worker, so it is not left leased to it
+            self.__worker_pool.discard(worker)
+            raise
         return True
 
+    def fail(self, job: Job):
+        related_session: Session | None = self.__session_manager.session_registry.get(job.session_token)
+        if related_session is None: return
+
+        # Any worker it was given has been discarded, there is none for Overwatch to reset
+        related_session.worker_node = None
+        related_session.worker_port = None
+        related_session.worker_url = None
+        related_session.status = Session_Status.ERROR
+
+    def utilization(self) -> dict:
+        return self.__worker_pool.utilization()
+
 
 class Overwatch(threading.Thread):
+    """ Supervises the active workers. Every tick each worker that needs a
+    handoff is checked on a shared thread pool so one slow container does not
+    hold up the others, and a booting container is retried with exponential backoff.
+    """
+
+    # Statuses where Overwatch has to act on the worker, everything else is left alone
+    ACTIONABLE_STATUSES = (Session_Status.PENDING_HEALTHY_RESPONSE, Session_Status.PENDING_JOB, Session_Status.FINISHED, Session_Status.ERROR)
+
+    # Statuses where Overwatch also acts for sessions whose dataset is held by the core
+    CORE_TRANSFER_STATUSES = (Session_Status.PENDING_DATA_TRANSFER, Session_Status.PENDING_RESPONSE_FETCH)
+
+    # The handoff made to a worker in each status, as it is labelled in the metrics
+    HANDOFF_NAMES = {Session_Status.PENDING_HEALTHY_RESPONSE: 'init', Session_Status.PENDING_JOB: 'post_job',
+                     Session_Status.PENDING_DATA_TRANSFER: 'data_transfer', Session_Status.PENDING_RESPONSE_FETCH: 'result_fetch',
+                     Session_Status.FINISHED: 'reset', Session_Status.ERROR: 'reset'}
 
-    def __init__(self, session_manager: Session_Manager, port_registry: dict[int:bool], *args, **kwargs):
+    def __init__(self, session_manager: Session_Manager, worker_pool: Worker_Pool, dataset_store: Dataset_Store, *args, **kwargs):
         self.__session_manager = session_manager
+        self.__dataset_store = dataset_store
         self.__stop_event = threading.Event()
 
-        self.__ROOT_WORKER_URL = str(getenv('ROOT_WORKER_URL'))
+        self.__worker_pool = worker_pool
 
-        self.__port_registry = port_registry
+        # One pooled HTTP client shared by every handoff
+        self.__http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections= OVERWATCH_MAX_WORKERS, pool_maxsize= OVERWATCH_MAX_WORKERS)
+        self.__http.mount('http://', adapter)
+        self.__http.mount('https://', adapter)
 
-        self.__docker_client = docker.from_env()
+        self.__executor = ThreadPoolExecutor(max_workers= OVERWATCH_MAX_WORKERS, thread_name_prefix= 'overwatch')
+
+        # Session tokens with a handoff running on the executor and
+        # session tokens mapped to (next attempt time, current delay)
+        self.__in_flight: set[str] = set()
+        self.__backoff: dict[str:tuple[float, float]] = {}
+        self.__lock = threading.Lock()
 
         super().__init__(*args, **kwargs)
 
@@ -146,26 +384,99 @@ class Overwatch(threading.Thread):
     def run(self):
         while(True):
 
-            try:
-                # Stop when we are told
-                if self.__stop_event.is_set():
-                    print("---OVERWATCH STOPPING---")
-                    break
-                
-                # If not look for active workers to manage
-                for _, session_token in self.__port_registry.items():
-                    if session_token:
-                        self.__handel_active_worker(session_token)
+            # Stop when we are told
+            if self.__stop_event.is_set():
+                print("---OVERWATCH STOPPING---")
+                break
 
-            except Exception:
-                pass
-                    
+            OVERWATCH_TICKS.inc()
+            try:
+                # Keep the pool topped up and warm any containers that have just been started
+                self.__worker_pool.maintain()
+                for worker in self.__worker_pool.cold_idle_workers():
+                    self.__schedule(worker.name, 'warm_up', self.__warm_up_worker, worker)
 
-    def __handel_active_worker(self, session_token: str):
+                # If not look for active workers to manage
+                for worker in self.__worker_pool.leased_workers():
+                    self.__schedule_active_worker(worker)
+
+            except Exception as e:
+                print(f'---OVERWATCH ERROR--- {e}')
+
+            # Sleep until the next tick, waking straight away if we are stopped
+            self.__stop_event.wait(OVERWATCH_TICK_SECONDS)
+
+        self.__executor.shutdown(wait= True, cancel_futures= True)
+        self.__http.close()
+
+    def __schedule_active_worker(self, worker: Worker):
+        related_session: Session | None = self.__session_manager.session_registry.get(worker.session_token)
+        if related_session is None: return
+
+        is_core_transfer = related_session.dataset_digest is not None and related_session.status in self.CORE_TRANSFER_STATUSES
+        if related_session.status not in self.ACTIONABLE_STATUSES and not is_core_transfer: return
+
+        self.__schedule(related_session.token, self.HANDOFF_NAMES[related_session.status], self.__handel_active_worker, related_session.token, worker)
+
+    def __schedule(self, key: str, handoff_name: str, handoff, *args):
+        """ Runs the handoff on the executor, keyed by a session token or worker name """
+        with self.__lock:
+            # Only one handoff per key at a time, and not before its backoff is up
+            if key in self.__in_flight: return
+            next_attempt, _ = self.__backoff.get(key, (0, 0))
+            if monotonic() < next_attempt: return
+
+            self.__in_flight.add(key)
+
+        future = self.__executor.submit(self.__timed_handoff, handoff_name, handoff, *args)
+        future.add_done_callback(lambda future: self.__finish_handoff(key, future))
+
+    def __timed_handoff(self, handoff_name: str, handoff, *args):
+        started = monotonic()
+        try:
+            handoff(*args)
+        finally:
+            HANDOFF_SECONDS.observe(monotonic() - started, handoff= handoff_name)
+
+    def __finish_handoff(self, key: str, future):
+        with self.__lock:
+            self.__in_flight.discard(key)
+
+        if future.exception() is not None:
+            print(f'---OVERWATCH ERROR--- {future.exception()}\n\nKey: {key}')
+
+    def __back_off(self, key: str):
+        """ Pushes the next attempt for this key out, doubling the delay each time """
+        HANDOFF_RETRIES.inc()
+        with self.__lock:
+            _, delay = self.__backoff.get(key, (0, 0))
+            delay = min(max(delay * 2, BOOT_BACKOFF_INITIAL_SECONDS), BOOT_BACKOFF_MAX_SECONDS)
+            self.__backoff[key] = (monotonic() + delay, delay)
+
+    def __reset_backoff(self, key: str):
+        with self.__lock:
+            self.__backoff.pop(key, None)
+
+    def __warm_up_worker(self, worker: Worker):
+        """ Asks a freshly started container to import its training libraries so the first job doesn't pay for it """
+        warm_up_url = f'{worker.url}/api/warmup/'
+        response = None
+        try:
+            response = self.__http.post(warm_up_url, timeout= WORKER_REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException:
+            pass # Still booting
+
+        if response and response.status_code == 200:
+            self.__reset_backoff(worker.name)
+            self.__worker_pool.mark_warm(worker)
+        else:
+            self.__back_off(worker.name)
+
+    def __handel_active_worker(self, session_token: str, worker: Worker):
         
         related_session: Session = self.__session_manager.session_registry[session_token]
         
-        worker_url = f'{self.__ROOT_WORKER_URL}:{related_session.worker_port}/api'
+        worker_url = f'{worker.url}/api'
 
         match related_session.status:
             case Session_Status.PENDING_AVAILABLE_TRAINER:
@@ -175,45 +486,142 @@ class Overwatch(threading.Thread):
                 init_url = worker_url + '/init/'
                 response = None
                 try:
-                    response = requests.post(init_url, json={'session_token': related_session.token})
+                    response = self.__http.post(init_url, json={'session_token': related_session.token}, timeout= WORKER_REQUEST_TIMEOUT)
                 except requests.exceptions.RequestException as e:  # This is the correct syntax
                     print(f'{e}\n\nPort: {related_session.worker_port} Token: {related_session.token}')
 
                 if response and response.status_code == 200:
+                    self.__reset_backoff(related_session.token)
                     related_session.status = Session_Status.PENDING_JOB
+                else:
+                    self.__back_off(related_session.token)
                 
             case Session_Status.PENDING_JOB:
                 post_job_url = worker_url + '/postJob/'
 
                 response = None
                 try:
-                    response = requests.post(post_job_url, json=related_session.job.job_spec)
+                    response = self.__http.post(post_job_url, json=related_session.job.job_spec, timeout= WORKER_REQUEST_TIMEOUT)
                 except requests.exceptions.RequestException as e:  # This is the correct syntax
                     print(f'{e}\n\nPort: {related_session.worker_port} Token: {related_session.token}')
                 
 
                 if response and response.status_code == 200:
+                    self.__reset_backoff(related_session.token)
                     related_session.status = Session_Status.PENDING_DATA_TRANSFER
+                elif response is not None and response.status_code == JOB_REFUSED_CODE:
+                    # The trainer can't run this job spec, sending it again won't change that
+                    print(f'The job was refused: {response.text}\n\nToken: {related_session.token}')
+                    self.__reset_backoff(related_session.token)
+                    related_session.status = Session_Status.ERROR
+                else:
+                    self.__back_off(related_session.token)
                 
             case Session_Status.PENDING_DATA_TRANSFER:
-                pass
+                # Only reached for sessions whose dataset the core holds, otherwise the client sends it
+                self.__transfer_dataset(related_session, worker_url)
             case Session_Status.TRAINING:
                 pass
             case Session_Status.PENDING_RESPONSE_FETCH:
-                pass
-            case Session_Status.FINISHED:
+                # Only reached for sessions whose dataset the core holds, otherwise the client fetches them
+                self.__fetch_results(related_session, worker_url)
+            case Session_Status.FINISHED | Session_Status.ERROR:
 
-                self.__docker_client.containers.get(related_session.token).kill()
+                # Reset the worker and hand it back to the pool, if it won't reset we kill it
+                reset_url = worker_url + '/reset/'
 
-                # free port
-                self.__port_registry[related_session.worker_port] = ''
+                response = None
+                try:
+                    response = self.__http.post(reset_url, timeout= WORKER_REQUEST_TIMEOUT)
+                except requests.exceptions.RequestException as e:
+                    print(f'{e}\n\nPort: {related_session.worker_port} Token: {related_session.token}')
+
+                self.__reset_backoff(related_session.token)
+
+                # Freeing the worker wakes the dispatcher if it is waiting on one
+                if response and response.status_code == 200:
+                    self.__worker_pool.release(worker)
+                else:
+                    self.__worker_pool.discard(worker)
+                related_session.worker_node = None
                 related_session.worker_port = None
+                related_session.worker_url = None
 
-                related_session.status = Session_Status.KILLED
+                if related_session.status == Session_Status.FINISHED:
+                    related_session.status = Session_Status.KILLED
+                else:
+                    self.__session_manager.save(related_session)
             case Session_Status.KILLED:
                 pass
             case _:
                 raise NotImplementedError('related_session.status found in Overwatch__handel_active_worker')
 
-
-
+    def __transfer_dataset(self, related_session: Session, worker_url: str):
+        dataset = self.__dataset_store.get(related_session.dataset_digest)
+        if dataset is None:
+            print(f'Dataset {related_session.dataset_digest} missing for Token: {related_session.token}')
+            related_session.status = Session_Status.ERROR
+            return
+
+        # The trainer answers once it has the dataset, then reports how the training went to us itself
+        related_session.status = Session_Status.TRAINING
+
+        # A trainer that sees our dataset directory reads the dataset in place, otherwise we send it the bytes
+        response = None
+        try:
+            response = self.__http.post(worker_url + '/postDataPath/', json= {'dataset': dataset.digest, 'content_type': dataset.content_type, 'file_name': dataset.file_name},
+                                        timeout= WORKER_REQUEST_TIMEOUT)
+        except requests.exceptions.ConnectionError as e:
+            print(f'{e}\n\nPort: {related_session.worker_port} Token: {related_session.token}')
+            related_session.status = Session_Status.PENDING_DATA_TRANSFER
+            self.__back_off(related_session.token)
+            return
+        except requests.exceptions.RequestException as e:
+            print(f'{e}\n\nPort: {related_session.worker_port} Token: {related_session.token}')
+
+        if response is not None and response.status_code == 200:
+            DATA_TRANSFERS.inc(method= 'shared_path')
+            return
+        if response is not None and response.status_code not in SHARED_PATH_UNAVAILABLE_CODES:
+            related_session.status = Session_Status.ERROR
+            return
+
+        response = None
+        try:
+            with open(dataset.path, 'rb') as dataset_file:
+                response = self.__http.post(worker_url + '/postDataFile/', data= dataset_file,
+                                            headers= {'content-type': dataset.content_type or 'application/octet-stream'},
+                                            timeout= DATA_TRANSFER_TIMEOUT)
+        except requests.exceptions.ConnectionError as e:
+            # The data never got there, try again later
+            print(f'{e}\n\nPort: {related_session.worker_port} Token: {related_session.token}')
+            related_session.status = Session_Status.PENDING_DATA_TRANSFER
+            self.__back_off(related_session.token)
+            return
+        except requests.exceptions.RequestException as e:
+            print(f'{e}\n\nPort: {related_session.worker_port} Token: {related_session.token}')
+
+        if response is None or response.status_code != 200:
+            related_session.status = Session_Status.ERROR
+        else:
+            DATA_TRANSFERS.inc(method= 'upload')
+
+    def __fetch_results(self, related_session: Session, worker_url: str):
+        # The trainer is not asked to report itself terminated, we finish the session ourselves once
+        # the results are in it, so a client never sees it FINISHED without them
+        response = None
+        try:
+            response = self.__http.get(worker_url + '/getResults', params= {'release': 'false'}, timeout= WORKER_REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            print(f'{e}\n\nPort: {related_session.worker_port} Token: {related_session.token}')
+
+        if response and response.status_code == 200:
+            # The trainer returns its results already serialized as JSON
+            results = response.json()
+            related_session.results = json.loads(results) if isinstance(results, str) else results
+            self.__reset_backoff(related_session.token)
+
+            # The transition writes the session, results included, through to the store
+            related_session.status = Session_Status.FINISHED
+        else:
+            self.__back_off(related_session.token)
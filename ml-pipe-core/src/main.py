@@ -1,18 +1,43 @@
 from fastapi import FastAPI
 from fastapi import FastAPI, Request, status
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from session import Session_Manager
-from jobs import Job, Job_Manager
+from session import Session_Manager, Session_Status
+from session_store import Session_Store
+from datasets import Dataset, Dataset_Store, Upload_Offset_Error, UPLOAD_ENCODINGS, supports_encoding
+from batches import Batch_Manager
+import asyncio
+from jobs import Job, Job_Conflict_Error, Job_Manager, validate_job_spec
+from metrics import METRICS, PROMETHEUS_CONTENT_TYPE
 
 
 app = FastAPI()
-SESSION_MANAGER = Session_Manager()
-JOB_MANAGER = Job_Manager(SESSION_MANAGER)
+SESSION_STORE = Session_Store()
+SESSION_MANAGER = Session_Manager(SESSION_STORE)
+DATASET_STORE = Dataset_Store()
+JOB_MANAGER = Job_Manager(SESSION_MANAGER, DATASET_STORE)
+BATCH_MANAGER = Batch_Manager(SESSION_MANAGER, JOB_MANAGER, SESSION_STORE)
+
+def utilization_gauge(field: str):
+    return lambda: {(node,): values[field] for node, values in JOB_MANAGER.utilization().items() if field in values}
+
+def queue_depth() -> dict:
+    return {(priority,): depth for priority, depth in JOB_MANAGER.queue_metrics()['depth_by_priority'].items()}
+
+METRICS.gauge('ml_pipe_sessions', 'Sessions in each status', ('status',), SESSION_MANAGER.count_by_status)
+METRICS.gauge('ml_pipe_queue_depth', 'Jobs waiting in the queue by priority class', ('priority',), queue_depth)
+METRICS.gauge('ml_pipe_slots', 'Ports (or processes) jobs can run on', ('node',), utilization_gauge('slots'))
+METRICS.gauge('ml_pipe_slots_used', 'Ports (or processes) held by a worker', ('node',), utilization_gauge('slots_used'))
+METRICS.gauge('ml_pipe_workers_leased', 'Workers running a job', ('node',), utilization_gauge('leased'))
+METRICS.gauge('ml_pipe_workers_idle', 'Workers waiting for a job', ('node',), utilization_gauge('idle'))
+METRICS.gauge('ml_pipe_node_cpus_allocated', 'CPUs given to the jobs on a node', ('node',), utilization_gauge('cpus_allocated'))
+METRICS.gauge('ml_pipe_node_memory_bytes_allocated', 'Memory given to the jobs on a node', ('node',), utilization_gauge('memory_bytes_allocated'))
+
+@app.get("/metrics")
+async def metrics():
+    return Response(METRICS.render(), media_type= PROMETHEUS_CONTENT_TYPE)
 
-import docker
-docker.from_env()
 @app.get("/api")
 async def root():
     return {"message": "I am core"}
@@ -27,9 +52,120 @@ async def post_job(request: Request):
     request_json = await request.json()
     token = request_json['session_token']
     job_spec = request_json['job_spec']
-    job = Job(token, job_spec)
+
+    # Optional priority class, and the user whose fair share of the queue the job comes out of
+    try:
+        validate_job_spec(job_spec)
+        job = Job(token, job_spec, request_json.get('priority'), request_json.get('user'))
+    except ValueError as e:
+        return JSONResponse(content={'detail': str(e)}, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
     print(job)
-    JOB_MANAGER.queue_job(job)
+
+    # A session runs one job, posting it again once it has been queued is refused
+    try:
+        queued = JOB_MANAGER.queue_job(job)
+    except Job_Conflict_Error as e:
+        return JSONResponse(content={'detail': str(e)}, status_code=status.HTTP_409_CONFLICT)
+    if not queued:
+        return queue_full_response()
+
+@app.post('/api/postdataset/')
+async def post_dataset(request: Request):
+    # The raw request body is the dataset, its content type tells the trainer how to read it
+    dataset = await DATASET_STORE.put_stream(request.stream(), request.headers.get('content-type'), request.headers.get('x-file-name'))
+    return {"dataset": dataset.digest, "size": dataset.size}
+
+@app.post('/api/uploads/')
+async def start_upload(request: Request):
+    # Sent straight after fetchtoken, so the dataset reaches us while the job waits for and boots its trainer.
+    # A client naming the sha256 of a dataset we already hold does not upload it again
+    request_json = await request.json()
+    token = request_json.get('session_token')
+    upload = DATASET_STORE.start_upload(request_json.get('content_type'), request_json.get('file_name'), request_json.get('digest'), token)
+
+    if isinstance(upload, Dataset):
+        return attach_dataset(token, upload)
+    return {"upload_id": upload.upload_id, "offset": upload.offset, "complete": False}
+
+@app.get('/api/uploads/{upload_id}')
+async def get_upload(upload_id: str):
+    # Where a client resumes an upload that was cut off
+    upload = DATASET_STORE.get_upload(upload_id)
+    if upload is None:
+        return JSONResponse(content={'detail': 'No such upload'}, status_code=status.HTTP_404_NOT_FOUND)
+    return {"upload_id": upload.upload_id, "offset": upload.offset, "complete": False}
+
+@app.put('/api/uploads/{upload_id}')
+async def put_upload_chunk(upload_id: str, offset: int, request: Request):
+    # The body is the chunk of the dataset starting at offset, compressed on its own if it has a content encoding
+    upload = DATASET_STORE.get_upload(upload_id)
+    if upload is None:
+        return JSONResponse(content={'detail': 'No such upload'}, status_code=status.HTTP_404_NOT_FOUND)
+    if not supports_encoding(request.headers.get('content-encoding')):
+        return JSONResponse(content={'detail': f"Chunks can be sent with the content encodings {UPLOAD_ENCODINGS}, zstd needs zstandard installed on the core"},
+                            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    try:
+        new_offset = await DATASET_STORE.append_chunk(upload, offset, request.stream(), request.headers.get('content-encoding'))
+    except Upload_Offset_Error as e:
+        return JSONResponse(content={'detail': str(e), 'offset': e.offset}, status_code=status.HTTP_409_CONFLICT)
+    except ValueError as e:
+        # The chunk was cut off or corrupted, it is sent again from the same offset
+        return JSONResponse(content={'detail': str(e), 'offset': upload.offset}, status_code=status.HTTP_400_BAD_REQUEST)
+    return {"upload_id": upload_id, "offset": new_offset, "complete": False}
+
+@app.post('/api/uploads/{upload_id}/complete')
+async def complete_upload(upload_id: str):
+    upload = DATASET_STORE.get_upload(upload_id)
+    if upload is None:
+        return JSONResponse(content={'detail': 'No such upload'}, status_code=status.HTTP_404_NOT_FOUND)
+
+    try:
+        dataset = DATASET_STORE.finish_upload(upload)
+    except Upload_Offset_Error as e:
+        return JSONResponse(content={'detail': str(e), 'offset': e.offset}, status_code=status.HTTP_409_CONFLICT)
+    except ValueError as e:
+        return JSONResponse(content={'detail': str(e)}, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    return attach_dataset(upload.session_token, dataset)
+
+def attach_dataset(token: str | None, dataset: Dataset) -> dict:
+    # With the dataset attached the core hands it to the trainer and fetches the results itself
+    attached = token is not None and SESSION_MANAGER.attach_dataset(token, dataset.digest)
+    return {"dataset": dataset.digest, "size": dataset.size, "complete": True, "attached": attached}
+
+@app.post('/api/postbatch/')
+async def post_batch(request: Request):
+    # One stored dataset and many job specs, each job spec runs as its own session
+    request_json = await request.json()
+    dataset = DATASET_STORE.get(request_json['dataset'])
+    if dataset is None:
+        return JSONResponse(content={'batch_id': None}, status_code=status.HTTP_404_NOT_FOUND)
+
+    try:
+        batch_id = BATCH_MANAGER.new_batch(dataset.digest, request_json['job_specs'], request_json.get('priority'), request_json.get('user'))
+    except ValueError as e:
+        return JSONResponse(content={'detail': str(e)}, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    if batch_id is None:
+        return queue_full_response()
+    return {"batch_id": batch_id}
+
+def queue_full_response() -> JSONResponse:
+    # The queue never blocks the event loop, the client is told when to come back instead
+    return JSONResponse(content={'detail': 'The job queue is full'}, status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                        headers={'Retry-After': str(JOB_MANAGER.retry_after())})
+
+@app.get("/api/queuemetrics/")
+async def queue_metrics():
+    return JOB_MANAGER.queue_metrics()
+
+@app.get("/api/batchstatus/")
+async def batch_status(batch_id: str):
+    return {"progress": BATCH_MANAGER.get_progress(batch_id)}
+
+@app.get("/api/batchresults/")
+async def batch_results(batch_id: str):
+    return {"results": BATCH_MANAGER.get_results(batch_id)}
 
 @app.get("/api/pollstatus/")
 async def poll_status(token: str):
@@ -37,10 +173,57 @@ async def poll_status(token: str):
     return {"status": status}
 
 
+# Once a session reaches one of these there is nothing left to stream
+TERMINAL_STATUSES = (Session_Status.FINISHED, Session_Status.KILLED, Session_Status.ERROR)
+STATUS_STREAM_KEEPALIVE_SECONDS = 15
+STATUS_STREAM_EXPIRED = 'EXPIRED'
+
+@app.get("/api/statusstream/")
+async def status_stream(token: str):
+    # Server sent events version of pollstatus, pushes each status transition as it happens
+    subscription = SESSION_MANAGER.subscribe(token)
+    if subscription is None:
+        return JSONResponse(content={'status': None}, status_code=status.HTTP_404_NOT_FOUND)
+
+    async def event_stream():
+        try:
+            while True:
+                try:
+                    session_status = await asyncio.wait_for(subscription.get(), STATUS_STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if token in SESSION_MANAGER.session_registry:
+                        yield ': keep-alive\n\n'
+                        continue
+                    session_status = None
+
+                # The session was evicted or deleted, the stream ends with a last event saying so
+                if session_status is None:
+                    yield f'data: {STATUS_STREAM_EXPIRED}\n\n'
+                    break
+
+                yield f'data: {session_status.name}\n\n'
+                if session_status in TERMINAL_STATUSES:
+                    break
+        finally:
+            SESSION_MANAGER.unsubscribe(token, subscription)
+
+    return StreamingResponse(event_stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@app.get("/api/getresults/")
+async def get_results(token: str):
+    # Results of a session whose dataset the core held, fetched from its trainer by the core
+    session = SESSION_MANAGER.session_registry.get(token)
+    if session is None:
+        return JSONResponse(content={'results': None}, status_code=status.HTTP_404_NOT_FOUND)
+    return {"status": session.status.name, "results": session.results}
+
+
 @app.get("/api/getworkerport/")
 async def get_worker_port(token: str):
     worker_port = SESSION_MANAGER.get_worker_port(token)
-    return {"workerPort": worker_port}
+    session = SESSION_MANAGER.session_registry.get(token)
+    return {"workerPort": worker_port, "workerUrl": session.worker_url if session is not None else None}
 
 
 @app.post('/api/postterminating/')
@@ -52,6 +235,15 @@ async def post_terminating(request: Request):
     SESSION_MANAGER.report_terminated(token)
 
 
+@app.post('/api/postfailedtraining/')
+async def post_failedtraining(request: Request):
+    request_json = await request.json()
+    token = request_json['session_token']
+    print(f'----DOCKER reports failed Session: {token}-----')
+
+    SESSION_MANAGER.report_failed_training(token)
+
+
 @app.post('/api/postfinishedtraining/')
 async def post_finishedtraining(request: Request):
     request_json = await request.json()
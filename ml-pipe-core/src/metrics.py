@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+""" This file contains the datastructures
+for metrics exposed in the Prometheus text format
+ """
+#----------------------------------
+#
+#
+#Imports
+import threading
+from bisect import bisect_left
+from math import inf
+
+# Upper bounds in seconds, from a quick handoff up to a long training run
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, inf)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    """ A named value per set of label values. It is either recorded as things happen, or
+    read from a function each time the metrics are rendered, which with labels returns the
+    label values mapped to each value.
+    """
+    TYPE = None
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), function = None):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.__function = function
+
+        # Label values mapped to the value held for them
+        self._values: dict[tuple:any] = {}
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.TYPE}']
+        for label_values, value in self._snapshot().items():
+            lines.append(f'{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}')
+        return lines
+
+    def _snapshot(self) -> dict:
+        if self.__function is not None:
+            values = self.__function()
+            return values if self.label_names else {(): values}
+
+        with self._lock:
+            return dict(self._values)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            # Per bucket counts, then the sum and count of every observation
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            counts[bucket] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.TYPE}']
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+
+        for label_values, counts in values.items():
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = format_labels(self.label_names + ('le',), label_values + (format_value(upper_bound),))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {format_value(counts[-2])}')
+            lines.append(f'{self.name}_count{labels} {counts[-1]}')
+        return lines
+
+
+class Metrics_Registry:
+    def __init__(self):
+        self.__metrics: list[Metric] = []
+
+    def counter(self, name: str, description: str, label_names: tuple = (), function = None) -> Counter:
+        return self.__register(Counter(name, description, label_names, function))
+
+    def gauge(self, name: str, description: str, label_names: tuple = (), function = None) -> Gauge:
+        return self.__register(Gauge(name, description, label_names, function))
+
+    def histogram(self, name: str, description: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.__register(Histogram(name, description, label_names, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.__metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def __register(self, metric: Metric) -> Metric:
+        self.__metrics.append(metric)
+        return metric
+
+
+def format_labels(label_names: tuple, label_values: tuple) -> str:
+    if not label_names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in label_values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(label_names, escaped)) + '}'
+
+
+def format_value(value: float) -> str:
+    if value == inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# The metrics of this core, every module adds its own
+METRICS = Metrics_Registry()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+""" This file contains the logic and datastructures
+for the nodes workers are placed on
+ """
+#----------------------------------
+#
+#
+#Imports
+import json
+import os
+import threading
+from os import getenv
+from workers import Port_Allocator, Resources, Worker_Backend, Docker_Backend, Subprocess_Backend, POOL_MIN_IDLE
+
+# JSON file listing the nodes, without it the core runs one node on this host from
+# ROOT_WORKER_URL, MIN_PORT and MAX_PORT. Each node looks like
+#   {"name": "gpu-1", "url": "http://10.0.0.2", "publicUrl": "http://gpu-1.example.org",
+#    "cpus": 32, "memoryBytes": 137438953472, "minPort": 8001, "maxPort": 8032,
+#    "backend": "docker", "dockerUrl": "tcp://10.0.0.2:2375", "minIdle": 1}
+NODES_FILE = getenv('NODES_FILE') or None
+
+# 'leastloaded' spreads jobs over the nodes, 'binpack' fills the busiest node that still fits first
+PLACEMENT_POLICY = getenv('PLACEMENT_POLICY', 'leastloaded')
+PLACEMENT_POLICIES = ('leastloaded', 'binpack')
+
+# Memory a job is expected to need, a base for the trainer plus a multiple of its dataset
+TRAINER_BASE_MEMORY_BYTES = int(getenv('TRAINER_BASE_MEMORY_BYTES', 512 * 1024 * 1024))
+DATASET_MEMORY_FACTOR = float(getenv('DATASET_MEMORY_FACTOR', 4))
+
+
+def estimate_resources(job_spec: dict, dataset_size: int = 0) -> Resources:
+    """ Works out what a job needs from its spec. CPUs are the widest n_jobs of its
+    models, times the models trained at once in parallel mode, n_jobs=-1 asking for a
+    whole node. Memory is a multiple of the dataset size when the core knows it.
+    execution: {'resources': {'cpus', 'memoryBytes'}} overrides either estimate.
+    """
+    execution = job_spec.get('execution') or {}
+    model_definitions = job_spec.get('modelDefinitions') or []
+
+    widest_model = 1
+    for model_definition in model_definitions:
+        n_jobs = (model_definition.get('modelParams') or {}).get('n_jobs') or 1
+        widest_model = max(widest_model, float('inf') if n_jobs < 0 else n_jobs)
+
+    models_at_once = 1
+    if execution.get('mode') == 'parallel':
+        models_at_once = max(1, min(execution.get('maxWorkers') or len(model_definitions), len(model_definitions)))
+
+    hints = execution.get('resources') or {}
+    cpus = float(hints.get('cpus', widest_model * models_at_once))
+    memory_bytes = int(hints.get('memoryBytes', TRAINER_BASE_MEMORY_BYTES + DATASET_MEMORY_FACTOR * dataset_size))
+
+    return Resources(cpus, memory_bytes)
+
+
+class Node:
+    """ A host workers run on, with the CPUs and memory jobs placed on it have been given """
+
+    def __init__(self, name: str, url: str, cpus: float, memory_bytes: int, min_port: int, max_port: int,
+                 backend: Worker_Backend, public_url: str | None = None, min_idle: int = POOL_MIN_IDLE):
+        self.name = name
+        self.url = url
+        self.public_url = public_url
+        self.capacity = Resources(cpus, memory_bytes)
+        self.allocated = Resources(0, 0)
+        self.port_allocator = Port_Allocator(min_port, max_port)
+        self.backend = backend
+        self.min_idle = min_idle
+
+        self.__lock = threading.Lock()
+
+    @property
+    def worker_count(self) -> int:
+        # Every worker holds one of the nodes ports
+        return len(self.port_allocator.claimed_ports())
+
+    def fit(self, resources: Resources) -> Resources:
+        """ The resources clamped to the node, a job bigger than a node gets the whole node """
+        return Resources(min(resources.cpus, self.capacity.cpus), min(resources.memory_bytes, self.capacity.memory_bytes))
+
+    def can_fit(self, resources: Resources) -> bool:
+        fitted = self.fit(resources)
+        with self.__lock:
+            return (self.allocated.cpus + fitted.cpus <= self.capacity.cpus
+                    and self.allocated.memory_bytes + fitted.memory_bytes <= self.capacity.memory_bytes)
+
+    def load(self) -> float:
+        """ The larger of the shares of CPUs and memory given out """
+        with self.__lock:
+            return max(self.allocated.cpus / self.capacity.cpus, self.allocated.memory_bytes / self.capacity.memory_bytes)
+
+    def reserve(self, resources: Resources) -> Resources:
+        fitted = self.fit(resources)
+        with self.__lock:
+            self.allocated = Resources(self.allocated.cpus + fitted.cpus, self.allocated.memory_bytes + fitted.memory_bytes)
+        return fitted
+
+    def free(self, resources: Resources):
+        with self.__lock:
+            self.allocated = Resources(max(0, self.allocated.cpus - resources.cpus), max(0, self.allocated.memory_bytes - resources.memory_bytes))
+
+
+class Node_Registry:
+    def __init__(self, nodes: list[Node], placement_policy: str = PLACEMENT_POLICY):
+        if placement_policy not in PLACEMENT_POLICIES:
+            raise ValueError(f'Unknown PLACEMENT_POLICY {placement_policy}, expected one of {PLACEMENT_POLICIES}')
+        if len({node.name for node in nodes}) != len(nodes):
+            raise ValueError('Node names must be unique')
+
+        self.nodes = nodes
+        self.placement_policy = placement_policy
+
+    def place(self, resources: Resources, candidates: list[Node]) -> Node | None:
+        """ Picks the node for a job among the candidates with room for it, None if none has room """
+        fitting = [node for node in candidates if node.can_fit(resources)]
+        if not fitting:
+            return None
+
+        if self.placement_policy == 'binpack':
+            # The busiest node that still fits, leaving the others free for big jobs
+            return max(fitting, key= lambda node: node.load())
+        return min(fitting, key= lambda node: node.load())
+
+
+def load_node_registry(default_backend: str) -> Node_Registry:
+    """ Builds the node registry from NODES_FILE, or a single node on this host
+
+    Args:
+        default_backend (str): 'docker' or 'subprocess', for nodes that don't name their backend
+    """
+    if NODES_FILE is None:
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+        memory_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        node_configs = [{'name': 'local', 'url': str(getenv('ROOT_WORKER_URL')), 'cpus': cpus, 'memoryBytes': memory_bytes,
+                         'minPort': int(getenv('MIN_PORT')), 'maxPort': int(getenv('MAX_PORT'))}]
+    else:
+        with open(NODES_FILE) as file:
+            node_configs = json.load(file)
+
+    nodes = []
+    for node_config in node_configs:
+        backend_name = node_config.get('backend', default_backend)
+        if backend_name == 'subprocess':
+            backend = Subprocess_Backend()
+        elif backend_name == 'docker':
+            backend = Docker_Backend(node_config.get('dockerUrl'))
+        else:
+            raise ValueError(f'Unknown backend {backend_name} for node {node_config["name"]}')
+
+        nodes.append(Node(node_config['name'], node_config['url'], float(node_config['cpus']), int(node_config['memoryBytes']),
+                          int(node_config['minPort']), int(node_config['maxPort']), backend,
+                          public_url= node_config.get('publicUrl'), min_idle= int(node_config.get('minIdle', POOL_MIN_IDLE))))
+
+    return Node_Registry(nodes)
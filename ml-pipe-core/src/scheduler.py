@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+""" This file contains the logic and datastructures
+for scheduling queued jobs fairly between users
+ """
+#----------------------------------
+#
+#
+#Imports
+import json
+import threading
+from collections import OrderedDict, deque
+from os import getenv
+from time import monotonic
+
+JOB_QUEUE_SIZE = int(getenv('JOB_QUEUE_SIZE', 200))
+
+# Most jobs one tenant may have queued at once, 0 means no limit besides the queue size
+TENANT_QUEUE_LIMIT = int(getenv('TENANT_QUEUE_LIMIT', 0))
+
+# Tenants mapped to their share of the dispatches within a priority class, everyone else has a weight of 1
+TENANT_WEIGHTS: dict[str:float] = json.loads(getenv('TENANT_WEIGHTS') or '{}')
+MIN_TENANT_WEIGHT = 0.01
+
+# Priority classes, the first is always dispatched before the ones after it
+PRIORITY_CLASSES = ('high', 'normal', 'low')
+DEFAULT_PRIORITY = 'normal'
+
+# How many recent waits the wait time metrics are taken over, and the Retry-After given before there are any
+WAIT_TIME_WINDOW = 1000
+DEFAULT_RETRY_AFTER_SECONDS = 5
+
+
+class Job_Scheduler:
+    """ Queue of jobs waiting for an executor. Priority classes are served strictly
+    in order, and within a class the tenants (users, or sessions that don't name one)
+    take turns by deficit round robin so one tenant queueing many jobs can't starve
+    the others. Admission never blocks, a job is refused once the queue is full.
+    """
+
+    def __init__(self, max_size: int = JOB_QUEUE_SIZE, tenant_limit: int = TENANT_QUEUE_LIMIT, tenant_weights: dict = TENANT_WEIGHTS):
+        self.__max_size = max_size
+        self.__tenant_limit = tenant_limit
+        self.__tenant_weights = tenant_weights
+
+        # Per priority class the tenants with jobs queued, in the order they take turns,
+        # each mapped to their jobs. (priority, tenant) mapped to the unspent share of their turn
+        self.__classes: dict[str:OrderedDict[str:deque]] = {priority: OrderedDict() for priority in PRIORITY_CLASSES}
+        self.__deficits: dict[tuple[str, str]:float] = {}
+        self.__size = 0
+        self.__tenant_sizes: dict[str:int] = {}
+        self.__condition = threading.Condition()
+
+        # Recent waits from admission to dispatch, and totals since start up
+        self.__waits: deque[float] = deque(maxlen= WAIT_TIME_WINDOW)
+        self.__admitted = 0
+        self.__rejected = 0
+        self.__dispatched = 0
+
+    def try_put(self, jobs: list) -> bool:
+        """ Admits all of the jobs or, if there isn't room for all of them, none """
+        with self.__condition:
+            tenant_counts = {}
+            for job in jobs:
+                tenant_counts[job.tenant] = tenant_counts.get(job.tenant, 0) + 1
+
+            has_room = self.__size + len(jobs) <= self.__max_size
+            if self.__tenant_limit > 0:
+                has_room = has_room and all(self.__tenant_sizes.get(tenant, 0) + count <= self.__tenant_limit for tenant, count in tenant_counts.items())
+            if not has_room:
+                self.__rejected += len(jobs)
+                return False
+
+            now = monotonic()
+            for job in jobs:
+                job.queued_at = now
+                self.__append(job)
+            self.__admitted += len(jobs)
+            self.__condition.notify(len(jobs))
+            return True
+
+    def get(self, timeout: float | None = None):
+        """ Takes the next job to dispatch, waiting up to timeout seconds for one. Returns None if none came. """
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: self.__size > 0, timeout):
+                return None
+
+            for priority in PRIORITY_CLASSES:
+                if self.__classes[priority]:
+                    return self.__take(priority)
+
+    def requeue(self, job):
+        """ Puts a job the dispatcher could not place back at the front of its tenants
+        queue, so it is reconsidered against anything more urgent queued since
+        """
+        with self.__condition:
+            tenants = self.__classes[job.priority]
+            is_new_tenant = job.tenant not in tenants
+            tenants.setdefault(job.tenant, deque()).appendleft(job)
+            if is_new_tenant:
+                tenants.move_to_end(job.tenant, last= False)
+            self.__deficits[(job.priority, job.tenant)] = self.__deficits.get((job.priority, job.tenant), 0) + 1
+            self.__count(job.tenant, 1)
+            self.__condition.notify()
+
+    def mark_dispatched(self, job):
+        with self.__condition:
+            self.__dispatched += 1
+            self.__waits.append(monotonic() - job.queued_at)
+
+    def retry_after(self) -> int:
+        """ Seconds a refused client should wait before trying again, the recent average wait """
+        with self.__condition:
+            if not self.__waits:
+                return DEFAULT_RETRY_AFTER_SECONDS
+            return max(1, round(sum(self.__waits) / len(self.__waits)))
+
+    def metrics(self) -> dict:
+        with self.__condition:
+            waits = sorted(self.__waits)
+            return {'depth': self.__size,
+                    'capacity': self.__max_size,
+                    'depth_by_priority': {priority: sum(len(jobs) for jobs in tenants.values()) for priority, tenants in self.__classes.items()},
+                    'depth_by_tenant': dict(self.__tenant_sizes),
+                    'admitted': self.__admitted,
+                    'rejected': self.__rejected,
+                    'dispatched': self.__dispatched,
+                    'wait_seconds': {'mean': sum(waits) / len(waits) if waits else None,
+                                     'p50': waits[len(waits) // 2] if waits else None,
+                                     'p95': waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else None,
+                                     'max': waits[-1] if waits else None}
+                    }
+
+    def __append(self, job):
+        self.__classes[job.priority].setdefault(job.tenant, deque()).append(job)
+        self.__count(job.tenant, 1)
+
+    def __take(self, priority: str):
+        # The tenant at the front spends its deficit one job at a time, topping it up by its
+        # weight when it runs out and otherwise passing the turn to the next tenant
+        tenants = self.__classes[priority]
+        while True:
+            tenant, jobs = next(iter(tenants.items()))
+            key = (priority, tenant)
+            if self.__deficits.get(key, 0) < 1:
+                self.__deficits[key] = self.__deficits.get(key, 0) + max(self.__tenant_weights.get(tenant, 1), MIN_TENANT_WEIGHT)
+                if self.__deficits[key] < 1:
+                    tenants.move_to_end(tenant)
+                    continue
+
+            job = jobs.popleft()
+            self.__deficits[key] -= 1
+            if not jobs:
+                # A tenant with nothing queued gives up the rest of its turn
+                del tenants[tenant]
+                self.__deficits.pop(key, None)
+            elif self.__deficits[key] < 1:
+                tenants.move_to_end(tenant)
+
+            self.__count(tenant, -1)
+            return job
+
+    def __count(self, tenant: str, change: int):
+        self.__size += change
+        size = self.__tenant_sizes.get(tenant, 0) + change
+        if size > 0:
+            self.__tenant_sizes[tenant] = size
+        else:
+            self.__tenant_sizes.pop(tenant, None)
@@ -13,24 +13,135 @@ for a client session
 #Imports
 from secrets import token_urlsafe
 from enum import Enum
+from os import getenv
+from time import monotonic, time
+from metrics import METRICS
+from session_store import Session_Store
+import asyncio
+import threading
+
+# How long a finished, killed or failed session is kept for its client to read, and
+# how long a session that never got a job is kept before it counts as abandoned
+SESSION_TTL_SECONDS = float(getenv('SESSION_TTL_SECONDS', 3600))
+ABANDONED_SESSION_TTL_SECONDS = float(getenv('ABANDONED_SESSION_TTL_SECONDS', 3600))
+
+# Expired sessions are looked for at most this often, as new sessions are made
+SESSION_EVICTION_INTERVAL_SECONDS = float(getenv('SESSION_EVICTION_INTERVAL_SECONDS', 30))
+
+SESSION_STATUS_SECONDS = METRICS.histogram('ml_pipe_session_status_seconds', 'Seconds sessions spent in a status before leaving it', ('status',))
+SESSION_TRANSITIONS = METRICS.counter('ml_pipe_session_transitions_total', 'Sessions entering each status', ('status',))
+SESSIONS_EVICTED = METRICS.counter('ml_pipe_sessions_evicted_total', 'Sessions dropped once their TTL was up')
 
 class Session_Manager:
-    def __init__(self):
+    def __init__(self, session_store: Session_Store | None = None):
         self.TOKEN_LENGTH = 18
         self.session_registry: dict[str:Session] = {}
+        self.__session_store = session_store if session_store is not None else Session_Store(':memory:')
+
+        # Per status the tokens of the sessions in it, in the order they entered it, so
+        # the sessions that have waited longest for eviction are always at the front
+        self.__status_index: dict[Session_Status:dict[str:None]] = {session_status: {} for session_status in Session_Status}
+        self.__index_lock = threading.Lock()
+        self.__last_eviction = monotonic()
+        self.__eviction_listeners = []
+        self.__dataset_listeners = []
+
+        # Session tokens mapped to whoever is listening for their status transitions
+        self.__subscribers: dict[str:list[Status_Subscription]] = {}
+        self.__subscriber_lock = threading.Lock()
+
+        # Jobs of the sessions restored from the store, until the job manager takes them back
+        self.__restored_jobs: dict[str:dict] = {}
+        self.__restore_sessions()
 
     def new_session(self) -> str:
+        self.__evict_expired_sessions()
 
         # Ensure the token we generate isn't already used
         while(True):
             token = self.__generate_session_token()
-            if self.session_registry.get('token') is None:
+            if self.session_registry.get(token) is None:
                 break
 
-        session = Session(token)
+        session = Session(token, self.__publish_status)
         self.session_registry[token] = session
+        self.__index(session, None)
+        self.__session_store.save_session(session)
         return token
 
+    def save(self, session: 'Session'):
+        """ Writes a change to a session that did not come with a status transition through to the store """
+        self.__session_store.save_session(session)
+
+    def remove_session(self, token: str):
+        session: Session | None = self.session_registry.pop(token, None)
+        if session is None: return
+
+        with self.__index_lock:
+            self.__status_index[session.status].pop(token, None)
+        self.__close_subscriptions([token])
+        self.__session_store.delete_sessions([token])
+
+    def add_eviction_listener(self, listener):
+        """ Calls listener(tokens) with the tokens of the sessions each time some are evicted """
+        self.__eviction_listeners.append(listener)
+
+    def add_dataset_listener(self, listener):
+        """ Calls listener(token) each time a dataset held by the core is attached to a session """
+        self.__dataset_listeners.append(listener)
+
+    def take_restored_jobs(self) -> dict:
+        """ Session tokens mapped to the {'job_spec', 'priority', 'tenant'} of the job they had
+        when the core last stopped. Only returns them once.
+        """
+        restored_jobs, self.__restored_jobs = self.__restored_jobs, {}
+        return restored_jobs
+
+    def subscribe(self, token: str) -> 'Status_Subscription | None':
+        """ Subscribes the running event loop to the status transitions of a
+        session. The current status is delivered first.
+        """
+        session: Session | None = self.session_registry.get(token)
+        if session is None: return None
+
+        subscription = Status_Subscription(asyncio.get_running_loop())
+        with self.__subscriber_lock:
+            self.__subscribers.setdefault(token, []).append(subscription)
+            subscription.push(session.status)
+        return subscription
+
+    def unsubscribe(self, token: str, subscription: 'Status_Subscription'):
+        with self.__subscriber_lock:
+            subscriptions = self.__subscribers.get(token, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self.__subscribers.pop(token, None)
+
+    def __close_subscriptions(self, tokens: list[str]):
+        # Listeners of a session that is gone are told so, rather than left waiting for a transition that never comes
+        with self.__subscriber_lock:
+            for token in tokens:
+                for subscription in self.__subscribers.pop(token, []):
+                    subscription.close()
+
+    def count_by_status(self) -> dict:
+        with self.__index_lock:
+            return {(session_status.name,): len(tokens) for session_status, tokens in self.__status_index.items()}
+
+    def __publish_status(self, session: 'Session', previous_status: 'Session_Status', seconds: float):
+        # Where the time of a session goes, queue wait, boot, handoffs, transfer, training and fetch
+        SESSION_STATUS_SECONDS.observe(seconds, status= previous_status.name)
+        SESSION_TRANSITIONS.inc(status= session.status.name)
+
+        self.__index(session, previous_status)
+        self.__session_store.save_session(session)
+
+        # Transitions happen on the dispatcher and overwatch threads as well as the event loop
+        with self.__subscriber_lock:
+            for subscription in self.__subscribers.get(session.token, []):
+                subscription.push(session.status)
+
     def poll_session_status(self, token: str) -> str | None:
         session: Session | None = self.session_registry.get(token)
         if session is None: return None
@@ -45,27 +156,167 @@ class Session_Manager:
             session.status = Session_Status.TRAINING 
             return session.worker_port
         
-    def report_finished_training(self, token: str) -> None:
+    def attach_dataset(self, token: str, dataset_digest: str) -> bool:
+        """ Hands the session's data transfer and result fetch to the core, which
+        moves the dataset it holds to the trainer. Returns False once the client has
+        started sending its data to the trainer itself, or if there is no such session.
+        """
         session: Session | None = self.session_registry.get(token)
+        if session is None or session.status not in DATASET_ATTACHABLE_STATUSES:
+            return False
+
+        session.dataset_digest = dataset_digest
+        self.save(session)
+
+        for listener in self.__dataset_listeners:
+            listener(token)
+        return True
+
+    def report_finished_training(self, token: str) -> None:
+        session: Session | None = self.__reporting_session(token)
         if session is not None: 
             session.status = Session_Status.PENDING_RESPONSE_FETCH 
     
+    def report_failed_training(self, token: str) -> None:
+        session: Session | None = self.__reporting_session(token)
+        if session is not None: 
+            session.status = Session_Status.ERROR 
+    
     def report_terminated(self, token: str) -> None:
-        session: Session | None = self.session_registry.get(token)
+        session: Session | None = self.__reporting_session(token)
         if session is not None: 
             session.status = Session_Status.FINISHED 
+
+    def __reporting_session(self, token: str) -> 'Session | None':
+        """ The session a trainer reports on, if it still holds that trainer. A report of an
+        earlier job, sent after its worker was reset and handed to another session, is ignored.
+        """
+        session: Session | None = self.session_registry.get(token)
+        if session is None or session.worker_port is None or session.status in (Session_Status.FINISHED, Session_Status.KILLED, Session_Status.ERROR):
+            if session is not None:
+                print(f'Ignoring a stale report for Session: {token} in {session.status.name}')
+            return None
+        return session
     
     def __generate_session_token(self):
         return token_urlsafe(self.TOKEN_LENGTH)
+
+    def __index(self, session: 'Session', previous_status: 'Session_Status | None'):
+        with self.__index_lock:
+            if previous_status is not None:
+                self.__status_index[previous_status].pop(session.token, None)
+            self.__status_index[session.status][session.token] = None
+
+    def __evict_expired_sessions(self):
+        """ Drops the sessions whose TTL is up, keeping the registry and the store
+        bounded however many sessions come and go. Sessions still holding a worker
+        are kept until Overwatch has handed it back.
+        """
+        if monotonic() - self.__last_eviction < SESSION_EVICTION_INTERVAL_SECONDS: return
+        self.__last_eviction = monotonic()
+
+        now = time()
+        expired = []
+        ttls = [(Session_Status.FINISHED, SESSION_TTL_SECONDS), (Session_Status.KILLED, SESSION_TTL_SECONDS),
+                (Session_Status.ERROR, SESSION_TTL_SECONDS), (Session_Status.PENDING_JOB, ABANDONED_SESSION_TTL_SECONDS)]
+        with self.__index_lock:
+            for session_status, ttl in ttls:
+                for token in self.__status_index[session_status]:
+                    session: Session | None = self.session_registry.get(token)
+                    if session is None: continue
+
+                    # Oldest first, so the first session still inside its TTL ends the search
+                    if now - session.status_changed_at < ttl: break
+                    # A session in PENDING_JOB with a job has a worker being handed it, it is not abandoned
+                    if session.worker_port is None and (session_status != Session_Status.PENDING_JOB or session.job is None):
+                        expired.append(token)
+
+            for token in expired:
+                session = self.session_registry.pop(token)
+                self.__status_index[session.status].pop(token, None)
+
+        if not expired: return
+
+        self.__close_subscriptions(expired)
+        self.__session_store.delete_sessions(expired)
+        SESSIONS_EVICTED.inc(len(expired))
+
+        for listener in self.__eviction_listeners:
+            listener(expired)
+
+    def __restore_sessions(self):
+        for record in self.__session_store.load_sessions():
+            session = Session(record['token'], self.__publish_status, Session_Status(record['status']), record['status_changed_at'])
+            session.worker_node = record['worker_node']
+            session.worker_port = record['worker_port']
+            session.worker_url = record['worker_url']
+            session.dataset_digest = record['dataset_digest']
+            session.results = record['results']
+
+            self.session_registry[session.token] = session
+            self.__index(session, None)
+            if record['job'] is not None:
+                self.__restored_jobs[session.token] = record['job']
+
+        if self.session_registry:
+            print(f'Restored {len(self.session_registry)} sessions')
     
 
 class Session():
-    def __init__(self, token: str):
+    def __init__(self, token: str, on_status_change = None, status: 'Session_Status | None' = None, status_changed_at: float | None = None):
         self.token = token
-        self.status = Session_Status.PENDING_JOB
+        self.__on_status_change = on_status_change
+        self.__status = status if status is not None else Session_Status.PENDING_JOB
+
+        # When the status last changed, on the wall clock so it still means something after a restart
+        self.status_changed_at = status_changed_at if status_changed_at is not None else time()
+        self.__status_since = monotonic() - max(0, time() - self.status_changed_at)
         self.job = None
+        self.worker_node = None
         self.worker_port = None
 
+        # Where clients reach the worker when it is not on the host they reach us on
+        self.worker_url = None
+
+        # Set when the core holds the dataset and moves the data and results itself
+        self.dataset_digest = None
+        self.results = None
+
+    @property
+    def status(self) -> 'Session_Status':
+        return self.__status
+
+    @status.setter
+    def status(self, status: 'Session_Status'):
+        if status == self.__status: return
+
+        now = monotonic()
+        previous_status, seconds = self.__status, now - self.__status_since
+        self.__status = status
+        self.__status_since = now
+        self.status_changed_at = time()
+        if self.__on_status_change is not None:
+            self.__on_status_change(self, previous_status, seconds)
+
+
+class Status_Subscription():
+    """ Queue of status transitions for one listener, fed from any thread and
+    read from the event loop the subscription was made on
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.__loop = loop
+        self.__queue: asyncio.Queue = asyncio.Queue()
+
+    def push(self, status: 'Session_Status'):
+        self.__loop.call_soon_threadsafe(self.__queue.put_nowait, status)
+
+    def close(self):
+        """ The session is gone, get returns None once the transitions before this have been read """
+        self.__loop.call_soon_threadsafe(self.__queue.put_nowait, None)
+
+    async def get(self) -> 'Session_Status | None':
+        return await self.__queue.get()
+
 
 class Session_Status(Enum):
     ERROR = -1
@@ -79,3 +330,7 @@ class Session_Status(Enum):
     FINISHED = 7
     KILLED = 8
 
+
+# Until the data transfer has begun the core can still take it over from the client
+DATASET_ATTACHABLE_STATUSES = (Session_Status.PENDING_JOB, Session_Status.PENDING_AVAILABLE_TRAINER,
+                               Session_Status.PENDING_HEALTHY_RESPONSE, Session_Status.PENDING_DATA_TRANSFER)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+""" This file contains the logic for keeping sessions
+and batches in SQLite so they survive a restart of the core
+ """
+#----------------------------------
+#
+#
+#Imports
+import json
+import os
+import sqlite3
+import threading
+from os import getenv
+from tempfile import gettempdir
+
+# Where sessions are kept, ':memory:' keeps them for the life of the process only
+SESSION_DATABASE = getenv('SESSION_DATABASE', os.path.join(gettempdir(), 'ml-pipe-core', 'sessions.db'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    token TEXT PRIMARY KEY,
+    status INTEGER NOT NULL,
+    status_changed_at REAL NOT NULL,
+    job TEXT,
+    worker_node TEXT,
+    worker_port INTEGER,
+    worker_url TEXT,
+    dataset_digest TEXT,
+    results TEXT
+);
+CREATE TABLE IF NOT EXISTS batches (
+    batch_id TEXT PRIMARY KEY,
+    dataset_digest TEXT NOT NULL,
+    session_tokens TEXT NOT NULL
+);
+"""
+
+
+class Session_Store:
+    """ Write through copy of the sessions and batches in SQLite. The registries
+    in memory are what gets read, this is only read back when the core starts.
+    WAL lets every write commit without waiting on a full fsync.
+    """
+
+    def __init__(self, path: str = SESSION_DATABASE):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok= True)
+
+        # One connection shared by every thread, writes are serialized by the lock
+        self.__connection = sqlite3.connect(path, check_same_thread= False, isolation_level= None)
+        self.__lock = threading.Lock()
+        with self.__lock:
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.execute('PRAGMA synchronous=NORMAL')
+            self.__connection.executescript(SCHEMA)
+
+    def save_session(self, session: 'Session'):
+        job = session.job
+        row = (session.token, session.status.value, session.status_changed_at,
+               json.dumps({'job_spec': job.job_spec, 'priority': job.priority, 'tenant': job.tenant}) if job is not None else None,
+               session.worker_node, session.worker_port, session.worker_url, session.dataset_digest,
+               json.dumps(session.results) if session.results is not None else None)
+
+        with self.__lock:
+            self.__connection.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+
+    def delete_sessions(self, tokens: list[str]):
+        with self.__lock:
+            self.__connection.executemany('DELETE FROM sessions WHERE token = ?', [(token,) for token in tokens])
+
+    def load_sessions(self) -> list[dict]:
+        """ Every stored session as a dict of its columns, oldest status change first """
+        with self.__lock:
+            cursor = self.__connection.execute('SELECT token, status, status_changed_at, job, worker_node, worker_port, worker_url, dataset_digest, results '
+                                               'FROM sessions ORDER BY status_changed_at')
+            rows = cursor.fetchall()
+
+        return [{'token': token, 'status': status, 'status_changed_at': status_changed_at,
+                 'job': json.loads(job) if job is not None else None,
+                 'worker_node': worker_node, 'worker_port': worker_port, 'worker_url': worker_url,
+                 'dataset_digest': dataset_digest,
+                 'results': json.loads(results) if results is not None else None}
+                for token, status, status_changed_at, job, worker_node, worker_port, worker_url, dataset_digest, results in rows]
+
+    def save_batch(self, batch: 'Batch'):
+        with self.__lock:
+            self.__connection.execute('INSERT OR REPLACE INTO batches VALUES (?, ?, ?)',
+                                      (batch.batch_id, batch.dataset_digest, json.dumps(batch.session_tokens)))
+
+    def delete_batch(self, batch_id: str):
+        with self.__lock:
+            self.__connection.execute('DELETE FROM batches WHERE batch_id = ?', (batch_id,))
+
+    def load_batches(self) -> list[tuple[str, str, list[str]]]:
+        with self.__lock:
+            rows = self.__connection.execute('SELECT batch_id, dataset_digest, session_tokens FROM batches').fetchall()
+        return [(batch_id, dataset_digest, json.loads(session_tokens)) for batch_id, dataset_digest, session_tokens in rows]
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
@@ -0,0 +1,544 @@
+# -*- coding: utf-8 -*-
+""" This file contains the logic and datastructures
+for the pool of trainer workers and the backends that run them
+ """
+#----------------------------------
+#
+#
+#Imports
+import os
+import signal
+import subprocess
+import sys
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from enum import Enum
+from os import getenv
+from tempfile import gettempdir
+from time import monotonic, sleep
+import docker
+from datasets import DATASET_DIRECTORY
+
+TRAINER_IMAGE = 'machine-learning-pipeline-orchestrator-trainer:latest'
+
+# production preloads the trainer once and forks the process serving it, dev reloads it on every change
+TRAINER_STARTUP = getenv('TRAINER_STARTUP', 'production')
+TRAINER_COMMANDS = {'production': ['python', '-m', 'src.serve', '--host', '0.0.0.0', '--port', '80'],
+                    'dev': ['fastapi', 'dev', './main.py', '--host', '0.0.0.0', '--port', '80']}
+TRAINER_COMMAND = TRAINER_COMMANDS[TRAINER_STARTUP]
+
+# Docker volume every trainer container keeps its model artifacts in, so any worker can predict with any model
+TRAINER_ARTIFACT_VOLUME = getenv('TRAINER_ARTIFACT_VOLUME', 'ml-pipe-artifacts')
+TRAINER_ARTIFACT_DIRECTORY = '/artifacts'
+
+# Docker volume holding our dataset store, mounted read only in every trainer container so they read
+# datasets in place. It only helps when the core keeps its DATASET_DIRECTORY on the same volume
+TRAINER_DATASET_VOLUME = getenv('TRAINER_DATASET_VOLUME', 'ml-pipe-datasets')
+TRAINER_DATASET_DIRECTORY = '/datasets'
+
+# Where the trainer app lives when it is run without docker, and where those trainers report back to us
+TRAINER_DIRECTORY = getenv('TRAINER_DIRECTORY', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'ml-pipe-trainer'))
+SUBPROCESS_CORE_URL = getenv('SUBPROCESS_CORE_URL', 'http://127.0.0.1:8000')
+SUBPROCESS_STOP_TIMEOUT_SECONDS = 5
+# Each local trainer process is recorded here, so the ones an earlier run of the core left running can be found again
+SUBPROCESS_PID_DIRECTORY = getenv('SUBPROCESS_PID_DIRECTORY', os.path.join(gettempdir(), 'ml-pipe-core', 'workers'))
+
+# Docker limits CPUs as a quota of CPU time per period
+CPU_PERIOD_MICROSECONDS = 100000
+
+# Warm workers each node tries to keep idle, the most workers a node will ever run
+# and how long an idle worker above the minimum is kept before it is evicted
+POOL_MIN_IDLE = int(getenv('POOL_MIN_IDLE', 1))
+POOL_MAX_SIZE = int(getenv('POOL_MAX_SIZE', 0)) # 0 means one per port
+POOL_IDLE_TIMEOUT_SECONDS = float(getenv('POOL_IDLE_TIMEOUT_SECONDS', 300))
+
+
+class Port_Allocator:
+    """ Free list of the worker ports we are allowed to give out. Claiming
+    and releasing a port is O(1) and claiming blocks until a port is free.
+    """
+
+    def __init__(self, min_port: int, max_port: int):
+        self.__free_ports = deque(range(min_port, max_port + 1))
+        self.port_count = len(self.__free_ports)
+
+        # Claimed port numbers are mapped to their owners
+        self.__port_registry: dict[int:str] = {}
+        self.__condition = threading.Condition()
+
+    def acquire(self, owner: str, timeout: float | None = None) -> int | None:
+        """ Claims the next free port for the owner, waiting up to timeout
+        seconds for one to be released. Returns None if none became free.
+        """
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: self.__free_ports, timeout):
+                return None
+
+            port = self.__free_ports.popleft()
+            self.__port_registry[port] = owner
+            return port
+
+    def claim(self, port: int, owner: str) -> bool:
+        """ Claims a given port for the owner, False if it is not ours or already claimed """
+        with self.__condition:
+            if port not in self.__free_ports: return False
+
+            self.__free_ports.remove(port)
+            self.__port_registry[port] = owner
+            return True
+
+    def release(self, port: int):
+        with self.__condition:
+            if self.__port_registry.pop(port, None) is None: return
+
+            self.__free_ports.append(port)
+            self.__condition.notify()
+
+    def claimed_ports(self) -> list[tuple[int, str]]:
+        """ Snapshot of the claimed ports and their owners """
+        with self.__condition:
+            return list(self.__port_registry.items())
+
+
+class Resources:
+    """ CPUs and memory a job needs, or a node has """
+    def __init__(self, cpus: float, memory_bytes: int):
+        self.cpus = cpus
+        self.memory_bytes = memory_bytes
+
+
+class Worker_Status(Enum):
+    BOOTING = 0
+    IDLE = 1
+    LEASED = 2
+
+
+class Worker:
+    def __init__(self, node: 'Node', port: int):
+        self.node = node
+        self.port = port
+        self.name = worker_name(node, port)
+        self.status = Worker_Status.BOOTING
+        self.warm = False
+        self.session_token = None
+        self.last_released = monotonic()
+
+        # What the leasing job has been given on the node
+        self.resources: Resources | None = None
+
+    @property
+    def url(self) -> str:
+        return f'{self.node.url}:{self.port}'
+
+    @property
+    def public_url(self) -> str | None:
+        """ Where clients reach the worker, None if they should use their own base URL """
+        return f'{self.node.public_url}:{self.port}' if self.node.public_url else None
+
+
+class Worker_Backend(ABC):
+    """ Starts and stops the trainer app behind a worker, reachable over HTTP on the workers port """
+
+    @abstractmethod
+    def start(self, worker: Worker, resources: Resources | None = None):
+        """ Starts the worker, limited to the resources when they are given """
+        pass
+
+    @abstractmethod
+    def stop(self, worker: Worker):
+        """ Stops the worker, doing nothing if it is not running """
+        pass
+
+    def apply_limits(self, worker: Worker, resources: Resources):
+        """ Limits a running worker to the resources of the job it has been leased to """
+        pass
+
+    def running_ports(self, node: 'Node') -> list[int]:
+        """ Ports of the workers running on the node, including ones left by an earlier run of the core """
+        return []
+
+
+def worker_name(node: 'Node', port: int) -> str:
+    return f'ml-pipe-trainer-{node.name}-{port}'
+
+
+class Docker_Backend(Worker_Backend):
+    """ Runs each worker as a trainer container with the workers port published.
+    Containers are limited to the CPUs and memory of the job they run.
+    """
+
+    def __init__(self, docker_url: str | None = None):
+        self.__docker_client = docker.DockerClient(base_url= docker_url) if docker_url else docker.from_env()
+
+    def start(self, worker: Worker, resources: Resources | None = None):
+        # Clear out a container left behind under this name by an earlier run
+        self.stop(worker)
+
+        limits = {}
+        if resources is not None:
+            limits = {'nano_cpus': int(resources.cpus * 1e9), 'mem_limit': resources.memory_bytes, 'memswap_limit': resources.memory_bytes}
+
+        self.__docker_client.containers.run(
+            image= TRAINER_IMAGE,
+            command= TRAINER_COMMAND,
+            ports= {80:worker.port},
+            name= worker.name,
+            volumes= {TRAINER_ARTIFACT_VOLUME: {'bind': TRAINER_ARTIFACT_DIRECTORY, 'mode': 'rw'},
+                      TRAINER_DATASET_VOLUME: {'bind': TRAINER_DATASET_DIRECTORY, 'mode': 'ro'}},
+            environment= {'ARTIFACT_DIRECTORY': TRAINER_ARTIFACT_DIRECTORY, 'CORE_DATASET_DIRECTORY': TRAINER_DATASET_DIRECTORY},
+            detach= True,
+            **limits
+        )
+
+    def stop(self, worker: Worker):
+        try:
+            self.__docker_client.containers.get(worker.name).remove(force= True)
+        except docker.errors.NotFound:
+            pass
+
+    def apply_limits(self, worker: Worker, resources: Resources):
+        try:
+            self.__docker_client.containers.get(worker.name).update(
+                cpu_period= CPU_PERIOD_MICROSECONDS,
+                cpu_quota= int(resources.cpus * CPU_PERIOD_MICROSECONDS),
+                mem_limit= resources.memory_bytes,
+                memswap_limit= resources.memory_bytes
+            )
+        except docker.errors.APIError as e:
+            # A warm container already using more memory than the new limit keeps its old one
+            print(f'Could not limit {worker.name}: {e}')
+
+    def running_ports(self, node: 'Node') -> list[int]:
+        # Containers are named after their node and port, the name filter matches on a substring
+        prefix = worker_name(node, '')
+        ports = []
+        for container in self.__docker_client.containers.list(filters= {'name': prefix, 'status': 'running'}):
+            port = container.name[len(prefix):]
+            if container.name.startswith(prefix) and port.isdigit():
+                ports.append(int(port))
+        return ports
+
+
+class Subprocess_Backend(Worker_Backend):
+    """ Runs each worker as a local process serving the trainer app,
+    for hosts without docker and for standing in for nodes on localhost.
+    Processes are not limited to the resources they are placed with. The pid
+    of each one is kept in a file named after its worker, so processes left
+    running by an earlier run of the core are found and stopped or adopted.
+    """
+
+    def __init__(self, trainer_directory: str = TRAINER_DIRECTORY, core_url: str = SUBPROCESS_CORE_URL, pid_directory: str = SUBPROCESS_PID_DIRECTORY):
+        self.__trainer_directory = trainer_directory
+        self.__pid_directory = pid_directory
+        os.makedirs(self.__pid_directory, exist_ok= True)
+        # Trainers on this host read the datasets we hold straight from our dataset store
+        self.__environment = {**os.environ, 'CORE_URL': core_url, 'CORE_DATASET_DIRECTORY': os.path.abspath(DATASET_DIRECTORY)}
+
+        # Worker names mapped to their processes
+        self.__processes: dict[str:subprocess.Popen] = {}
+        self.__lock = threading.Lock()
+
+    def start(self, worker: Worker, resources: Resources | None = None):
+        self.stop(worker)
+
+        if TRAINER_STARTUP == 'production':
+            command = [sys.executable, '-m', 'src.serve', '--host', '127.0.0.1', '--port', str(worker.port)]
+        else:
+            command = [sys.executable, '-m', 'uvicorn', 'src.main:app', '--host', '127.0.0.1', '--port', str(worker.port), '--reload']
+
+        process = subprocess.Popen(
+            command,
+            cwd= self.__trainer_directory,
+            env= self.__environment
+        )
+        with self.__lock:
+            self.__processes[worker.name] = process
+        with open(self.__pid_file(worker.name), 'w') as file:
+            file.write(str(process.pid))
+
+    def stop(self, worker: Worker):
+        with self.__lock:
+            process = self.__processes.pop(worker.name, None)
+
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(SUBPROCESS_STOP_TIMEOUT_SECONDS)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        else:
+            # Not started by this run of the core, so it is not our child and is stopped by its pid
+            pid = self.__recorded_pid(worker.name, worker.port)
+            if pid is not None:
+                stop_pid(pid)
+
+        try:
+            os.remove(self.__pid_file(worker.name))
+        except FileNotFoundError:
+            pass
+
+    def running_ports(self, node: 'Node') -> list[int]:
+        prefix = worker_name(node, '')
+        ports = []
+        for file_name in os.listdir(self.__pid_directory):
+            name, extension = os.path.splitext(file_name)
+            port = name[len(prefix):]
+            if extension != '.pid' or not name.startswith(prefix) or not port.isdigit(): continue
+
+            if self.__recorded_pid(name, int(port)) is not None:
+                ports.append(int(port))
+            else:
+                os.remove(self.__pid_file(name))
+        return ports
+
+    def __pid_file(self, name: str) -> str:
+        return os.path.join(self.__pid_directory, f'{name}.pid')
+
+    def __recorded_pid(self, name: str, port: int) -> int | None:
+        """ The pid recorded for the worker, None when that process is gone or the pid has been reused by another """
+        try:
+            with open(self.__pid_file(name)) as file:
+                pid = int(file.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError:
+            # Running, but as someone else, so it is not one of our trainers
+            return None
+
+        # Where the command line can be read, the process must be a trainer serving this port
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as file:
+                command = file.read().split(b'\0')
+        except OSError:
+            return pid
+        return pid if str(port).encode() in command else None
+
+
+def stop_pid(pid: int):
+    """ Terminates a process that is not a child of ours, killing it if it is still running after the stop timeout """
+    try:
+        os.kill(pid, signal.SIGTERM)
+        deadline = monotonic() + SUBPROCESS_STOP_TIMEOUT_SECONDS
+        while monotonic() < deadline:
+            os.kill(pid, 0)
+            sleep(0.1)
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class Worker_Pool:
+    """ Pool of trainer workers across the nodes of the node registry. Workers are
+    started ahead of time and warmed so a session can lease one straight away, and
+    they are reset and handed back after a job instead of being killed. A lease is
+    placed on a node with room for the jobs resources, which are held until release.
+    """
+
+    def __init__(self, node_registry: 'Node_Registry', max_size: int = POOL_MAX_SIZE, idle_timeout: float = POOL_IDLE_TIMEOUT_SECONDS):
+        self.__node_registry = node_registry
+        self.__idle_timeout = idle_timeout
+
+        # Per node limits on the workers it runs and the idle workers it keeps warm
+        self.__max_size = {node.name: min(max_size, node.port_allocator.port_count) if max_size > 0 else node.port_allocator.port_count for node in node_registry.nodes}
+        self.__min_idle = {node.name: min(node.min_idle, self.__max_size[node.name]) for node in node_registry.nodes}
+
+        # Every worker mapped by its name, and per node the idle ones with the most recently released on the right
+        self.__workers: dict[str:Worker] = {}
+        self.__idle: dict[str:deque[Worker]] = {node.name: deque() for node in node_registry.nodes}
+        self.__condition = threading.Condition()
+
+    def lease(self, session_token: str, resources: Resources, timeout: float | None = None) -> Worker | None:
+        """ Leases a worker to the session on the node the placement policy picks
+        among those with room for the resources, preferring a warm idle worker and
+        starting a new one if the node may still grow. Waits up to timeout seconds
+        for room to be released. Returns None if none became available.
+        """
+        with self.__condition:
+            placement = []
+            def place() -> bool:
+                node = self.__node_registry.place(resources, [node for node in self.__node_registry.nodes if self.__idle[node.name] or self.__can_grow(node)])
+                placement[:] = [node] if node is not None else []
+                return node is not None
+
+            if not self.__condition.wait_for(place, timeout):
+                return None
+
+            node = placement[0]
+            if self.__idle[node.name]:
+                worker = self.__take_idle_worker(node)
+                is_new = False
+            else:
+                worker = self.__reserve_worker(node)
+                is_new = True
+
+            worker.resources = node.reserve(resources)
+            worker.status = Worker_Status.LEASED
+            worker.session_token = session_token
+
+        try:
+            if is_new:
+                node.backend.start(worker, worker.resources)
+            else:
+                node.backend.apply_limits(worker, worker.resources)
+        except Exception:
+            # Its port and resources go back rather than being held by a worker that never ran
+            self.discard(worker)
+            raise
+
+        return worker
+
+    def release(self, worker: Worker):
+        """ Hands a worker that has been reset back to the pool """
+        with self.__condition:
+            if self.__workers.get(worker.name) is not worker: return
+
+            self.__free_resources(worker)
+            worker.status = Worker_Status.IDLE
+            worker.warm = True
+            worker.session_token = None
+            worker.last_released = monotonic()
+            self.__idle[worker.node.name].append(worker)
+            self.__condition.notify_all()
+
+    def discard(self, worker: Worker):
+        """ Stops the worker and frees its port """
+        with self.__condition:
+            if self.__workers.pop(worker.name, None) is None: return
+            if worker in self.__idle[worker.node.name]:
+                self.__idle[worker.node.name].remove(worker)
+            self.__free_resources(worker)
+
+        self.__stop_worker(worker)
+        worker.node.port_allocator.release(worker.port)
+
+        with self.__condition:
+            self.__condition.notify_all()
+
+    def mark_warm(self, worker: Worker):
+        with self.__condition:
+            worker.warm = True
+
+    def reconcile(self, leases: dict) -> set[str]:
+        """ Takes over the workers an earlier run of the core left running. Those still
+        leased to one of its sessions are adopted, leased again to the same session,
+        and the rest are stopped so their ports can be used again.
+
+        Args:
+            leases (dict): (node name, port) mapped to the (session token, resources) leasing that worker
+
+        Returns:
+            set[str]: Tokens of the sessions whose worker was adopted
+        """
+        adopted, reaped = set(), []
+        for node in self.__node_registry.nodes:
+            for port in node.backend.running_ports(node):
+                lease = leases.get((node.name, port))
+                if lease is None or not node.port_allocator.claim(port, 'pool'):
+                    reaped.append(Worker(node, port))
+                    continue
+
+                session_token, resources = lease
+                worker = Worker(node, port)
+                worker.status = Worker_Status.LEASED
+                worker.warm = True
+                worker.session_token = session_token
+                worker.resources = node.reserve(resources)
+                with self.__condition:
+                    self.__workers[worker.name] = worker
+                adopted.add(session_token)
+
+        for worker in reaped:
+            print(f'Stopping {worker.name}, left running by an earlier run')
+            self.__stop_worker(worker)
+
+        return adopted
+
+    def utilization(self) -> dict:
+        """ Per node its ports, the workers holding them and what the leased ones have been given """
+        with self.__condition:
+            utilization = {}
+            for node in self.__node_registry.nodes:
+                workers = [worker for worker in self.__workers.values() if worker.node is node]
+                leased = sum(1 for worker in workers if worker.status == Worker_Status.LEASED)
+                utilization[node.name] = {'slots': node.port_allocator.port_count, 'slots_used': node.worker_count,
+                                          'leased': leased, 'idle': len(self.__idle[node.name]),
+                                          'cpus': node.capacity.cpus, 'cpus_allocated': node.allocated.cpus,
+                                          'memory_bytes': node.capacity.memory_bytes, 'memory_bytes_allocated': node.allocated.memory_bytes}
+            return utilization
+
+    def leased_workers(self) -> list[Worker]:
+        with self.__condition:
+            return [worker for worker in self.__workers.values() if worker.status == Worker_Status.LEASED]
+
+    def cold_idle_workers(self) -> list[Worker]:
+        """ Idle workers that have not yet answered a warm up """
+        with self.__condition:
+            return [worker for idle in self.__idle.values() for worker in idle if not worker.warm]
+
+    def maintain(self):
+        """ Evicts workers that have sat idle too long above the minimum and
+        tops each node back up to its minimum number of idle workers
+        """
+        evicted, started = [], []
+        now = monotonic()
+        with self.__condition:
+            for node in self.__node_registry.nodes:
+                idle = self.__idle[node.name]
+
+                # The oldest idle workers are on the left
+                while len(idle) > self.__min_idle[node.name] and now - idle[0].last_released > self.__idle_timeout:
+                    worker = idle.popleft()
+                    del self.__workers[worker.name]
+                    evicted.append(worker)
+
+                while len(idle) < self.__min_idle[node.name] and self.__can_grow(node):
+                    worker = self.__reserve_worker(node)
+                    worker.status = Worker_Status.IDLE
+                    idle.appendleft(worker)
+                    started.append(worker)
+
+        for worker in evicted:
+            self.__stop_worker(worker)
+            worker.node.port_allocator.release(worker.port)
+
+        for worker in started:
+            worker.node.backend.start(worker)
+
+        if started:
+            with self.__condition:
+                self.__condition.notify_all()
+
+    def __can_grow(self, node: 'Node') -> bool:
+        return node.worker_count < self.__max_size[node.name]
+
+    def __take_idle_worker(self, node: 'Node') -> Worker:
+        # Most recently released warm worker first, then any booting one
+        idle = self.__idle[node.name]
+        for worker in reversed(idle):
+            if worker.warm: break
+        else:
+            worker = idle[-1]
+
+        idle.remove(worker)
+        return worker
+
+    def __reserve_worker(self, node: 'Node') -> Worker:
+        port = node.port_allocator.acquire('pool', timeout= 0)
+        worker = Worker(node, port)
+        self.__workers[worker.name] = worker
+        return worker
+
+    def __free_resources(self, worker: Worker):
+        if worker.resources is not None:
+            worker.node.free(worker.resources)
+            worker.resources = None
+
+    def __stop_worker(self, worker: Worker):
+        worker.node.backend.stop(worker)
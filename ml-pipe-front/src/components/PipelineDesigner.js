@@ -69,6 +69,31 @@ const preprocessingTasks = {
   DropNaNs: {
     subset: ["Revenue", "Sales_quantity"],
   },
+  LagFeatures: {
+    dataSeries: ["Revenue"],
+    lags: [1, 7],
+  },
+  LeadFeatures: {
+    dataSeries: ["Revenue"],
+    leads: [1],
+  },
+  RollingFeatures: {
+    dataSeries: ["Revenue"],
+    windows: [7, 30],
+    statistics: ["mean", "std"],
+  },
+  ExpandingFeatures: {
+    dataSeries: ["Revenue"],
+    statistics: ["mean"],
+  },
+  Differencing: {
+    dataSeries: ["Revenue"],
+    periods: [1],
+  },
+  CalendarFeatures: {
+    features: ["month", "dayofweek"],
+    cyclical: true,
+  },
 };
 
 const PipelineDesigner = () => {
@@ -283,7 +308,7 @@ const PipelineDesigner = () => {
               <>
                 <h4>Upload Data Node</h4>
                 <label>Upload File:</label>
-                <input type="file" accept=".csv" onChange={handleFileChange} />
+                <input type="file" accept=".csv,.parquet,.arrow,.feather,.npy,.npz" onChange={handleFileChange} />
                 {fileName && <div><strong>File selected:</strong> {fileName}</div>}
               </>
             )}
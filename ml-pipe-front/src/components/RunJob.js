@@ -6,8 +6,20 @@ const CORE_PORT = 8000;
 let jobSpec = undefined;
 let token = undefined;
 let workerPort = undefined;
+let workerUrl = undefined;
 let lastStatus = undefined;
 let pollingIntervalID = undefined;
+let statusStream = undefined;
+let jobSent = false; // A session runs one job, it is sent the first time the session waits for it
+
+// The dataset goes to the core as soon as we have a token, in chunks that are resumed
+// where they left off. The core hands it to the trainer itself once one is ready
+const UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024;
+const UPLOAD_ATTEMPTS = 5;
+let uploadState = undefined; // "uploading", "attached" once the core holds our dataset, or "failed"
+
+// Nothing more happens to a session in these, EXPIRED is the last event of a stream whose session is gone
+const ENDED_STATUSES = ["FINISHED", "KILLED", "ERROR", "EXPIRED"];
 
 const RunJob = ({ jobSpecification, dataFile, onBack }) => {
   const [csvFile, setCsvFile] = useState(null); // Store the uploaded CSV file
@@ -33,9 +45,42 @@ const RunJob = ({ jobSpecification, dataFile, onBack }) => {
     // Reset error message
     setFileError('');
 
-    // First, send job specification to backend
-    pollingIntervalID = setInterval(pollBackend, 2000);
-    addLog('Submitting job and starting polling...', "info");
+    // First, fetch a session token and follow the status the backend pushes for it.
+    // Browsers without server sent events fall back to polling
+    if (window.EventSource) {
+      fetch(`${BASE_URL}:${CORE_PORT}/api/fetchtoken`)
+        .then(response => response.json())
+        .then(response => {
+          token = response["token"];
+          jobSent = false;
+          addLog(`Session token: ${token}`, "info");
+          upload_data();
+          openStatusStream();
+        });
+      addLog('Submitting job and streaming status...', "info");
+    } else {
+      pollingIntervalID = setInterval(pollBackend, 2000);
+      addLog('Submitting job and starting polling...', "info");
+    }
+  };
+
+  const openStatusStream = () => {
+    statusStream = new EventSource(`${BASE_URL}:${CORE_PORT}/api/statusstream/?token=${token}`);
+
+    statusStream.onmessage = (event) => {
+      lastStatus = event.data;
+      handleStatus(lastStatus);
+      addLog(`Status: ${lastStatus}`, "info");
+    };
+
+    statusStream.onerror = () => {
+      // The stream dropped before the session ended, poll for the rest of it
+      statusStream.close();
+      statusStream = undefined;
+      if (!ENDED_STATUSES.includes(lastStatus)) {
+        pollingIntervalID = setInterval(pollBackend, 2000);
+      }
+    };
   };
 
   const pollBackend = () => {
@@ -45,7 +90,9 @@ const RunJob = ({ jobSpecification, dataFile, onBack }) => {
         .then(response => response.json())
         .then(response => { 
           token = response["token"];
+          jobSent = false;
           addLog(`Session token: ${token}`, "info");
+          upload_data();
         });
     } else {
       // With our session token we can fetch the status of our training job
@@ -62,13 +109,30 @@ const RunJob = ({ jobSpecification, dataFile, onBack }) => {
   const handleStatus = (lastStatus) => {
     // There are steps of the process where we need to do something
     if (lastStatus === "PENDING_JOB") {
-      send_job(); // Send the job to the backend
+      // The session is back in PENDING_JOB once its trainer is up, the core hands it the job then
+      if (!jobSent) {
+        jobSent = true;
+        send_job(); // Send the job to the backend
+      }
     } else if (lastStatus === "PENDING_DATA_TRANSFER") {
-      send_data(); // Send the data to the trainer
+      // Only if the core could not take our dataset, otherwise it sends it to the trainer
+      if (uploadState === "failed") {
+        send_data(); // Send the data to the trainer
+      }
     } else if (lastStatus === "PENDING_RESPONSE_FETCH") {
-      get_results(); // Training has finished so fetch the results
-    } else if (lastStatus === "FINISHED" || lastStatus === "KILLED") {
+      if (uploadState !== "attached") {
+        get_results(); // Training has finished so fetch the results
+      }
+    } else if (ENDED_STATUSES.includes(lastStatus) || lastStatus === null) {
+      // A session the core no longer knows is polled as null
+      if (uploadState === "attached" && (lastStatus === "FINISHED" || lastStatus === "KILLED")) {
+        get_core_results(); // The core fetched the results from the trainer for us
+      }
       clearInterval(pollingIntervalID); // We can stop talking to the backend now
+      if (statusStream) {
+        statusStream.close();
+        statusStream = undefined;
+      }
     }
   };
 
@@ -85,7 +149,101 @@ const RunJob = ({ jobSpecification, dataFile, onBack }) => {
       headers: headers,
       body: body
     })
-      .then(() => addLog('Job submitted to backend.', "success"));
+      .then(response => {
+        // A full queue is refused with a hint of when to try again
+        if (response.status === 429) {
+          addLog(`Job queue is full, try again in ${response.headers.get('Retry-After')} seconds.`, "error");
+          jobSent = false; // Sent again if the session is still waiting for it next time we hear from it
+        } else if (response.status === 409) {
+          addLog('The session already has a job.', "error");
+        } else {
+          addLog('Job submitted to backend.', "success");
+        }
+      });
+  };
+
+  const upload_data = async () => {
+    uploadState = "uploading";
+    try {
+      // Named by its sha256 the core skips a dataset it already holds
+      const digest = Array.from(new Uint8Array(await crypto.subtle.digest("SHA-256", await dataFile.arrayBuffer())))
+        .map(byte => byte.toString(16).padStart(2, "0")).join("");
+
+      let upload = await fetch(`${BASE_URL}:${CORE_PORT}/api/uploads/`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          "session_token": token,
+          "digest": digest,
+          "content_type": dataFile.type || undefined,
+          "file_name": dataFile.name
+        })
+      }).then(response => response.json());
+
+      let attempts = 0;
+      while (!upload["complete"]) {
+        const offset = upload["offset"];
+        if (offset >= dataFile.size) {
+          upload = await fetch(`${BASE_URL}:${CORE_PORT}/api/uploads/${upload["upload_id"]}/complete`, { method: 'POST' })
+            .then(response => response.json());
+          break;
+        }
+
+        try {
+          const response = await send_chunk(upload["upload_id"], offset, dataFile.slice(offset, offset + UPLOAD_CHUNK_BYTES));
+          // 409 tells us where the core has got to, so we carry on from there
+          if (!response.ok && response.status !== 409) {
+            throw new Error(`HTTP ${response.status}`);
+          }
+          upload = { ...upload, ...(await response.json()), "complete": false };
+          attempts = 0;
+        } catch (error) {
+          attempts += 1;
+          if (attempts >= UPLOAD_ATTEMPTS) {
+            throw error;
+          }
+          await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempts));
+          upload = { ...upload, ...(await fetch(`${BASE_URL}:${CORE_PORT}/api/uploads/${upload["upload_id"]}`).then(response => response.json())) };
+        }
+      }
+
+      if (!upload["attached"]) {
+        throw new Error("The core could not take over the data transfer");
+      }
+      uploadState = "attached";
+      addLog(`Dataset held by the core: ${upload["dataset"]}`, "success");
+    } catch (error) {
+      console.error('Error uploading data:', error);
+      uploadState = "failed";
+      addLog('Could not upload to the core, sending the data to the trainer instead.', "info");
+      if (lastStatus === "PENDING_DATA_TRANSFER") {
+        send_data();
+      }
+    }
+  };
+
+  const send_chunk = async (uploadId, offset, chunk) => {
+    // Each chunk is gzip compressed on its own where the browser can
+    const headers = new Headers();
+    let body = chunk;
+    if (window.CompressionStream) {
+      body = await new Response(chunk.stream().pipeThrough(new CompressionStream("gzip"))).blob();
+      headers.append('Content-Encoding', 'gzip');
+    }
+
+    return fetch(`${BASE_URL}:${CORE_PORT}/api/uploads/${uploadId}?offset=${offset}`, {
+      method: 'PUT',
+      headers: headers,
+      body: body
+    });
+  };
+
+  const get_core_results = () => {
+    fetch(`${BASE_URL}:${CORE_PORT}/api/getresults/?token=${token}`)
+      .then(response => response.json())
+      .then(response => {
+        addLog(`Training Results: ${JSON.stringify(response["results"])}`, "success");
+      });
   };
 
   const send_data = () => {
@@ -93,37 +251,33 @@ const RunJob = ({ jobSpecification, dataFile, onBack }) => {
       .then(response => response.json())
       .then(response => {
         workerPort = response["workerPort"];
+        // Workers on other nodes come with their own URL, otherwise they are on our host
+        workerUrl = response["workerUrl"] || `${BASE_URL}:${workerPort}`;
         addLog(`WorkerPort: ${workerPort}`, "info");
 
-        // Create a FormData to send CSV content as text
-        const formData = new FormData();
-        
-        // Read the CSV file as text (using FileReader)
-        const reader = new FileReader();
-        reader.onload = function(event) {
-          formData.append("data_file", event.target.result);
-        
-          // Send the request with multipart/form-data, including the file content as text
-          fetch(`${BASE_URL}:${workerPort}/api/postData/`, {
-            method: 'POST',
-            mode: 'no-cors',
-            body: formData,
-          }).catch(error => {
-            console.error('Error sending data:', error);
-            addLog('Error sending data to the backend!', "error");
-          });
-        };
-
-        if (dataFile) {
-          reader.readAsText(dataFile);
-        } else {
+        if (!dataFile) {
           addLog("No file selected.", "error");
+          return;
         }
+
+        // Send the file itself with multipart/form-data, the trainer streams it to disk
+        // and works out whether it is CSV, Parquet, Arrow or NumPy from its name
+        const formData = new FormData();
+        formData.append("data_file", dataFile, dataFile.name);
+
+        fetch(`${workerUrl}/api/postDataFile/`, {
+          method: 'POST',
+          mode: 'no-cors',
+          body: formData,
+        }).catch(error => {
+          console.error('Error sending data:', error);
+          addLog('Error sending data to the backend!', "error");
+        });
       });
   };
 
   const get_results = () => {
-    fetch(`${BASE_URL}:${workerPort}/api/getResults`)
+    fetch(`${workerUrl}/api/getResults`)
       .then(response => response.json())
       .then(response => { 
         addLog(`Training Results: ${JSON.stringify(response)}`, "success");
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for storing trained models
+on local disk by the digest of their bytes, and for keeping
+the most recently used ones loaded for predictions.
+ """
+#----------------------------------
+#
+#
+from collections import OrderedDict
+from hashlib import sha256
+from tempfile import gettempdir
+import json
+import os
+import threading
+
+import joblib
+
+ARTIFACT_DIRECTORY = os.getenv('ARTIFACT_DIRECTORY', os.path.join(gettempdir(), 'ml-pipe-artifacts'))
+ARTIFACT_STORE_MAX_BYTES = int(os.getenv('ARTIFACT_STORE_MAX_BYTES', 1024 * 1024 * 1024))
+
+# zlib level from 0 to 9. Compressed models are smaller on disk, but are read
+# into memory as a whole, while uncompressed ones have their arrays memory mapped
+ARTIFACT_COMPRESSION = int(os.getenv('ARTIFACT_COMPRESSION', 0))
+
+# Models kept loaded between predictions
+HOT_MODEL_CACHE_SIZE = int(os.getenv('HOT_MODEL_CACHE_SIZE', 8))
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ArtifactStore():
+    """Trained models stored on local disk under the sha256 of their joblib dump, with
+    a JSON file of metadata next to each. The same model is only ever stored once.
+    Loading a model marks it as recently used and the least recently used models
+    are evicted once the store grows past its size limit.
+    """
+
+    def __init__(self, directory: str = ARTIFACT_DIRECTORY, max_bytes: int = ARTIFACT_STORE_MAX_BYTES, compression: int = ARTIFACT_COMPRESSION):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.__lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def put(self, model, metadata: dict) -> str:
+        """Stores a trained model
+
+        Args:
+            model (any): The trained model
+
+            metadata (dict): What is needed to use the model later, such as its feature columns
+
+        Returns:
+            str: The digest the model is stored under
+        """
+        # Dumped to the side, hashed, then moved into place so a reader never sees half a model
+        temporary_path = os.path.join(self.directory, f'{threading.get_ident()}.{os.getpid()}.tmp')
+        joblib.dump(model, temporary_path, compress=self.compression)
+        digest = _hash_file(temporary_path)
+
+        with self.__lock:
+            if os.path.exists(self.__model_path(digest)):
+                os.remove(temporary_path)
+                os.utime(self.__model_path(digest))
+                return digest
+
+            with open(self.__metadata_path(digest), 'w') as file:
+                json.dump({**metadata, 'compression': self.compression}, file, default=str)
+            os.replace(temporary_path, self.__model_path(digest))
+
+            self.__evict(keep=digest)
+
+        return digest
+
+
+    def load(self, digest: str) -> tuple[any, dict] | None:
+        """Loads a model and its metadata, None if the store does not hold it"""
+        metadata = self.get_metadata(digest)
+        if metadata is None:
+            return None
+
+        path = self.__model_path(digest)
+        with self.__lock:
+            try:
+                os.utime(path) # The modification time orders models for eviction
+            except FileNotFoundError:
+                return None
+
+        # The arrays of an uncompressed model are mapped from the file rather than copied
+        mmap_mode = 'r' if not metadata.get('compression') else None
+        return joblib.load(path, mmap_mode=mmap_mode), metadata
+
+
+    def get_metadata(self, digest: str) -> dict | None:
+        # Digests are hex, anything else can't be in the store
+        if not digest or not all(character in '0123456789abcdef' for character in digest):
+            return None
+
+        try:
+            with open(self.__metadata_path(digest)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+
+    def stats(self) -> dict:
+        with self.__lock:
+            entries = self.__entries()
+            return {'models': len(entries),
+                    'bytes': sum(size for _, size, _ in entries)
+                    }
+
+
+    def __evict(self, keep: str):
+        entries = sorted(self.__entries(), key=lambda entry: entry[2])
+        total_bytes = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if path == self.__model_path(keep):
+                continue
+
+            os.remove(path)
+            os.remove(path[:-len('.joblib')] + '.json')
+            total_bytes -= size
+
+
+    def __entries(self) -> list[tuple[str, int, float]]:
+        entries = []
+        with os.scandir(self.directory) as directory_entries:
+            for entry in directory_entries:
+                if entry.name.endswith('.joblib'):
+                    stat = entry.stat()
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+
+        return entries
+
+
+    def __model_path(self, digest: str) -> str:
+        return os.path.join(self.directory, f'{digest}.joblib')
+
+
+    def __metadata_path(self, digest: str) -> str:
+        return os.path.join(self.directory, f'{digest}.json')
+
+
+class HotModelCache():
+    """The most recently used models kept loaded, so repeated predictions
+    don't pay for reading the model from disk each time
+    """
+
+    def __init__(self, artifact_store: ArtifactStore, max_models: int = HOT_MODEL_CACHE_SIZE):
+        self.artifact_store = artifact_store
+        self.max_models = max_models
+        self.hits = 0
+        self.misses = 0
+        self.__models = OrderedDict()
+        self.__lock = threading.Lock()
+
+
+    def get(self, digest: str) -> tuple[any, dict] | None:
+        """The model and its metadata, loaded from the artifact store on first use"""
+        with self.__lock:
+            if digest in self.__models:
+                self.__models.move_to_end(digest)
+                self.hits += 1
+                return self.__models[digest]
+            self.misses += 1
+
+        # Loaded outside the lock, two threads loading the same model at once just both load it
+        loaded = self.artifact_store.load(digest)
+        if loaded is None:
+            return None
+
+        with self.__lock:
+            self.__models[digest] = loaded
+            self.__models.move_to_end(digest)
+            while len(self.__models) > self.max_models:
+                self.__models.popitem(last=False)
+
+        return loaded
+
+
+def _hash_file(path: str) -> str:
+    digest = sha256()
+    with open(path, 'rb') as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+ARTIFACT_STORE = ArtifactStore()
+HOT_MODELS = HotModelCache(ARTIFACT_STORE)
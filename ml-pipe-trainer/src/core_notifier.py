@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for reporting to the core
+from the background, retrying reports that fail.
+ """
+#----------------------------------
+#
+#
+from queue import Queue
+from time import sleep
+import os
+import threading
+
+import requests
+
+from src.metrics import METRICS
+
+# Where the core listens for our reports, the docker host unless we were started some other way
+CORE_URL = os.getenv('CORE_URL', 'http://host.docker.internal:8000')
+
+NOTIFY_ATTEMPTS = int(os.getenv('NOTIFY_ATTEMPTS', 6))
+NOTIFY_BACKOFF_SECONDS = 0.5
+NOTIFY_MAX_BACKOFF_SECONDS = 30
+NOTIFY_TIMEOUT_SECONDS = 10
+
+NOTIFICATIONS = METRICS.counter('ml_pipe_trainer_core_notifications_total', 'Reports sent to the core, by whether the core got them', ('outcome',))
+
+
+class CoreNotifier():
+    """Sends reports to the core one after another on a thread of its own, so the
+    caller never waits on the core. A report the core does not accept is retried
+    with exponential backoff, reports are kept in the order they were made.
+    """
+
+    def __init__(self, core_url: str = CORE_URL, attempts: int = NOTIFY_ATTEMPTS):
+        self.core_url = core_url
+        self.attempts = attempts
+        self.__queue = Queue()
+        self.__http = requests.Session()
+        self.__thread = None
+        self.__lock = threading.Lock()
+
+
+    def notify(self, path: str, token: str | None):
+        """Queues a report, for example notify('/api/postfinishedtraining/', token)"""
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='core-notifier', daemon=True)
+                self.__thread.start()
+
+        self.__queue.put((path, token))
+
+
+    def join(self):
+        """Waits until every queued report has been sent or given up on"""
+        self.__queue.join()
+
+
+    def __run(self):
+        while True:
+            path, token = self.__queue.get()
+            try:
+                self.__send(path, token)
+            finally:
+                self.__queue.task_done()
+
+
+    def __send(self, path: str, token: str | None):
+        backoff = NOTIFY_BACKOFF_SECONDS
+        for attempt in range(1, self.attempts + 1):
+            try:
+                response = self.__http.post(f'{self.core_url}{path}', json={'session_token': token}, timeout=NOTIFY_TIMEOUT_SECONDS)
+                if response.ok:
+                    NOTIFICATIONS.inc(outcome='sent')
+                    return
+                error = f'HTTP {response.status_code}'
+            except requests.RequestException as e:
+                error = str(e)
+
+            print(f'Report {path} for {token} failed on attempt {attempt}/{self.attempts}: {error}')
+            if attempt < self.attempts:
+                NOTIFICATIONS.inc(outcome='retried')
+                sleep(backoff)
+                backoff = min(backoff * 2, NOTIFY_MAX_BACKOFF_SECONDS)
+
+        NOTIFICATIONS.inc(outcome='failed')
+
+
+CORE_NOTIFIER = CoreNotifier()
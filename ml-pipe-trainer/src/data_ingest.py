@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for receiving uploaded
+datasets and loading them into a DataFrame.
+ """
+#----------------------------------
+#
+#
+from hashlib import sha256
+import os
+from tempfile import mkstemp
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from src.metrics import METRICS, STAGE_SECONDS
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Whole and chunked CSV reads parse with the same engine and options, so a dataset gets the same dtypes either way.
+# Like pandas, strings such as NA and null are read as missing
+CSV_CONVERT_OPTIONS = pa.csv.ConvertOptions(strings_can_be_null = True) if pa is not None else None
+
+UPLOAD_DIRECTORY = os.getenv('UPLOAD_DIRECTORY', None) # None uses the system temp directory
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# The core's dataset store when it is mounted or on the same host, datasets in it are named by their sha256
+CORE_DATASET_DIRECTORY = os.getenv('CORE_DATASET_DIRECTORY', None)
+
+BYTES_RECEIVED = METRICS.counter('ml_pipe_trainer_dataset_bytes_received_total', 'Bytes of datasets uploaded to this trainer')
+
+# Supported dataset formats by content type, file extension and leading magic bytes
+CONTENT_TYPE_FORMATS = {'text/csv': 'csv',
+                        'application/csv': 'csv',
+                        'application/vnd.apache.parquet': 'parquet',
+                        'application/x-parquet': 'parquet',
+                        'application/vnd.apache.arrow.file': 'arrow',
+                        'application/vnd.apache.arrow.stream': 'arrow_stream',
+                        'application/x-npy': 'npy',
+                        'application/x-npz': 'npz'
+                        }
+
+FILE_EXTENSION_FORMATS = {'.csv': 'csv',
+                          '.parquet': 'parquet',
+                          '.arrow': 'arrow',
+                          '.feather': 'arrow',
+                          '.arrows': 'arrow_stream',
+                          '.npy': 'npy',
+                          '.npz': 'npz'
+                          }
+
+MAGIC_BYTES_FORMATS = {b'PAR1': 'parquet',
+                       b'ARROW1': 'arrow',
+                       b'\x93NUMPY': 'npy',
+                       b'PK\x03\x04': 'npz'
+                       }
+
+NPZ_INDEX_KEY = 'index'
+
+
+def detect_format(content_type: str | None, file_name: str | None = None, path: str | None = None) -> str:
+    """Works out the format of an uploaded dataset from its content type, falling
+    back to its file extension and then to the magic bytes at the start of the file.
+
+    Args:
+        content_type (str | None): Content type the dataset was uploaded with
+
+        file_name (str | None): Name of the uploaded file
+
+        path (str | None): Path of the received dataset
+
+    Raises:
+        ValueError: An error will appear when the format is not supported
+
+    Returns:
+        str: The dataset format
+    """
+    if content_type is not None:
+        data_format = CONTENT_TYPE_FORMATS.get(content_type.split(';')[0].strip().lower())
+        if data_format is not None:
+            return data_format
+
+    if file_name is not None:
+        data_format = FILE_EXTENSION_FORMATS.get(os.path.splitext(file_name)[1].lower())
+        if data_format is not None:
+            return data_format
+
+    if path is not None:
+        with open(path, 'rb') as file:
+            header = file.read(8)
+        for magic_bytes, data_format in MAGIC_BYTES_FORMATS.items():
+            if header.startswith(magic_bytes):
+                return data_format
+
+        # Anything else that decodes as text is treated as a CSV
+        try:
+            header.decode('utf-8')
+            return 'csv'
+        except UnicodeDecodeError:
+            pass
+
+    raise ValueError(f'Unsupported dataset format {content_type} {file_name}')
+
+
+async def receive_upload(chunks) -> tuple[str, str]:
+    """Streams an upload to a file on disk chunk by chunk so it is never held
+    in memory as a whole, hashing it on the way.
+
+    Args:
+        chunks (AsyncIterable[bytes]): The upload, for example Request.stream()
+
+    Returns:
+        tuple[str, str]: Path of the file the upload was written to, and its sha256 hex digest
+    """
+    digest = sha256()
+    file_descriptor, path = mkstemp(prefix='dataset-', dir=UPLOAD_DIRECTORY)
+    try:
+        with STAGE_SECONDS.time(stage='upload'), os.fdopen(file_descriptor, 'wb') as file:
+            async for chunk in chunks:
+                file.write(chunk)
+                digest.update(chunk)
+                BYTES_RECEIVED.inc(len(chunk))
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return path, digest.hexdigest()
+
+
+def core_dataset_path(digest: str) -> str | None:
+    """Path of a dataset in the core's dataset store, None when this trainer can't see it
+
+    Args:
+        digest (str): sha256 hex digest the core stores the dataset under
+
+    Returns:
+        str | None: Path of the dataset
+    """
+    # Anything but a digest could name a file outside the store
+    if CORE_DATASET_DIRECTORY is None or len(digest) != 64 or any(character not in '0123456789abcdef' for character in digest):
+        return None
+
+    path = os.path.join(CORE_DATASET_DIRECTORY, digest)
+    return path if os.path.isfile(path) else None
+
+
+async def iterate_upload_file(upload_file, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    """Reads a multipart UploadFile in chunks for receive_upload"""
+    while chunk := await upload_file.read(chunk_size):
+        yield chunk
+
+
+def load_dataset(path: str, data_format: str) -> DataFrame:
+    """Loads a dataset from disk. Arrow and Parquet files are memory mapped and
+    NumPy files are opened with mmap_mode, so columns are not copied where the
+    format allows it. The first column is used as the index, as with a CSV.
+
+    Args:
+        path (str): Path of the dataset
+
+        data_format (str): One of the formats returned by detect_format
+
+    Raises:
+        ValueError: An error will appear when the format is not supported or pyarrow is missing
+
+    Returns:
+        DataFrame: The dataset
+    """
+    match data_format:
+        case 'csv':
+            if pa is None:
+                return pd.read_csv(path, index_col = 0)
+            return _arrow_table_to_frame(pa.csv.read_csv(path, convert_options = CSV_CONVERT_OPTIONS))
+        case 'parquet':
+            _require_pyarrow(data_format)
+            return _arrow_table_to_frame(pq.read_table(path, memory_map = True))
+        case 'arrow':
+            _require_pyarrow(data_format)
+            with pa.memory_map(path) as source:
+                return _arrow_table_to_frame(pa.ipc.open_file(source).read_all())
+        case 'arrow_stream':
+            _require_pyarrow(data_format)
+            with pa.memory_map(path) as source:
+                return _arrow_table_to_frame(pa.ipc.open_stream(source).read_all())
+        case 'npy':
+            return _records_to_frame(_load_records(path))
+        case 'npz':
+            return _load_npz(path)
+        case _:
+            raise ValueError(f'Unsupported dataset format {data_format}')
+
+
+def iterate_dataset_chunks(path: str, data_format: str, chunk_rows: int):
+    """Reads a dataset from disk a chunk of rows at a time, so only one chunk is
+    in memory at once. CSVs are read in chunks, Parquet by row group batches, Arrow
+    by record batches and .npy by slices of the memory map. A .npz can't be memory
+    mapped so it is loaded whole and then sliced.
+
+    CSVs are parsed as load_dataset parses them, with the column types taken from
+    the first block of the file.
+
+    Args:
+        path (str): Path of the dataset
+
+        data_format (str): One of the formats returned by detect_format
+
+        chunk_rows (int): Most rows in one chunk
+
+    Raises:
+        ValueError: An error will appear when the format is not supported, or a later CSV row does not fit the column types
+
+    Yields:
+        DataFrame: The next chunk of the dataset
+    """
+    match data_format:
+        case 'csv':
+            if pa is None:
+                with pd.read_csv(path, index_col = 0, chunksize = chunk_rows) as chunks:
+                    yield from chunks
+            else:
+                yield from _iterate_csv_chunks(path, chunk_rows)
+        case 'parquet':
+            _require_pyarrow(data_format)
+            for batch in pq.ParquetFile(path, memory_map = True).iter_batches(batch_size = chunk_rows):
+                yield _arrow_table_to_frame(pa.Table.from_batches([batch]))
+        case 'arrow' | 'arrow_stream':
+            _require_pyarrow(data_format)
+            with pa.memory_map(path) as source:
+                reader = pa.ipc.open_file(source) if data_format == 'arrow' else pa.ipc.open_stream(source)
+                batches = (reader.get_batch(i) for i in range(reader.num_record_batches)) if data_format == 'arrow' else reader
+                for batch in batches:
+                    for offset in range(0, batch.num_rows, chunk_rows):
+                        yield _arrow_table_to_frame(pa.Table.from_batches([batch.slice(offset, chunk_rows)]))
+        case 'npy':
+            records = _load_records(path)
+            for offset in range(0, len(records), chunk_rows):
+                yield _records_to_frame(records[offset:offset + chunk_rows])
+        case 'npz':
+            yield from iterate_frame_chunks(_load_npz(path), chunk_rows)
+        case _:
+            raise ValueError(f'Unsupported dataset format {data_format}')
+
+
+def iterate_frame_chunks(df: DataFrame, chunk_rows: int):
+    """Chunks of a DataFrame already in memory, as iterate_dataset_chunks. Each chunk
+    is a copy so preprocessing it in place leaves the DataFrame untouched.
+    """
+    for offset in range(0, len(df), chunk_rows):
+        yield df.iloc[offset:offset + chunk_rows].copy()
+
+
+class DatasetFile():
+    """A received dataset on disk that is only read when it is needed, either
+    whole or a chunk at a time
+    """
+
+    def __init__(self, path: str, data_format: str):
+        self.path = path
+        self.data_format = data_format
+
+
+    def load(self) -> DataFrame:
+        return load_dataset(self.path, self.data_format)
+
+
+    def iterate_chunks(self, chunk_rows: int):
+        return iterate_dataset_chunks(self.path, self.data_format, chunk_rows)
+
+
+def _load_records(path: str) -> np.ndarray:
+    # A structured array, its first field is the index
+    records = np.load(path, mmap_mode = 'r', allow_pickle = False)
+    if records.dtype.names is None:
+        raise ValueError('A .npy dataset must be a structured array with named fields')
+    return records
+
+
+def _records_to_frame(records: np.ndarray) -> DataFrame:
+    index_name, *column_names = records.dtype.names
+    df = DataFrame({name: records[name] for name in column_names}, index = records[index_name], copy = False)
+    df.index.name = index_name
+    return df
+
+
+def _load_npz(path: str) -> DataFrame:
+    # One array per column, the "index" array (or else the first one) is the index
+    with np.load(path, allow_pickle = False) as arrays:
+        names = list(arrays.files)
+        index_name = NPZ_INDEX_KEY if NPZ_INDEX_KEY in names else names[0]
+        columns = {name: arrays[name] for name in names if name != index_name}
+        return DataFrame(columns, index = arrays[index_name], copy = False)
+
+
+def _iterate_csv_chunks(path: str, chunk_rows: int):
+    # The streaming reader yields blocks of bytes, they are gathered into chunks of chunk_rows rows
+    reader = pa.csv.open_csv(path, convert_options = CSV_CONVERT_OPTIONS)
+    batches, rows = [], 0
+    try:
+        for batch in reader:
+            batches.append(batch)
+            rows += batch.num_rows
+            while rows >= chunk_rows:
+                table = pa.Table.from_batches(batches)
+                yield _arrow_table_to_frame(table.slice(0, chunk_rows))
+                rest = table.slice(chunk_rows)
+                batches, rows = rest.to_batches(), rest.num_rows
+    except pa.ArrowInvalid as e:
+        raise ValueError(f'CSV dataset does not fit the column types of its first rows: {e}')
+
+    if rows:
+        yield _arrow_table_to_frame(pa.Table.from_batches(batches, schema = reader.schema))
+
+
+def _require_pyarrow(data_format: str):
+    if pa is None:
+        raise ValueError(f'pyarrow is required to load {data_format} datasets')
+
+
+def _arrow_table_to_frame(table) -> DataFrame:
+    # Keep an index pandas wrote as a column, otherwise use the first column like a CSV
+    pandas_metadata = table.schema.pandas_metadata or {}
+    has_pandas_index = any(isinstance(column, str) for column in pandas_metadata.get('index_columns', []))
+    df = table.to_pandas(split_blocks = True, self_destruct = True)
+    if not has_pandas_index:
+        df = df.set_index(df.columns[0])
+
+    return df
@@ -10,10 +10,20 @@ data manipulation tasks.
 #----------------------------------
 # 
 #
+import json
 import numpy as np
 import pandas as pd
 from pandas import DataFrame
 
+DATASET_SPLITS = ('training', 'validation', 'testing')
+
+# Cross validation types scored over several folds of the rows rather than one split by year
+FOLD_CROSS_VALIDATION_TYPES = ('rollingOrigin', 'kFold', 'blockedKFold')
+DEFAULT_FOLDS = 5
+
+# Seed of a kFold shuffle that does not give one, so the same spec always makes the same folds
+DEFAULT_FOLD_SEED = 0
+
 def cross_validation(df: DataFrame, cross_validation_information: dict):
     if cross_validation_information['type'] == 'year':
         return split_dataset_by_year(df, cross_validation_information)
@@ -37,8 +47,259 @@ def split_dataset_by_year(df: DataFrame, cross_validation_information: dict):
     return dataset
 
 
+def is_fold_cross_validation(cross_validation_information: dict) -> bool:
+    return cross_validation_information['type'] in FOLD_CROSS_VALIDATION_TYPES
+
+
+def get_fold_positions(cross_validation_information: dict, n_rows: int) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Works out the rows each fold trains and tests on, as sorted row positions. Rows
+    are taken to be in time order, as they are for the time series preprocessing tasks.
+
+        {'type': 'rollingOrigin', 'folds': 5, 'testRows': 1000, 'gap': 0, 'maxTrainRows': None}
+            Tests on consecutive blocks of testRows at the end of the rows, each fold training
+            on every row before its block, or on the last maxTrainRows of them for a rolling window.
+            testRows defaults to an even share of the rows between the folds and a first training block
+        {'type': 'kFold', 'folds': 5, 'shuffle': True, 'seed': 0}
+            Tests on a share of the rows each, drawn at random unless shuffle is False. The seed
+            defaults to DEFAULT_FOLD_SEED, so folds can be worked out again and results cached
+        {'type': 'blockedKFold', 'folds': 5, 'gap': 0}
+            Tests on contiguous blocks, training on the rest
+
+    gap rows next to a testing block are left out of the training rows, so features
+    looking at neighbouring rows don't leak what is being tested.
+
+    Args:
+        cross_validation_information (dict): The crossValidation section of the model definition
+
+        n_rows (int): Rows in the dataset
+
+    Raises:
+        ValueError: An error will appear when the rows can't be split into the folds asked for
+
+    Returns:
+        list[tuple[np.ndarray, np.ndarray]]: The training and testing positions of each fold
+    """
+    cross_validation_type = cross_validation_information['type']
+    folds = int(cross_validation_information.get('folds', DEFAULT_FOLDS))
+    gap = int(cross_validation_information.get('gap', 0))
+    if folds < (1 if cross_validation_type == 'rollingOrigin' else 2) or gap < 0:
+        raise ValueError(f'Unsupported folds {folds} or gap {gap} for {cross_validation_type} cross validation')
+    if n_rows < folds:
+        raise ValueError(f'{n_rows} rows can not be split into {folds} folds')
+
+    if cross_validation_type == 'rollingOrigin':
+        test_rows = int(cross_validation_information.get('testRows') or n_rows // (folds + 1))
+        first_test_row = n_rows - folds * test_rows
+        if test_rows < 1 or first_test_row - gap < 1:
+            raise ValueError(f'{n_rows} rows leave no training rows for {folds} folds of {test_rows} testing rows')
+
+        max_train_rows = cross_validation_information.get('maxTrainRows')
+        fold_positions = []
+        for test_start in range(first_test_row, n_rows, test_rows):
+            train_end = test_start - gap
+            train_start = max(0, train_end - int(max_train_rows)) if max_train_rows else 0
+            fold_positions.append((np.arange(train_start, train_end), np.arange(test_start, test_start + test_rows)))
+
+        return fold_positions
+
+    if cross_validation_type == 'kFold':
+        positions = np.arange(n_rows)
+        if cross_validation_information.get('shuffle', True):
+            positions = np.random.default_rng(cross_validation_information.get('seed', DEFAULT_FOLD_SEED)).permutation(n_rows)
+        test_blocks = [np.sort(test_positions) for test_positions in np.array_split(positions, folds)]
+        gap = 0
+    elif cross_validation_type == 'blockedKFold':
+        test_blocks = np.array_split(np.arange(n_rows), folds)
+    else:
+        raise ValueError(f'Unsupported cross validation type {cross_validation_type}')
+
+    fold_positions = []
+    for test_positions in test_blocks:
+        training = np.ones(n_rows, dtype=bool)
+        training[test_positions] = False
+        if gap:
+            training[max(0, test_positions[0] - gap):test_positions[-1] + 1 + gap] = False
+        if not training.any():
+            raise ValueError(f'A gap of {gap} rows leaves no training rows for {folds} folds of {n_rows} rows')
+        fold_positions.append((np.flatnonzero(training), test_positions))
+
+    return fold_positions
+
+
+def take_rows(values: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """The rows of values at sorted positions, a view without a copy when they are contiguous"""
+    if len(positions) and positions[-1] - positions[0] + 1 == len(positions):
+        return values[positions[0]:positions[-1] + 1]
+
+    return values[positions]
+
+
 def get_XY(df, target_features):
     y = np.array(df[target_features]).ravel()
     X = np.array(df.drop(target_features, axis=1))
 
-    return X, y
\ No newline at end of file
+    return X, y
+
+
+def split_key(cross_validation_information: dict, target_features: list) -> tuple:
+    """Key identifying one split of a dataset, specs that only differ in key order match"""
+    return (json.dumps(cross_validation_information, sort_keys=True), tuple(target_features))
+
+
+class SplitCache():
+    """Per job cache of the cross validation splits of a dataset. Each split is
+    built once per (crossValidation spec, target) as contiguous X/y matrices and
+    is then reused by every model that asks for it.
+    """
+
+    def __init__(self, df: DataFrame | None):
+        self.df = df
+
+        # Years mapped to the row positions that fall in them, and the feature
+        # matrices of the whole dataset per target, both built on first use
+        self.__year_positions = None
+        self.__feature_matrices = {}
+
+        self.splits = {}
+
+        # Split keys mapped to the names of the columns of X, in order, and to the row positions of each split
+        self.feature_names = {}
+        self.__split_positions = {}
+
+        # Split keys of fold cross validation mapped to the training and testing positions of each fold
+        self.__fold_positions = {}
+
+
+    def get_split(self, cross_validation_information: dict, target_features: list) -> dict:
+        """Gets the X/y matrices of every split for a model
+
+        Args:
+            cross_validation_information (dict): The crossValidation section of the model definition
+
+            target_features (list): The target section of the model definition
+
+        Returns:
+            dict: 'training', 'validation' and 'testing' mapped to (X, y), 'validation' may be None.
+            With fold cross validation 'training' is every row and the folds come from get_folds
+        """
+        key = split_key(cross_validation_information, target_features)
+        split = self.splits.get(key)
+        if split is None:
+            split, self.__split_positions[key] = self.__build_split(cross_validation_information, target_features)
+            self.splits[key] = split
+            self.feature_names[key] = [column for column in self.df.columns if column not in target_features]
+
+        return split
+
+
+    def get_folds(self, cross_validation_information: dict, target_features: list) -> list[tuple[np.ndarray, np.ndarray]]:
+        """The training and testing row positions of each fold of a split built by get_split,
+        into its 'training' X/y. Worked out again from the number of rows where the split was
+        shared with a worker process, so only the matrices themselves are ever shared.
+        """
+        key = split_key(cross_validation_information, target_features)
+        if key not in self.__fold_positions:
+            n_rows = len(self.get_split(cross_validation_information, target_features)['training'][1])
+            self.__fold_positions[key] = get_fold_positions(cross_validation_information, n_rows)
+
+        return self.__fold_positions[key]
+
+
+    def get_feature_names(self, cross_validation_information: dict, target_features: list) -> list:
+        """The names of the columns of X in a split built by get_split"""
+        return self.feature_names[split_key(cross_validation_information, target_features)]
+
+
+    def get_index(self, cross_validation_information: dict, target_features: list, split_name: str):
+        """The index of the dataset rows in one split built by get_split, in the order of its X/y rows.
+        With fold cross validation 'testing' is the testing rows of every fold, one fold after another
+        """
+        key = split_key(cross_validation_information, target_features)
+        if split_name == 'testing' and is_fold_cross_validation(cross_validation_information):
+            return self.df.index[np.concatenate([test_positions for _, test_positions in self.get_folds(cross_validation_information, target_features)])]
+
+        return self.df.index[self.__split_positions[key][split_name]]
+
+
+    def to_arrays(self) -> tuple[dict, dict]:
+        """Flattens the cached splits so they can be shared with worker processes
+
+        Returns:
+            tuple[dict, dict]: The layout of the splits with their feature names, and the arrays keyed by name
+        """
+        layout, arrays = {}, {}
+        for split_number, (key, split) in enumerate(self.splits.items()):
+            layout[key] = (split_number, self.feature_names[key])
+            for split_name, XY in split.items():
+                if XY is not None:
+                    arrays[f'{split_number}.{split_name}.X'], arrays[f'{split_number}.{split_name}.y'] = XY
+
+        return layout, arrays
+
+
+    @classmethod
+    def from_arrays(cls, layout: dict, arrays: dict) -> 'SplitCache':
+        """Rebuilds a cache from to_arrays, the dataset itself is not needed"""
+        split_cache = cls(None)
+        for key, (split_number, feature_names) in layout.items():
+            split_cache.feature_names[key] = feature_names
+            split_cache.splits[key] = {split_name: (arrays[f'{split_number}.{split_name}.X'], arrays[f'{split_number}.{split_name}.y'])
+                                       if f'{split_number}.{split_name}.X' in arrays else None
+                                       for split_name in DATASET_SPLITS}
+
+        return split_cache
+
+
+    def __build_split(self, cross_validation_information: dict, target_features: list) -> tuple[dict, dict]:
+        X, y = self.__get_feature_matrices(target_features)
+
+        if is_fold_cross_validation(cross_validation_information):
+            # The folds are positions into the matrices, no rows are copied until a fold is trained
+            self.__fold_positions[split_key(cross_validation_information, target_features)] = get_fold_positions(cross_validation_information, len(y))
+            return {'training': (X, y), 'validation': None, 'testing': None}, {'training': np.arange(len(y))}
+
+        if cross_validation_information['type'] != 'year':
+            raise ValueError(f'Unsupported cross validation type {cross_validation_information["type"]}')
+
+        split, split_positions = {}, {}
+        for split_name in DATASET_SPLITS:
+            years = cross_validation_information.get(f'{split_name}Years')
+            if years is None:
+                split[split_name] = None
+            else:
+                positions = self.__get_year_positions(years)
+                split[split_name] = (X[positions], y[positions])
+                split_positions[split_name] = positions
+
+        return split, split_positions
+
+
+    def __get_feature_matrices(self, target_features: list) -> tuple[np.ndarray, np.ndarray]:
+        key = tuple(target_features)
+        if key not in self.__feature_matrices:
+            y = np.ascontiguousarray(self.df[target_features].to_numpy()).ravel()
+
+            features = self.df.drop(target_features, axis=1)
+            try:
+                X = np.ascontiguousarray(features.to_numpy(dtype=np.float64))
+            except (TypeError, ValueError):
+                X = np.ascontiguousarray(features.to_numpy())
+
+            self.__feature_matrices[key] = (X, y)
+
+        return self.__feature_matrices[key]
+
+
+    def __get_year_positions(self, years: list) -> np.ndarray:
+        if self.__year_positions is None:
+            # Sort the rows by year once, then each year is a contiguous run found by searchsorted
+            row_years = pd.to_datetime(self.df.index).year.to_numpy()
+            order = np.argsort(row_years, kind='stable')
+            self.__year_positions = (row_years[order], order)
+
+        sorted_years, order = self.__year_positions
+        starts = np.searchsorted(sorted_years, years, side='left')
+        ends = np.searchsorted(sorted_years, years, side='right')
+
+        # Rows stay in their original order, as with a boolean mask
+        return np.sort(np.concatenate([order[start:end] for start, end in zip(starts, ends)] + [np.empty(0, dtype=order.dtype)]))
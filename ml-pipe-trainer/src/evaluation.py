@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for scoring the
+predictions of a model with a set of metrics.
+ """
+#----------------------------------
+#
+#
+import numpy as np
+
+REGRESSION_METRICS = ('r2', 'mae', 'mse', 'rmse', 'mape', 'medianAbsoluteError', 'maxError', 'meanError')
+CLASSIFICATION_METRICS = ('accuracy', 'balancedAccuracy', 'precisionMacro', 'recallMacro', 'f1Macro')
+
+# Named sets a model definition can ask for instead of listing metrics one by one
+METRIC_SETS = {'score': (),
+               'regression': ('r2', 'mae', 'rmse', 'maxError'),
+               'classification': ('accuracy', 'balancedAccuracy', 'f1Macro'),
+               'all': REGRESSION_METRICS + CLASSIFICATION_METRICS
+               }
+
+
+def get_metric_names(prediction_problem: str, metrics: str | list | None) -> list:
+    """Works out the metrics a model definition asks for
+
+    Args:
+        prediction_problem (str): 'regression' or 'classification'
+
+        metrics (str | list | None): The metrics section of the model definition, the
+        name of a metric set or a list of metric and metric set names
+
+    Raises:
+        ValueError: An error will appear when a metric does not exist for the prediction problem
+
+    Returns:
+        list: The names of the metrics, without repeats
+    """
+    supported_metrics = REGRESSION_METRICS if prediction_problem == 'regression' else CLASSIFICATION_METRICS
+
+    metric_names = []
+    for name in ([metrics] if isinstance(metrics, str) else metrics or []):
+        if name in METRIC_SETS:
+            # Sets such as 'all' hold the metrics of both prediction problems
+            names = [metric for metric in METRIC_SETS[name] if metric in supported_metrics]
+        elif name in supported_metrics:
+            names = [name]
+        else:
+            raise ValueError(f'Unsupported {prediction_problem} metric {name}')
+
+        metric_names.extend(name for name in names if name not in metric_names)
+
+    return metric_names
+
+
+def evaluate_predictions(prediction_problem: str, y_true: np.ndarray, y_pred: np.ndarray, metric_names: list) -> dict:
+    """Scores predictions with every asked for metric. The residuals, or for
+    classification the confusion matrix, are worked out once and every metric
+    is computed from them.
+
+    Args:
+        prediction_problem (str): 'regression' or 'classification'
+
+        y_true (np.ndarray): The true targets
+
+        y_pred (np.ndarray): The predicted targets
+
+        metric_names (list): Metrics from get_metric_names
+
+    Returns:
+        dict: 'score', which matches model.score, and each metric by name
+    """
+    if prediction_problem == 'classification':
+        return _evaluate_classification(y_true, y_pred, metric_names)
+
+    return _evaluate_regression(y_true, y_pred, metric_names)
+
+
+def _evaluate_regression(y_true: np.ndarray, y_pred: np.ndarray, metric_names: list) -> dict:
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+
+    count = len(y_true)
+    if count == 0:
+        return {'score': float('nan'), **{name: float('nan') for name in metric_names}}
+
+    residuals = y_pred - y_true
+    sum_squared_error = float(np.dot(residuals, residuals))
+    centered = y_true - y_true.mean()
+    total_sum_of_squares = float(np.dot(centered, centered))
+
+    # As sklearn's r2_score, a constant target scores 1 when predicted exactly and 0 otherwise
+    if total_sum_of_squares == 0:
+        r2 = 1.0 if sum_squared_error == 0 else 0.0
+    else:
+        r2 = 1 - sum_squared_error / total_sum_of_squares
+
+    absolute_residuals = np.abs(residuals) if set(metric_names) & {'mae', 'mape', 'medianAbsoluteError', 'maxError'} else None
+
+    metrics = {'score': r2}
+    for name in metric_names:
+        match name:
+            case 'r2':
+                metrics[name] = r2
+            case 'mae':
+                metrics[name] = float(absolute_residuals.mean())
+            case 'mse':
+                metrics[name] = sum_squared_error / count
+            case 'rmse':
+                metrics[name] = float(np.sqrt(sum_squared_error / count))
+            case 'mape':
+                # As sklearn, zero targets are divided by machine epsilon rather than left out
+                metrics[name] = float(np.mean(absolute_residuals / np.maximum(np.abs(y_true), np.finfo(np.float64).eps)))
+            case 'medianAbsoluteError':
+                metrics[name] = float(np.median(absolute_residuals))
+            case 'maxError':
+                metrics[name] = float(absolute_residuals.max())
+            case 'meanError':
+                metrics[name] = float(residuals.mean())
+
+    return metrics
+
+
+def _evaluate_classification(y_true: np.ndarray, y_pred: np.ndarray, metric_names: list) -> dict:
+    count = len(y_true)
+    if count == 0:
+        return {'score': float('nan'), **{name: float('nan') for name in metric_names}}
+
+    accuracy = float(np.count_nonzero(y_true == y_pred)) / count
+    metrics = {'score': accuracy}
+    if not metric_names:
+        return metrics
+
+    # Confusion matrix of every class seen in either array, counted with one bincount
+    classes, encoded = np.unique(np.concatenate([y_true, y_pred]), return_inverse=True)
+    class_count = len(classes)
+    confusion = np.bincount(encoded[:count] * class_count + encoded[count:], minlength=class_count * class_count).reshape(class_count, class_count)
+
+    true_positives = np.diag(confusion).astype(np.float64)
+    support = confusion.sum(axis=1)
+    predicted = confusion.sum(axis=0)
+
+    # Classes never predicted, or never present, score 0 rather than dividing by zero
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predicted > 0, true_positives / predicted, 0.0)
+        recall = np.where(support > 0, true_positives / support, 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+    for name in metric_names:
+        match name:
+            case 'accuracy':
+                metrics[name] = accuracy
+            case 'balancedAccuracy':
+                metrics[name] = float(recall[support > 0].mean())
+            case 'precisionMacro':
+                metrics[name] = float(precision.mean())
+            case 'recallMacro':
+                metrics[name] = float(recall.mean())
+            case 'f1Macro':
+                metrics[name] = float(f1.mean())
+
+    return metrics
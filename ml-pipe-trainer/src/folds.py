@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for scoring a model
+over the folds of a cross validation, in parallel.
+ """
+#----------------------------------
+#
+#
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+import multiprocessing
+import os
+
+import numpy as np
+
+from src.progress import JobProgress
+from src.shared_dataset import SharedArrays, share_arrays
+
+
+class FoldEvaluation():
+    """Scores a model definition on every fold of its cross validation. Each fold
+    fits a model of its own on the fold's training rows and scores its predictions
+    of the fold's testing rows. Folds are fitted at the same time in worker processes,
+    which map the X/y matrices and the fold positions from shared memory and take each
+    fold's rows by position.
+
+    The crossValidation section may limit the worker processes with 'maxWorkers'.
+    """
+
+    def __init__(self, model_definition: dict, dataset: dict, folds: list, metric_names: list, evaluate_fold, progress: JobProgress | None = None):
+        """
+        Args:
+            model_definition (dict): The model definition to score
+
+            dataset (dict): The split of the model, with every row in dataset['training']
+
+            folds (list): The training and testing row positions of each fold
+
+            metric_names (list): Metrics from get_metric_names
+
+            evaluate_fold (Callable): evaluate_fold(model_definition, dataset, fold_positions, metric_names, return_predictions)
+            fits a model on one fold and returns its metrics and, if asked for, its predictions
+
+            progress (JobProgress | None): Checked for cancellation before each fold, or before the folds when they run in parallel
+        """
+        self.model_definition = model_definition
+        self.dataset = dataset
+        self.folds = folds
+        self.metric_names = metric_names
+        self.evaluate_fold = evaluate_fold
+        self.progress = progress if progress is not None else JobProgress()
+        self.return_predictions = bool(model_definition.get('returnPredictions'))
+
+
+    def run(self) -> dict:
+        """Scores every fold
+
+        Returns:
+            dict: 'score' and each metric averaged over the folds, 'scoreStd', the per fold
+            results under 'folds', and the predictions of every testing row if asked for
+        """
+        with self.__fold_executor() as executor:
+            if executor is None:
+                fold_results = []
+                for fold_positions in self.folds:
+                    self.progress.check_cancelled()
+                    fold_results.append(self.evaluate_fold(self.model_definition, self.dataset, fold_positions, self.metric_names, self.return_predictions))
+            else:
+                self.progress.check_cancelled()
+                fold_numbers = range(len(self.folds))
+                fold_results = list(executor.map(run_fold_in_worker, [self.evaluate_fold] * len(self.folds), [self.model_definition] * len(self.folds),
+                                                 fold_numbers, [self.metric_names] * len(self.folds), [self.return_predictions] * len(self.folds)))
+
+        return self.__aggregate(fold_results)
+
+
+    def __aggregate(self, fold_results: list) -> dict:
+        all_fold_metrics = [fold_metrics for fold_metrics, _ in fold_results]
+
+        # Every fold counts the same however many rows it tests, as with the mean of cross_val_score
+        model_metrics = {name: float(np.mean([fold_metrics[name] for fold_metrics in all_fold_metrics])) for name in all_fold_metrics[0]}
+        scores = [fold_metrics['score'] for fold_metrics in all_fold_metrics]
+        model_metrics['scoreStd'] = float(np.std(scores, ddof=1)) if len(scores) > 1 else 0.0
+        model_metrics['folds'] = [{'fold': fold_number, 'trainRows': len(train_positions), 'testRows': len(test_positions), **fold_metrics}
+                                  for fold_number, ((train_positions, test_positions), fold_metrics) in enumerate(zip(self.folds, all_fold_metrics))]
+
+        if self.return_predictions:
+            # Out of fold predictions, in the order of the folds' testing rows
+            _, y = self.dataset['training']
+            model_metrics['predictions'] = {'yTrue': np.concatenate([y[test_positions] for _, test_positions in self.folds]),
+                                            'yPred': np.concatenate([y_pred for _, y_pred in fold_results])}
+
+        return model_metrics
+
+
+    def __fold_executor(self):
+        # Folds run in worker processes unless this is already a worker process or there is only one core to use
+        worker_count = self.__get_worker_count()
+        if worker_count <= 1 or multiprocessing.parent_process() is not None:
+            return nullcontext()
+
+        return fold_executor(self.dataset, self.folds, worker_count)
+
+
+    def __get_worker_count(self) -> int:
+        cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+        n_jobs = (self.model_definition.get('modelParams') or {}).get('n_jobs') or 1
+        n_jobs = cpu_count if n_jobs < 0 else n_jobs
+        max_workers = int(self.model_definition['crossValidation'].get('maxWorkers', cpu_count))
+
+        return max(1, min(max_workers, len(self.folds), cpu_count // n_jobs))
+
+
+@contextmanager
+def fold_executor(dataset: dict, folds: list, worker_count: int):
+    """Process pool whose workers map the X/y matrices and the fold positions from shared memory on start up"""
+    X, y = dataset['training']
+    arrays = {'X': X, 'y': y}
+    for fold_number, (train_positions, test_positions) in enumerate(folds):
+        arrays[f'{fold_number}.train'], arrays[f'{fold_number}.test'] = train_positions, test_positions
+
+    # The folds are shared rather than worked out again, so every worker uses exactly the folds of this process
+    with share_arrays(arrays) as shared_arrays:
+        with ProcessPoolExecutor(max_workers = worker_count,
+                                 mp_context = multiprocessing.get_context('spawn'),
+                                 initializer = attach_fold_dataset,
+                                 initargs = (shared_arrays, len(folds))) as executor:
+            yield executor
+
+
+# The dataset and its folds as seen from inside a worker process
+WORKER_FOLD_DATASET = None
+WORKER_FOLDS = None
+
+def attach_fold_dataset(shared_arrays: SharedArrays, fold_count: int):
+    global WORKER_FOLD_DATASET, WORKER_FOLDS
+    arrays = shared_arrays.load()
+    WORKER_FOLD_DATASET = {'training': (arrays['X'], arrays['y'])}
+    WORKER_FOLDS = [(arrays[f'{fold_number}.train'], arrays[f'{fold_number}.test']) for fold_number in range(fold_count)]
+
+
+def run_fold_in_worker(evaluate_fold, model_definition: dict, fold_number: int, metric_names: list, return_predictions: bool) -> tuple[dict, np.ndarray | None]:
+    return evaluate_fold(model_definition, WORKER_FOLD_DATASET, WORKER_FOLDS[fold_number], metric_names, return_predictions)
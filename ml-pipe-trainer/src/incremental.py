@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for training models
+incrementally, a chunk of the dataset at a time.
+ """
+#----------------------------------
+#
+#
+import numpy as np
+
+from src.data_manipulation import SplitCache, is_fold_cross_validation
+from src.evaluation import evaluate_predictions, get_metric_names
+from src.preprocessing import PreprocessingPlan, TimeSeriesFeatures
+from src.progress import JobProgress
+from src.training import TrainingManager, save_model
+
+INCREMENTAL_CHUNK_ROWS = 100_000
+INCREMENTAL_BATCH_SIZE = 1024
+
+
+def is_incremental(model_definition: dict) -> bool:
+    return model_definition.get('trainingMode') == 'incremental'
+
+
+def train_incremental_models(model_definitions: list, preprocessing_plan: PreprocessingPlan | None, iterate_chunks, progress: JobProgress | None = None) -> list:
+    """Trains models with partial_fit while streaming over the dataset, so the
+    dataset never has to fit in memory. Every epoch is one pass over the chunks
+    shared by all the models, then one last pass scores them on the testing years.
+
+    A model definition opts in with trainingMode: 'incremental' and may add
+        'incremental': {'chunkRows': 100000, 'batchSize': 1024, 'epochs': 1, 'classes': [0, 1]}
+
+    Preprocessing runs on each chunk on its own, so tasks that look at
+    neighbouring rows such as interpolation can't see across chunk boundaries.
+    Time series feature tasks would start again at each chunk and are refused.
+
+    Args:
+        model_definitions (list): The incremental model definitions
+
+        preprocessing_plan (PreprocessingPlan | None): The compiled preprocessing tasks
+
+        iterate_chunks (Callable[[int], Iterable[DataFrame]]): Starts a new pass over the
+        dataset in chunks of at most the given number of rows
+
+        progress (JobProgress | None): Advanced with every chunk, which stops a cancelled job
+
+    Raises:
+        ValueError: If a model's algorithm does not support incremental training, or the
+        preprocessing makes time series features
+
+    Returns:
+        list: The metrics of each model, in the order of the model definitions
+    """
+    progress = progress if progress is not None else JobProgress()
+
+    # Lags, windows and differences would be wrong near the edges of every chunk
+    for preprocessing, preprocessing_task_request in (preprocessing_plan.steps if preprocessing_plan is not None else []):
+        if isinstance(preprocessing, TimeSeriesFeatures):
+            raise ValueError(f'{preprocessing_task_request["task"]} needs the rows across chunk boundaries and can not be used with incremental training')
+
+    trainers = []
+    for model_definition in model_definitions:
+        if model_definition.get('search'):
+            raise ValueError(f'Model {model_definition["id"]} can not combine a search with incremental training')
+        if is_fold_cross_validation(model_definition['crossValidation']):
+            raise ValueError(f'Model {model_definition["id"]} can not combine fold cross validation with incremental training')
+
+        model_trainer = TrainingManager(model_definition, None).build_model()
+        if not model_trainer.supports_incremental_training():
+            raise ValueError(f'{model_definition["mlAlgorithm"]} does not support incremental training')
+        trainers.append(model_trainer)
+
+    # Checked up front so a misspelled metric fails before any model is trained
+    metric_names = [get_metric_names(model_definition['predictionProblem'], model_definition.get('metrics')) for model_definition in model_definitions]
+
+    options = [model_definition.get('incremental') or {} for model_definition in model_definitions]
+    chunk_rows = min(int(option.get('chunkRows', INCREMENTAL_CHUNK_ROWS)) for option in options)
+    epochs = [max(1, int(option.get('epochs', 1))) for option in options]
+
+    def iterate_splits(pass_name: str):
+        for df_chunk in iterate_chunks(chunk_rows):
+            progress.advance(pass_name)
+            if preprocessing_plan is not None:
+                df_chunk = preprocessing_plan.run(df_chunk)
+
+            # Models with the same crossValidation and target share the chunk's X/y matrices
+            split_cache = SplitCache(df_chunk)
+            yield split_cache, [split_cache.get_split(model_definition['crossValidation'], model_definition['target']) for model_definition in model_definitions]
+
+    classes = _get_classes(model_definitions, options, iterate_splits)
+
+    for epoch in range(max(epochs)):
+        for _, splits in iterate_splits(f'epoch {epoch + 1}'):
+            for model_number, (model_trainer, dataset) in enumerate(zip(trainers, splits)):
+                if epoch >= epochs[model_number]:
+                    continue
+
+                X_train, y_train = dataset['training']
+                batch_size = int(options[model_number].get('batchSize', INCREMENTAL_BATCH_SIZE))
+                for offset in range(0, len(y_train), batch_size):
+                    model_trainer.train_batch(X_train[offset:offset + batch_size], y_train[offset:offset + batch_size], classes[model_number])
+
+    # Models asking for metrics or their predictions keep their testing predictions,
+    # the rest only need the running score
+    scores = [StreamingScore(model_definition['predictionProblem']) for model_definition in model_definitions]
+    kept_predictions = [{'yTrue': [], 'yPred': [], 'index': []} if metric_names[model_number] or model_definition.get('returnPredictions') else None
+                        for model_number, model_definition in enumerate(model_definitions)]
+    feature_names = [None] * len(model_definitions)
+    for split_cache, splits in iterate_splits('scoring'):
+        for model_number, (model_trainer, model_definition, dataset) in enumerate(zip(trainers, model_definitions, splits)):
+            feature_names[model_number] = split_cache.get_feature_names(model_definition['crossValidation'], model_definition['target'])
+
+            X_test, y_test = dataset['testing']
+            if not len(y_test):
+                continue
+
+            y_pred = model_trainer.predict(X_test)
+            score = scores[model_number]
+            score.update(y_test, y_pred)
+
+            predictions = kept_predictions[model_number]
+            if predictions is not None:
+                predictions['yTrue'].append(y_test)
+                predictions['yPred'].append(y_pred)
+                predictions['index'].append(split_cache.get_index(model_definition['crossValidation'], model_definition['target'], 'testing'))
+
+    all_model_metrics = []
+    for model_number, (model_trainer, model_definition, score) in enumerate(zip(trainers, model_definitions, scores)):
+        model_metrics = {'score': score.result()}
+
+        predictions = kept_predictions[model_number]
+        if predictions is not None:
+            y_true = np.concatenate(predictions['yTrue']) if predictions['yTrue'] else np.empty(0)
+            y_pred = np.concatenate(predictions['yPred']) if predictions['yPred'] else np.empty(0)
+            model_metrics.update(evaluate_predictions(model_definition['predictionProblem'], y_true, y_pred, metric_names[model_number]))
+            if model_definition.get('returnPredictions'):
+                index = predictions['index'][0].append(predictions['index'][1:]) if predictions['index'] else None
+                model_metrics['predictions'] = {'yTrue': y_true, 'yPred': y_pred, 'index': index}
+
+        model_metrics['artifact'] = save_model(model_trainer, model_definition, feature_names[model_number], model_metrics['score'])
+        all_model_metrics.append(model_metrics)
+        progress.finish_model()
+
+    return all_model_metrics
+
+
+def _get_classes(model_definitions: list, options: list, iterate_splits) -> list:
+    # partial_fit needs every class on the first call, unless they are given
+    # the training targets are read once up front to find them
+    classes = [np.asarray(option['classes']) if 'classes' in option else None for option in options]
+    missing = [model_number for model_number, model_definition in enumerate(model_definitions)
+               if model_definition['predictionProblem'] == 'classification' and classes[model_number] is None]
+    if not missing:
+        return classes
+
+    found = {model_number: [] for model_number in missing}
+    for _, splits in iterate_splits('classes'):
+        for model_number in missing:
+            found[model_number].append(np.unique(splits[model_number]['training'][1]))
+
+    for model_number in missing:
+        classes[model_number] = np.unique(np.concatenate(found[model_number]))
+
+    return classes
+
+
+class StreamingScore():
+    """The score model.score would give on the whole testing split, accumulated
+    a chunk at a time: R^2 for regression and accuracy for classification.
+    """
+
+    def __init__(self, prediction_problem: str):
+        self.prediction_problem = prediction_problem
+        self.count = 0
+        self.correct = 0
+        self.sum_y = 0.0
+        self.sum_y_squared = 0.0
+        self.sum_squared_error = 0.0
+
+
+    def update(self, y_true: np.ndarray, y_pred: np.ndarray):
+        self.count += len(y_true)
+        if self.prediction_problem == 'classification':
+            self.correct += int(np.count_nonzero(y_true == y_pred))
+        else:
+            y_true = y_true.astype(np.float64)
+            self.sum_y += float(y_true.sum())
+            self.sum_y_squared += float(np.dot(y_true, y_true))
+            self.sum_squared_error += float(np.sum((y_true - y_pred) ** 2))
+
+
+    def result(self) -> float:
+        if self.count == 0:
+            return float('nan')
+
+        if self.prediction_problem == 'classification':
+            return self.correct / self.count
+
+        total_sum_of_squares = self.sum_y_squared - self.sum_y ** 2 / self.count
+        if total_sum_of_squares <= 0:
+            return 1.0 if self.sum_squared_error == 0 else 0.0
+        return 1 - self.sum_squared_error / total_sum_of_squares
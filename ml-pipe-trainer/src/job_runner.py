@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for running a job in the
+background, so the trainer keeps answering requests while
+it trains.
+ """
+#----------------------------------
+#
+#
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import threading
+import traceback
+
+from src.progress import JobCancelled, JobProgress
+
+
+class JobBusy(Exception):
+    pass
+
+
+class JobRunner():
+    """Runs one job at a time on a thread of its own. A worker only ever has
+    one job, a second one is refused until the first has stopped.
+    """
+
+    def __init__(self):
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='job')
+        self.__lock = threading.Lock()
+        self.progress = None
+        self.future = None
+
+
+    def submit(self, run_job, token: str | None, on_finished=None, on_cancelled=None, on_error=None) -> JobProgress:
+        """Starts a job
+
+        Args:
+            run_job (Callable[[JobProgress], any]): Runs the job, checking the progress it is given for cancellation
+
+            token (str | None): The session the job belongs to
+
+            on_finished (Callable[[any], None] | None): Called with what run_job returned
+
+            on_cancelled (Callable[[], None] | None): Called once a cancelled job has stopped
+
+            on_error (Callable[[Exception], None] | None): Called when run_job raised
+
+        Raises:
+            JobBusy: An error will appear when a job is already running
+
+        Returns:
+            JobProgress: The progress of the job
+        """
+        with self.__lock:
+            if self.busy:
+                raise JobBusy(f'Job {self.progress.token} is still running')
+
+            progress = JobProgress(token)
+            self.progress = progress
+            self.future = self.__executor.submit(self.__run, progress, run_job, on_finished, on_cancelled, on_error)
+
+        return progress
+
+
+    @property
+    def busy(self) -> bool:
+        return self.future is not None and not self.future.done()
+
+
+    def cancel(self) -> bool:
+        """Asks the running job to stop, False if there is none"""
+        with self.__lock:
+            return self.busy and self.progress.cancel()
+
+
+    def wait(self, timeout: float | None = None):
+        future: Future | None = self.future
+        if future is not None:
+            future.exception(timeout)
+
+
+    def reset(self, timeout: float | None = None) -> bool:
+        """Forgets the last job, cancelling it if it is still running and waiting
+        up to timeout seconds for it to stop. A job that has not stopped by then is
+        not forgotten and False is returned.
+        """
+        self.cancel()
+        try:
+            self.wait(timeout)
+        except FutureTimeoutError:
+            return False
+
+        with self.__lock:
+            self.progress = None
+        return True
+
+
+    def __run(self, progress: JobProgress, run_job, on_finished, on_cancelled, on_error):
+        try:
+            results = run_job(progress)
+        except JobCancelled:
+            progress.finish('cancelled')
+            if on_cancelled is not None:
+                on_cancelled()
+        except Exception as e:
+            traceback.print_exc()
+            progress.finish('error', f'{type(e).__name__}: {e}')
+            if on_error is not None:
+                on_error(e)
+        else:
+            # The results are in place before anyone polling the progress sees the job finish
+            if on_finished is not None:
+                on_finished(results)
+            progress.finish('finished')
@@ -10,13 +10,31 @@ for the trainer container.
 #----------------------------------
 # 
 #
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from hashlib import sha256
 from io import StringIO
+import os
 import pandas as pd
-import requests
 
-from src.pipeline_manager import run_pipeline
+from src.artifact_store import ARTIFACT_STORE, HOT_MODELS
+from src.core_notifier import CORE_NOTIFIER
+from src.data_ingest import DatasetFile, core_dataset_path, detect_format, iterate_upload_file, receive_upload
+from src.job_runner import JobBusy, JobRunner
+from src.metrics import METRICS, PROMETHEUS_CONTENT_TYPE
+from src.pipeline_manager import JOBS, RESULT_CACHE, run_pipeline, run_prediction
+from src.preprocessing import compile_preprocessing_plan
+from src.results import RESULT_FORMATS, RESULT_TABLES, pa
+from src.training import warm_up
+
+# Rows in each chunk of a streamed results table
+RESULT_CHUNK_ROWS = int(os.getenv('RESULT_CHUNK_ROWS', 50_000))
+
+# How long a reset waits for a cancelled job to stop, below the core's read timeout
+RESET_TIMEOUT_SECONDS = float(os.getenv('RESET_TIMEOUT_SECONDS', 5))
 
 app = FastAPI()
 
@@ -32,9 +50,13 @@ app.add_middleware(
 class worker:
     job_specification = None
     data = None
+    data_path = None
     results = None
     token = None
 
+    # Runs the job in the background, so this worker keeps answering while it trains
+    job_runner = JobRunner()
+
 THIS_WORKER = worker()
 
 @app.post("/api/init")
@@ -43,26 +65,199 @@ async def init(request: Request):
     THIS_WORKER.token = json['session_token']
 
 
+@app.post("/api/warmup/")
+def warmup():
+    # Called by the core when this container joins the worker pool
+    warm_up()
+
+
+@app.post("/api/reset/")
+async def reset():
+    # Called by the core once the results have been fetched, this worker is then leased to the next session.
+    # A job that won't stop in time is refused, so the core throws this worker away instead of leasing it
+    if not await run_in_threadpool(THIS_WORKER.job_runner.reset, RESET_TIMEOUT_SECONDS):
+        raise HTTPException(status_code=503, detail='The running job did not stop in time')
+    THIS_WORKER.job_specification = None
+    THIS_WORKER.data = None
+    remove_data_file()
+    THIS_WORKER.results = None
+    THIS_WORKER.token = None
+
+
 @app.post("/api/postJob/")
 async def post_job(request: Request):
-    THIS_WORKER.job_specification = await request.json()
+    job_specification = await request.json()
+
+    # Unknown or malformed preprocessing tasks are refused here rather than failing the job once its data has arrived
+    try:
+        compile_preprocessing_plan(job_specification.get('preprocessingTasks') if isinstance(job_specification, dict) else None)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    THIS_WORKER.job_specification = job_specification
 
 
 @app.post("/api/postData/")
 async def post_data(request: Request):
+    refuse_if_busy()
     form_data = await request.form()
 
     # Extract the CSV content (sent as text in the "data_file" key)
     csv_content = form_data["data_file"]
     
-    # Convert the CSV text content into a Pandas DataFrame
-    df_data = pd.read_csv(StringIO(csv_content), index_col = 0)
+    # Convert the CSV text content into a Pandas DataFrame, unless the results are already cached
+    run_job_on_data(lambda: pd.read_csv(StringIO(csv_content), index_col = 0), sha256(csv_content.encode()).hexdigest())
+
+
+@app.post("/api/postDataFile/")
+async def post_data_file(request: Request):
+    # Checked before the upload, whose file would replace the one the running job reads
+    refuse_if_busy()
+    data_path, data_digest, content_type, file_name = await receive_dataset(request)
+
+    remove_data_file()
+    THIS_WORKER.data_path = data_path
+
+    try:
+        data_format = detect_format(content_type, file_name, data_path)
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+
+    # The dataset is only parsed if the results are not already cached,
+    # and only a chunk at a time if every model is trained incrementally
+    run_job_on_data(DatasetFile(data_path, data_format), data_digest)
+
+
+@app.post("/api/postDataPath/")
+async def post_data_path(request: Request):
+    # The core names a dataset in its store, which this worker sees as a shared directory and reads
+    # in place instead of being sent the bytes. 404 tells the core to send them after all
+    refuse_if_busy()
+    json = await request.json()
+    data_path = core_dataset_path(json['dataset'])
+    if data_path is None:
+        raise HTTPException(status_code=404, detail=f"Dataset {json['dataset']} is not in a directory shared with the core")
+
+    try:
+        data_format = detect_format(json.get('content_type'), json.get('file_name'), data_path)
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+
+    # The file belongs to the core, so it is left in place once the job is done
+    remove_data_file()
+    run_job_on_data(DatasetFile(data_path, data_format), json['dataset'])
+
+
+@app.post("/api/predict/")
+async def predict(request: Request, artifact: str):
+    # The model is loaded before the dataset is received, so an unknown artifact is refused up front
+    loaded = await run_in_threadpool(HOT_MODELS.get, artifact)
+    if loaded is None:
+        raise HTTPException(status_code=404, detail=f'No model artifact {artifact}')
+    model, metadata = loaded
+
+    data_path, _, content_type, file_name = await receive_dataset(request)
+    try:
+        try:
+            data_format = detect_format(content_type, file_name, data_path)
+        except ValueError as e:
+            raise HTTPException(status_code=415, detail=str(e))
+
+        try:
+            index, predictions = await run_in_threadpool(run_prediction, model, metadata, DatasetFile(data_path, data_format))
+        except KeyError as e:
+            raise HTTPException(status_code=422, detail=f'The dataset is missing features of the model: {e}')
+    finally:
+        os.remove(data_path)
+
+    return {'artifact': artifact, 'index': index, 'predictions': predictions}
+
+
+@app.get("/api/artifacts/{artifact}")
+async def get_artifact(artifact: str):
+    metadata = ARTIFACT_STORE.get_metadata(artifact)
+    if metadata is None:
+        raise HTTPException(status_code=404, detail=f'No model artifact {artifact}')
+
+    return metadata
+
 
-    THIS_WORKER.data = df_data
+async def receive_dataset(request: Request) -> tuple[str, str, str, str | None]:
+    # The dataset is either the raw request body, with its format given by the content type,
+    # or the "data_file" part of a multipart form. Both are streamed to disk as they arrive
+    content_type = request.headers.get('content-type', '')
+    file_name = None
+    if content_type.startswith('multipart/form-data'):
+        form_data = await request.form()
+        upload_file = form_data["data_file"]
+        content_type, file_name = upload_file.content_type, upload_file.filename
+        data_path, data_digest = await receive_upload(iterate_upload_file(upload_file))
+        await form_data.close()
+    else:
+        data_path, data_digest = await receive_upload(request.stream())
 
-    THIS_WORKER.results = run_pipeline(df_data, THIS_WORKER.job_specification).to_json(orient="records")
+    return data_path, data_digest, content_type, file_name
 
-    requests.post('http://host.docker.internal:8000/api/postfinishedtraining/', json={'session_token': THIS_WORKER.token})
+
+@app.get("/api/progress")
+async def progress():
+    # Stage, step and model the running job is on, or how the last job ended
+    job_progress = THIS_WORKER.job_runner.progress
+    return job_progress.to_dict() if job_progress is not None else {'status': 'idle'}
+
+
+@app.post("/api/cancel/")
+async def cancel():
+    # The job stops at its next step, then the core is told it can take this worker back
+    if not THIS_WORKER.job_runner.cancel():
+        raise HTTPException(status_code=409, detail='No job is running')
+
+    return THIS_WORKER.job_runner.progress.to_dict()
+
+
+@app.get("/api/health")
+async def health():
+    return {'status': 'ok', 'busy': THIS_WORKER.job_runner.busy}
+
+
+def refuse_if_busy():
+    if THIS_WORKER.job_runner.busy:
+        raise HTTPException(status_code=409, detail='This worker is already running a job')
+
+
+def run_job_on_data(dataset, data_digest: str):
+    if callable(dataset):
+        load_data = dataset
+
+        def dataset() -> pd.DataFrame:
+            THIS_WORKER.data = load_data()
+            return THIS_WORKER.data
+
+    job_specification, token = THIS_WORKER.job_specification, THIS_WORKER.token
+
+    def on_finished(results):
+        THIS_WORKER.results = results
+        CORE_NOTIFIER.notify('/api/postfinishedtraining/', token)
+
+    def on_cancelled():
+        # There are no results to fetch, so the worker is handed straight back
+        JOBS.inc(outcome = 'cancelled')
+        CORE_NOTIFIER.notify('/api/postterminating/', token)
+
+    def on_error(e: Exception):
+        JOBS.inc(outcome = 'failed')
+        CORE_NOTIFIER.notify('/api/postfailedtraining/', token)
+
+    try:
+        THIS_WORKER.job_runner.submit(lambda progress: run_pipeline(dataset, job_specification, data_digest, progress),
+                                      token, on_finished, on_cancelled, on_error)
+    except JobBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+def remove_data_file():
+    if THIS_WORKER.data_path is not None and os.path.exists(THIS_WORKER.data_path):
+        os.remove(THIS_WORKER.data_path)
+    THIS_WORKER.data_path = None
 
 
 @app.post("/runJob/")
@@ -70,13 +265,42 @@ async def run_job():
     # NOTE:: Currently implemented in post_data above instead. Probably should be moved here, but left there for now
     # THIS_WORKER.results = run_pipeline(THIS_WORKER.data, THIS_WORKER.job_specification).to_json(orient="records")
     print('TRAINING FINISHED')
-    requests.post('http://host.docker.internal:8000/api/postfinishedtraining/', json={'session_token': THIS_WORKER.token})
+    CORE_NOTIFIER.notify('/api/postfinishedtraining/', THIS_WORKER.token)
     
 
+@app.get("/api/cacheStats")
+async def cache_stats():
+    return RESULT_CACHE.stats()
+
+
+@app.get("/metrics")
+def metrics():
+    # Scraped by Prometheus, covers the jobs run by this worker since it started
+    return Response(content=METRICS.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
 @app.get("/api/getResults")
-async def get_results():
-    # As the front has asked us for the results, we know we are safe to be killed, we tell the controller to terminate us
-    requests.post('http://host.docker.internal:8000/api/postterminating/', json={'session_token': THIS_WORKER.token})
+async def get_results(table: str = 'models', format: str = 'json', release: bool = True):
+    """Returns a table of the results. 'json' is a list of records, 'ndjson' streams gzip compressed
+    records a line each and 'arrow' streams an Arrow IPC stream of compressed record batches.
+    Pass release=false when fetching the predictions before the models table.
+    """
+    if table not in RESULT_TABLES or format not in RESULT_FORMATS:
+        raise HTTPException(status_code=400, detail=f'Results tables are {RESULT_TABLES} in the formats {tuple(RESULT_FORMATS)}')
+    if format == 'arrow' and pa is None:
+        raise HTTPException(status_code=406, detail='pyarrow is required for arrow results')
+
+    # As the front has asked us for the results, we know we are safe to be killed. The controller
+    # is told to terminate us once they have been sent, as a streamed table is still being read from
+    background = BackgroundTask(CORE_NOTIFIER.notify, '/api/postterminating/', THIS_WORKER.token) if release else None
+
+    job_results = THIS_WORKER.results
+    if job_results is None or format == 'json':
+        return JSONResponse(job_results.to_records(table) if job_results is not None else None, background=background)
+
+    if format == 'ndjson':
+        return StreamingResponse(job_results.iterate_ndjson(table, RESULT_CHUNK_ROWS), media_type=RESULT_FORMATS[format],
+                                 headers={'Content-Encoding': 'gzip'}, background=background)
+
+    return StreamingResponse(job_results.iterate_arrow(table, RESULT_CHUNK_ROWS), media_type=RESULT_FORMATS[format], background=background)
 
-    # Return the results
-    return THIS_WORKER.results
\ No newline at end of file
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic and data structures for
+metrics exposed in the Prometheus text format.
+ """
+#----------------------------------
+#
+#
+from bisect import bisect_left
+from contextlib import contextmanager
+from math import inf
+from time import perf_counter
+import os
+import resource
+import threading
+
+# Upper bounds in seconds, from a single preprocessing task up to a long training run
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, inf)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric():
+    """A named value per set of label values. It is either recorded as things happen,
+    or read from a function each time the metrics are rendered, which with labels
+    returns the label values mapped to each value.
+    """
+    TYPE = None
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), function = None):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.function = function
+
+        # Label values mapped to the value held for them
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.TYPE}']
+        for label_values, value in self.snapshot().items():
+            lines.append(f'{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}')
+        return lines
+
+
+    def snapshot(self) -> dict:
+        if self.function is not None:
+            values = self.function()
+            return values if self.label_names else {(): values}
+
+        with self.lock:
+            return dict(self.values)
+
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = buckets
+
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            # Per bucket counts, then the sum and count of every observation
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            counts[bucket] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the seconds spent in the with block, even if it raises"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.TYPE}']
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+
+        for label_values, counts in values.items():
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = format_labels(self.label_names + ('le',), label_values + (format_value(upper_bound),))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {format_value(counts[-2])}')
+            lines.append(f'{self.name}_count{labels} {counts[-1]}')
+        return lines
+
+
+class MetricsRegistry():
+    def __init__(self):
+        self.metrics = []
+
+
+    def counter(self, name: str, description: str, label_names: tuple = (), function = None) -> Counter:
+        return self.register(Counter(name, description, label_names, function))
+
+
+    def gauge(self, name: str, description: str, label_names: tuple = (), function = None) -> Gauge:
+        return self.register(Gauge(name, description, label_names, function))
+
+
+    def histogram(self, name: str, description: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, description, label_names, buckets))
+
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(label_names: tuple, label_values: tuple) -> str:
+    if not label_names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in label_values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(label_names, escaped)) + '}'
+
+
+def format_value(value: float) -> str:
+    if value == inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def resident_memory_bytes() -> int:
+    """Current resident set size of this process, from /proc where there is one"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return peak_resident_memory_bytes()
+
+
+def peak_resident_memory_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# The metrics of this trainer, every module adds its own
+METRICS = MetricsRegistry()
+
+STAGE_SECONDS = METRICS.histogram('ml_pipe_trainer_stage_seconds', 'Seconds spent in each stage of a job', ('stage',))
+
+METRICS.gauge('ml_pipe_trainer_resident_memory_bytes', 'Resident set size of the trainer process', function = resident_memory_bytes)
+METRICS.gauge('ml_pipe_trainer_peak_resident_memory_bytes', 'Largest resident set size of the trainer process so far', function = peak_resident_memory_bytes)
@@ -10,49 +10,298 @@ learning (ML) pipeline steps.
 #----------------------------------
 # 
 #
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+import multiprocessing
+import numpy as np
+import os
 from pandas import DataFrame
 
-from src.preprocessing import preprocessing_factory
+from src.artifact_store import HOT_MODELS
+from src.data_ingest import DatasetFile, iterate_frame_chunks
+from src.data_manipulation import SplitCache
+from src.incremental import is_incremental, train_incremental_models
+from src.metrics import METRICS, STAGE_SECONDS
+from src.preprocessing import compile_preprocessing_plan
+from src.progress import JobProgress
+from src.result_cache import ResultCache, result_key
+from src.results import JobResults
+from src.shared_dataset import SharedArrays, share_arrays
 from src.training import TrainingManager
 
-def run_pipeline(df_dataset: DataFrame, job_specification: dict):
-    preprocessing_tasks = job_specification['preprocessingTasks']
+# Upper bound on the worker processes used to train models in parallel, 0 means one per core
+TRAINER_MAX_WORKERS = int(os.getenv('TRAINER_MAX_WORKERS', 0))
+
+# How often a parallel training run checks whether its job was cancelled
+CANCEL_POLL_SECONDS = 0.2
+
+# Rows scored at once by a prediction, only one chunk of the dataset is in memory at a time
+PREDICTION_CHUNK_ROWS = int(os.getenv('PREDICTION_CHUNK_ROWS', 100_000))
+
+RESULT_CACHE = ResultCache()
+
+JOBS = METRICS.counter('ml_pipe_trainer_jobs_total', 'Jobs run by this trainer, by whether they were answered from the result cache', ('outcome',))
+PREPROCESSING_TASK_SECONDS = METRICS.histogram('ml_pipe_trainer_preprocessing_task_seconds', 'Seconds spent in each preprocessing task', ('task',))
+METRICS.counter('ml_pipe_trainer_result_cache_hits_total', 'Jobs answered from the result cache', function = lambda: RESULT_CACHE.stats()['hits'])
+METRICS.counter('ml_pipe_trainer_result_cache_misses_total', 'Jobs not found in the result cache', function = lambda: RESULT_CACHE.stats()['misses'])
+PREDICTED_ROWS = METRICS.counter('ml_pipe_trainer_predicted_rows_total', 'Rows scored by predictions')
+METRICS.counter('ml_pipe_trainer_hot_model_hits_total', 'Predictions made with a model that was already loaded', function = lambda: HOT_MODELS.hits)
+METRICS.counter('ml_pipe_trainer_hot_model_misses_total', 'Predictions that loaded their model from the artifact store', function = lambda: HOT_MODELS.misses)
+
+def run_pipeline(df_dataset, job_specification: dict, dataset_digest: str | None = None, progress: JobProgress | None = None):
+    """Runs the preprocessing and training of a job. When the digest of the dataset
+    is given, results are answered from the result cache where possible, unless the
+    job sets execution: {'useCache': False}.
+
+    Models with trainingMode: 'incremental' are trained a chunk at a time, so when
+    every model is incremental a DatasetFile is streamed and never loaded whole.
+
+    A model definition may ask for metrics besides its score, for example
+    'metrics': ['regression', 'mape'] with the names of metrics or metric sets, and
+    for its predictions of the testing years with 'returnPredictions': True.
+
+    Besides splitting by year, crossValidation may be of type 'rollingOrigin', 'kFold'
+    or 'blockedKFold', which score a model over several folds of the rows. The folds
+    are fitted in parallel and each model reports its score and metrics averaged over
+    them, with 'scoreStd' and the results of every fold under 'folds'.
+
+    Args:
+        df_dataset (DataFrame | DatasetFile | Callable[[], DataFrame]): The dataset, the file
+        holding it, or a function loading it so the dataset is only loaded on a cache miss
+
+        job_specification (dict): The job specification
+
+        dataset_digest (str | None): sha256 hex digest of the dataset bytes
+
+        progress (JobProgress | None): Tracks the progress of the job and whether it was cancelled
+
+    Raises:
+        JobCancelled: An error will appear when the job is cancelled through progress
 
-    df_dataset = preprocess_data(preprocessing_tasks, df_dataset)
+    Returns:
+        JobResults: The performance metrics of each model, and the predictions asked for
+    """
+    progress = progress if progress is not None else JobProgress()
+    execution = job_specification.get('execution') or {}
+    cache_key = None
+    if dataset_digest is not None and execution.get('useCache', True):
+        cache_key = result_key(dataset_digest, job_specification)
+        job_results = RESULT_CACHE.get(cache_key)
+        if job_results is not None:
+            JOBS.inc(outcome = 'cached')
+            return job_results
 
+    preprocessing_tasks = job_specification['preprocessingTasks']
     model_definitions = job_specification['modelDefinitions']
+    progress.add_models(len(model_definitions))
+
+    all_model_metrics = [None] * len(model_definitions)
+    incremental_positions = [position for position, model_definition in enumerate(model_definitions) if is_incremental(model_definition)]
+    in_memory_positions = [position for position, model_definition in enumerate(model_definitions) if not is_incremental(model_definition)]
+
+    if in_memory_positions and not isinstance(df_dataset, DataFrame):
+        progress.start_stage('load')
+        with STAGE_SECONDS.time(stage = 'load'):
+            df_dataset = df_dataset.load() if isinstance(df_dataset, DatasetFile) else df_dataset()
+
+    if incremental_positions:
+        # Runs before in memory preprocessing, which may change the dataset in place
+        if isinstance(df_dataset, DatasetFile):
+            iterate_chunks = df_dataset.iterate_chunks
+        else:
+            if callable(df_dataset):
+                progress.start_stage('load')
+                with STAGE_SECONDS.time(stage = 'load'):
+                    df_dataset = df_dataset()
+            iterate_chunks = partial(iterate_frame_chunks, df_dataset)
+
+        # Loading, preprocessing and training are interleaved chunk by chunk, so are timed as one stage
+        preprocessing_plan = compile_preprocessing_plan(preprocessing_tasks) if preprocessing_tasks is not None else None
+        progress.start_stage('incremental')
+        with STAGE_SECONDS.time(stage = 'incremental'):
+            incremental_metrics = train_incremental_models([model_definitions[position] for position in incremental_positions], preprocessing_plan, iterate_chunks, progress)
+        for position, model_metrics in zip(incremental_positions, incremental_metrics):
+            all_model_metrics[position] = model_metrics
+
+    if in_memory_positions:
+        preprocessing_report = []
+        with STAGE_SECONDS.time(stage = 'preprocess'):
+            df_dataset = preprocess_data(preprocessing_tasks, df_dataset, preprocessing_report, progress)
+        for step in preprocessing_report:
+            PREPROCESSING_TASK_SECONDS.observe(step['seconds'], task = step['task'])
+
+        # Optional {'mode': 'parallel', 'maxWorkers': n} block, models are trained one after another by default
+        max_workers = execution.get('maxWorkers') if execution.get('mode') == 'parallel' else 1
+
+        progress.start_stage('train')
+        in_memory_metrics = fit_models([model_definitions[position] for position in in_memory_positions], df_dataset, max_workers, progress)
+        for position, model_metrics in zip(in_memory_positions, in_memory_metrics):
+            all_model_metrics[position] = model_metrics
+
+    job_results = get_performance_metrics(model_definitions, all_model_metrics)
+    JOBS.inc(outcome = 'trained')
+
+    if cache_key is not None:
+        RESULT_CACHE.put(cache_key, job_results)
+
+    return job_results
+
+
+def run_prediction(model, metadata: dict, dataset_file: DatasetFile, chunk_rows: int = PREDICTION_CHUNK_ROWS) -> tuple[list, list]:
+    """Scores a dataset with a stored model a chunk of rows at a time. Each chunk
+    is one predict call on the model's feature columns as a contiguous matrix.
+
+    Args:
+        model (any): The trained model
 
-    df_performance_metrics = train_models(model_definitions, df_dataset)
+        metadata (dict): The metadata of the model's artifact
 
-    return df_performance_metrics
+        dataset_file (DatasetFile): The dataset to score, with every feature column of the model
 
+        chunk_rows (int): Most rows scored at once
 
-def preprocess_data(preprocessing_tasks: list, df_dataset: DataFrame):
+    Raises:
+        KeyError: An error will appear when the dataset is missing a feature column
+
+    Returns:
+        tuple[list, list]: The index of the dataset, and the prediction of each row
+    """
+    feature_names = metadata['features']
+    index, predictions = [], []
+    with STAGE_SECONDS.time(stage = 'predict'):
+        for df_chunk in dataset_file.iterate_chunks(chunk_rows):
+            features = df_chunk[feature_names]
+            try:
+                X = np.ascontiguousarray(features.to_numpy(dtype = np.float64))
+            except (TypeError, ValueError):
+                X = np.ascontiguousarray(features.to_numpy())
+
+            predictions.append(model.predict(X))
+            index.extend(df_chunk.index.astype(str))
+            PREDICTED_ROWS.inc(len(df_chunk))
+
+    return index, np.concatenate(predictions).tolist() if predictions else []
+
+
+def preprocess_data(preprocessing_tasks: list, df_dataset: DataFrame, report: list | None = None, progress: JobProgress | None = None):
     if preprocessing_tasks is None:
         return df_dataset
     
-    for preprocessing_task_request in preprocessing_tasks:
-        preprocessing_class = preprocessing_factory(preprocessing_task_request['task'])
-        df_dataset = preprocessing_class.preprocess_data(preprocessing_task_request, df_dataset)
+    preprocessing_plan = compile_preprocessing_plan(preprocessing_tasks)
+    if progress is not None:
+        progress.start_stage('preprocess', len(preprocessing_plan.steps))
+
+    return preprocessing_plan.run(df_dataset, report, progress)
+
+
+def train_models(model_definitions: list, df_dataset: DataFrame, max_workers: int | None = 1):
+    return get_performance_metrics(model_definitions, fit_models(model_definitions, df_dataset, max_workers))
+
+
+def fit_models(model_definitions: list, df_dataset: DataFrame, max_workers: int | None = 1, progress: JobProgress | None = None) -> list:
+    progress = progress if progress is not None else JobProgress()
+    worker_count = get_worker_count(model_definitions, max_workers)
+
+    # Models with the same crossValidation and target share one set of X/y matrices
+    split_cache = SplitCache(df_dataset)
+
+    if worker_count > 1:
+        all_model_metrics, all_timings = train_models_in_parallel(model_definitions, split_cache, worker_count, progress)
+    else:
+        all_model_metrics, all_timings = [], []
+        for model_definition in model_definitions:
+            progress.start_model(model_definition['id'])
+            training_manager = TrainingManager(model_definition, df_dataset, split_cache, progress)
+            all_model_metrics.append(training_manager.train_model())
+            all_timings.append(training_manager.timings)
+            progress.finish_model()
+
+    for timings in all_timings:
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage = stage)
+
+    # Only this process has the dataset, so the predictions are given their index here
+    for model_definition, model_metrics in zip(model_definitions, all_model_metrics):
+        if 'predictions' in model_metrics:
+            model_metrics['predictions']['index'] = split_cache.get_index(model_definition['crossValidation'], model_definition['target'], 'testing')
 
-    return df_dataset
+    return all_model_metrics
 
 
-def train_models(model_definitions: list, df_dataset: DataFrame):
-    all_performance_metrics = []
+def get_performance_metrics(model_definitions: list, all_model_metrics: list) -> JobResults:
+    return JobResults.from_model_metrics(model_definitions, all_model_metrics)
+
+
+def get_worker_count(model_definitions: list, max_workers: int | None) -> int:
+    """Works out how many models can be trained at once without oversubscribing
+    the cores, given the n_jobs each model asks for itself. A model with n_jobs=-1
+    wants every core, so the models are then trained one after another.
+    """
+    # Only count the cores this process is allowed to run on
+    cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    max_workers = max_workers or TRAINER_MAX_WORKERS or cpu_count
+
+    widest_model = 1
+    for model_definition in model_definitions:
+        n_jobs = (model_definition.get('modelParams') or {}).get('n_jobs') or 1
+        widest_model = max(widest_model, cpu_count if n_jobs < 0 else n_jobs)
+
+    return max(1, min(max_workers, len(model_definitions), cpu_count // widest_model))
+
+
+def train_models_in_parallel(model_definitions: list, split_cache: SplitCache, worker_count: int, progress: JobProgress) -> tuple[list, list]:
+    # Every split is built here once, written to shared memory and mapped by each worker process on start up
     for model_definition in model_definitions:
-        performance_metrics = {}
+        split_cache.get_split(model_definition['crossValidation'], model_definition['target'])
+    layout, arrays = split_cache.to_arrays()
+
+    with share_arrays(arrays) as shared_arrays:
+        with ProcessPoolExecutor(max_workers = worker_count,
+                                 mp_context = multiprocessing.get_context('spawn'),
+                                 initializer = attach_shared_splits,
+                                 initargs = (layout, shared_arrays)) as executor:
+
+            # The stage timings come back with the metrics as metrics recorded in a worker process stay there
+            futures = {executor.submit(train_model_in_worker, model_definition): model_definition for model_definition in model_definitions}
+            try:
+                pending = set(futures)
+                while pending:
+                    # Waits in short steps so a cancelled job is noticed while its models train
+                    done, pending = wait(pending, timeout = CANCEL_POLL_SECONDS, return_when = FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        progress.finish_model()
+                    progress.check_cancelled()
+            except BaseException:
+                terminate_executor(executor)
+                raise
+
+            results = [future.result() for future in futures]
+
+    return [model_metrics for model_metrics, _ in results], [timings for _, timings in results]
+
+
+def terminate_executor(executor: ProcessPoolExecutor):
+    """Stops a process pool without waiting for the models it is training, which
+    could take a long time. The executor has no public way of killing its processes.
+    """
+    # Taken first, as shutting down forgets the processes
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    executor.shutdown(wait = False, cancel_futures = True)
+    for process in processes:
+        process.terminate()
+
 
-        performance_metrics['model_id'] = model_definition['id']
-        
-        training_manager = TrainingManager(model_definition, df_dataset)
+# The dataset splits as seen from inside a worker process
+WORKER_SPLIT_CACHE = None
 
-        score = training_manager.train_model()
+def attach_shared_splits(layout: dict, shared_arrays: SharedArrays):
+    global WORKER_SPLIT_CACHE
+    WORKER_SPLIT_CACHE = SplitCache.from_arrays(layout, shared_arrays.load())
 
-        performance_metrics['score'] = score
 
-        all_performance_metrics.append(performance_metrics)
-            
-    df_performance_metrics = DataFrame(all_performance_metrics)
+def train_model_in_worker(model_definition: dict) -> tuple[dict, dict]:
+    training_manager = TrainingManager(model_definition, None, WORKER_SPLIT_CACHE)
+    model_metrics = training_manager.train_model()
 
-    return df_performance_metrics
\ No newline at end of file
+    return model_metrics, training_manager.timings
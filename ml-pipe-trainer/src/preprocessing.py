@@ -11,9 +11,15 @@ for preprocessing tasks
 # 
 #
 from abc import ABC, abstractmethod
-from importlib import import_module
+from functools import lru_cache
+from time import perf_counter
+import json
+import numpy as np
 import pandas as pd
 
+from src import time_series
+from src.progress import JobProgress
+
 class IPreprocessing(ABC):
     @abstractmethod
     def preprocess_data(self, preprocessing_task_request: dict, df: pd.DataFrame) -> pd.DataFrame:
@@ -32,20 +38,72 @@ class IPreprocessing(ABC):
             DataFrame: A DataFrame with the new preprocessed data
         """
         raise NotImplementedError
+
+
+    def validate(self, preprocessing_task_request: dict):
+        """Checks a task request when the preprocessing plan is compiled, before any data is touched.
+
+        Args:
+            preprocessing_task_request (dict): The task request to check
+
+        Raises:
+            ValueError: An error will appear when the request is not valid
+        """
+        if not isinstance(preprocessing_task_request.get('args', {}), dict):
+            raise ValueError(f'args of {preprocessing_task_request["task"]} must be a dictionary')
+
+
+    def fuse(self, preprocessing_task_request: dict, next_preprocessing_task_request: dict) -> dict | None:
+        """Merges this task with the next one of the same type when running them as one gives the same result.
+
+        Args:
+            preprocessing_task_request (dict): This task request
+
+            next_preprocessing_task_request (dict): The task request that follows it
+
+        Returns:
+            dict | None: The merged task request, or None when the two can't be merged
+        """
+        return None
     
 
 class Interpolation(IPreprocessing):
 
     def preprocess_data(self, preprocessing_task_request: dict, df: pd.DataFrame):
-        args = preprocessing_task_request['args']
-
-        # Extract and removed 'dataSeries' from args. The remaining args will be
-        # passed directly to the interpolate function
+        # 'dataSeries' is left out of the remaining args, which are passed directly to
+        # the interpolate function. The request itself is not changed so it can be run again
+        args = dict(preprocessing_task_request['args'])
         data_series_columns = args.pop('dataSeries', None)
 
+        # Only the block of interpolated columns is written back into the frame
         df[data_series_columns] = df[data_series_columns].interpolate(**args)
 
         return df
+
+
+    def validate(self, preprocessing_task_request: dict):
+        super().validate(preprocessing_task_request)
+        if not preprocessing_task_request['args'].get('dataSeries'):
+            raise ValueError('Interpolation requires the dataSeries to interpolate')
+
+
+    def fuse(self, preprocessing_task_request: dict, next_preprocessing_task_request: dict) -> dict | None:
+        # Interpolations with the same settings of different columns become one interpolate call over
+        # all their columns. A column interpolated twice is left alone, as with a limit the second
+        # interpolation fills gaps the first one left
+        args = dict(preprocessing_task_request['args'])
+        next_args = dict(next_preprocessing_task_request['args'])
+        data_series_columns = self.__as_list(args.pop('dataSeries'))
+        next_data_series_columns = self.__as_list(next_args.pop('dataSeries'))
+        if args != next_args or args.get('axis', 0) not in (0, 'index') or set(data_series_columns) & set(next_data_series_columns):
+            return None
+
+        args['dataSeries'] = data_series_columns + next_data_series_columns
+        return {'task': preprocessing_task_request['task'], 'args': args}
+
+
+    def __as_list(self, data_series_columns) -> list:
+        return list(data_series_columns) if isinstance(data_series_columns, (list, tuple)) else [data_series_columns]
     
 
 class DropNaNs(IPreprocessing):
@@ -58,21 +116,359 @@ class DropNaNs(IPreprocessing):
         return df
 
 
+    def fuse(self, preprocessing_task_request: dict, next_preprocessing_task_request: dict) -> dict | None:
+        # Dropping rows with a NaN in one subset and then in another is the same
+        # as dropping rows with a NaN in either, as long as neither uses a threshold
+        args = dict(preprocessing_task_request['args'])
+        next_args = dict(next_preprocessing_task_request['args'])
+        for task_args in (args, next_args):
+            if 'thresh' in task_args or task_args.get('how', 'any') != 'any' or task_args.get('axis', 0) not in (0, 'index'):
+                return None
+
+        subset, next_subset = args.pop('subset', None), next_args.pop('subset', None)
+        if args != next_args:
+            return None
+
+        if subset is not None and next_subset is not None:
+            args['subset'] = list(dict.fromkeys(list(subset) + list(next_subset)))
+        return {'task': preprocessing_task_request['task'], 'args': args}
+
+
+class TimeSeriesFeatures(IPreprocessing):
+    """Base of the tasks that add features computed from the rows before or after each
+    row. Rows are taken in the order they are in, so the dataset should be sorted by
+    time with one row per time step. A task fills every feature it makes into one
+    preallocated block, which is added to the dataset in a single step.
+    """
+
+    def preprocess_data(self, preprocessing_task_request: dict, df: pd.DataFrame):
+        args = preprocessing_task_request['args']
+        feature_columns = self.feature_columns(args)
+
+        # Column major, so each feature is written to a contiguous column
+        block = np.empty((len(df), len(feature_columns)), dtype=np.float64, order='F')
+        self.compute_features(args, df, block)
+
+        # Features made again replace the ones of the same name
+        df = df.drop(columns=[column for column in feature_columns if column in df.columns])
+        return pd.concat([df, pd.DataFrame(block, index=df.index, columns=feature_columns)], axis=1)
+
+
+    @abstractmethod
+    def feature_columns(self, args: dict) -> list:
+        """Names of the features the task makes, in the order of the columns of its block"""
+        raise NotImplementedError
+
+
+    @abstractmethod
+    def compute_features(self, args: dict, df: pd.DataFrame, block: np.ndarray):
+        """Writes the features into the columns of block, in the order of feature_columns"""
+        raise NotImplementedError
+
+
+    def validate(self, preprocessing_task_request: dict):
+        super().validate(preprocessing_task_request)
+        if not preprocessing_task_request['args'].get('dataSeries'):
+            raise ValueError(f'{preprocessing_task_request["task"]} requires the dataSeries to make features of')
+
+
+    def data_series(self, args: dict) -> list:
+        data_series_columns = args['dataSeries']
+        return list(data_series_columns) if isinstance(data_series_columns, (list, tuple)) else [data_series_columns]
+
+
+    def column_values(self, df: pd.DataFrame, column: str) -> np.ndarray:
+        return df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+    def positive_integers(self, args: dict, name: str, default: list | None = None) -> list:
+        values = args.get(name, default)
+        values = list(values) if isinstance(values, (list, tuple)) else [values]
+        if not values or any(isinstance(value, bool) or not isinstance(value, int) or value < 1 for value in values):
+            raise ValueError(f'{name} must be one or more positive integers')
+        return values
+
+
+class LagFeatures(TimeSeriesFeatures):
+    # args: {'dataSeries': ['Revenue'], 'lags': [1, 2, 24]} makes Revenue_lag_1, ...
+
+    def feature_columns(self, args: dict) -> list:
+        return [f'{column}_lag_{lag}' for column in self.data_series(args) for lag in self.positive_integers(args, 'lags')]
+
+
+    def compute_features(self, args: dict, df: pd.DataFrame, block: np.ndarray):
+        lags = self.positive_integers(args, 'lags')
+        position = 0
+        for column in self.data_series(args):
+            values = self.column_values(df, column)
+            for lag in lags:
+                time_series.shift_into(block[:, position], values, lag)
+                position += 1
+
+
+    def validate(self, preprocessing_task_request: dict):
+        super().validate(preprocessing_task_request)
+        self.positive_integers(preprocessing_task_request['args'], 'lags')
+
+
+class LeadFeatures(TimeSeriesFeatures):
+    # args: {'dataSeries': ['Revenue'], 'leads': [1]} makes Revenue_lead_1, the value of the next row
+
+    def feature_columns(self, args: dict) -> list:
+        return [f'{column}_lead_{lead}' for column in self.data_series(args) for lead in self.positive_integers(args, 'leads')]
+
+
+    def compute_features(self, args: dict, df: pd.DataFrame, block: np.ndarray):
+        leads = self.positive_integers(args, 'leads')
+        position = 0
+        for column in self.data_series(args):
+            values = self.column_values(df, column)
+            for lead in leads:
+                time_series.shift_into(block[:, position], values, -lead)
+                position += 1
+
+
+    def validate(self, preprocessing_task_request: dict):
+        super().validate(preprocessing_task_request)
+        self.positive_integers(preprocessing_task_request['args'], 'leads')
+
+
+class Differencing(TimeSeriesFeatures):
+    # args: {'dataSeries': ['Revenue'], 'periods': [1, 24]} makes Revenue_diff_1, ..., periods defaults to 1
+
+    def feature_columns(self, args: dict) -> list:
+        return [f'{column}_diff_{periods}' for column in self.data_series(args) for periods in self.positive_integers(args, 'periods', [1])]
+
+
+    def compute_features(self, args: dict, df: pd.DataFrame, block: np.ndarray):
+        all_periods = self.positive_integers(args, 'periods', [1])
+        position = 0
+        for column in self.data_series(args):
+            values = self.column_values(df, column)
+            for periods in all_periods:
+                time_series.diff_into(block[:, position], values, periods)
+                position += 1
+
+
+    def validate(self, preprocessing_task_request: dict):
+        super().validate(preprocessing_task_request)
+        self.positive_integers(preprocessing_task_request['args'], 'periods', [1])
+
+
+class RollingFeatures(TimeSeriesFeatures):
+    # args: {'dataSeries': ['Revenue'], 'windows': [24], 'statistics': ['mean', 'std'], 'minPeriods': 12}
+    # makes Revenue_rolling_24_mean, ... over the window of rows ending at each row, including it.
+    # statistics defaults to mean and minPeriods to the window, as in pandas
+
+    def feature_columns(self, args: dict) -> list:
+        return [f'{column}_rolling_{window}_{statistic}'
+                for column in self.data_series(args) for window in self.positive_integers(args, 'windows') for statistic in window_statistics(args)]
+
+
+    def compute_features(self, args: dict, df: pd.DataFrame, block: np.ndarray):
+        windows = self.positive_integers(args, 'windows')
+        statistics = window_statistics(args)
+        position = 0
+        for column in self.data_series(args):
+            values = self.column_values(df, column)
+
+            # Every window of a column is read off the same cumulative sums
+            sums = time_series.WindowSums(values)
+            for window in windows:
+                min_periods = args.get('minPeriods', window)
+                time_series.window_statistics_into(block[:, position:position + len(statistics)], values, window, statistics, min_periods, sums)
+                position += len(statistics)
+
+
+    def validate(self, preprocessing_task_request: dict):
+        super().validate(preprocessing_task_request)
+        args = preprocessing_task_request['args']
+        windows = self.positive_integers(args, 'windows')
+        window_statistics(args)
+        if 'minPeriods' in args and self.positive_integers(args, 'minPeriods')[0] > min(windows):
+            raise ValueError('minPeriods must not be more than the smallest window')
+
+
+class ExpandingFeatures(TimeSeriesFeatures):
+    # args: {'dataSeries': ['Revenue'], 'statistics': ['mean', 'max'], 'minPeriods': 1}
+    # makes Revenue_expanding_mean, ... over every row up to and including each row
+
+    def feature_columns(self, args: dict) -> list:
+        return [f'{column}_expanding_{statistic}' for column in self.data_series(args) for statistic in window_statistics(args)]
+
+
+    def compute_features(self, args: dict, df: pd.DataFrame, block: np.ndarray):
+        statistics = window_statistics(args)
+        position = 0
+        for column in self.data_series(args):
+            time_series.window_statistics_into(block[:, position:position + len(statistics)], self.column_values(df, column),
+                                               None, statistics, args.get('minPeriods', 1))
+            position += len(statistics)
+
+
+    def validate(self, preprocessing_task_request: dict):
+        super().validate(preprocessing_task_request)
+        window_statistics(preprocessing_task_request['args'])
+        self.positive_integers(preprocessing_task_request['args'], 'minPeriods', [1])
+
+
+class CalendarFeatures(TimeSeriesFeatures):
+    # args: {'features': ['hour', 'dayofweek', 'month'], 'cyclical': True} makes hour_sin, hour_cos, ...
+    # from the datetime index. Without cyclical each feature is one column of its value
+
+    def feature_columns(self, args: dict) -> list:
+        return time_series.calendar_columns(calendar_features(args), args.get('cyclical', False))
+
+
+    def compute_features(self, args: dict, df: pd.DataFrame, block: np.ndarray):
+        time_series.calendar_into(block, self.datetime_index(df), calendar_features(args), args.get('cyclical', False))
+
+
+    def validate(self, preprocessing_task_request: dict):
+        # Calendar features come from the index, so unlike the other tasks there is no dataSeries to check
+        IPreprocessing.validate(self, preprocessing_task_request)
+        calendar_features(preprocessing_task_request['args'])
+
+
+    def datetime_index(self, df: pd.DataFrame) -> pd.DatetimeIndex:
+        # Dates read from a file are parsed, numbers are refused rather than read as times since 1970
+        if isinstance(df.index, pd.DatetimeIndex):
+            return df.index
+        if not (pd.api.types.is_object_dtype(df.index) or pd.api.types.is_string_dtype(df.index)):
+            raise ValueError(f'CalendarFeatures needs an index of dates, the dataset index is {df.index.dtype}')
+
+        try:
+            return pd.DatetimeIndex(pd.to_datetime(df.index))
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'CalendarFeatures needs an index of dates: {e}')
+
+
+def window_statistics(args: dict) -> list:
+    statistics = args.get('statistics', ['mean'])
+    statistics = list(statistics) if isinstance(statistics, (list, tuple)) else [statistics]
+    unknown = [statistic for statistic in statistics if statistic not in time_series.WINDOW_STATISTICS]
+    if not statistics or unknown:
+        raise ValueError(f'Unknown window statistics {unknown}, expected some of {time_series.WINDOW_STATISTICS}')
+    return statistics
+
+
+def calendar_features(args: dict) -> list:
+    features = args.get('features', ['month', 'dayofweek', 'hour'])
+    features = list(features) if isinstance(features, (list, tuple)) else [features]
+    unknown = [feature for feature in features if feature not in time_series.CALENDAR_FEATURES]
+    if not features or unknown:
+        raise ValueError(f'Unknown calendar features {unknown}, expected some of {tuple(time_series.CALENDAR_FEATURES)}')
+    return features
+
+
+class PreprocessingPlan():
+    """A validated list of preprocessing steps compiled from the preprocessingTasks
+    of a job specification. Plans are cached and never changed once compiled, so
+    the same plan can be run any number of times.
+    """
+
+    def __init__(self, steps: list[tuple[IPreprocessing, dict]]):
+        self.steps = steps
+
+
+    def run(self, df: pd.DataFrame, report: list | None = None, progress: JobProgress | None = None) -> pd.DataFrame:
+        """Runs every step of the plan over the dataset
+
+        Args:
+            df (DataFrame): The data that is to be preprocessed
+
+            report (list | None): When given, the time and memory used by each step is appended to it
+
+            progress (JobProgress | None): When given, advanced before each step, which stops a cancelled job
+
+        Returns:
+            DataFrame: A DataFrame with the preprocessed data
+        """
+        for preprocessing, preprocessing_task_request in self.steps:
+            if progress is not None:
+                progress.advance(preprocessing_task_request['task'])
+
+            start_time = perf_counter()
+            start_memory = df.memory_usage(index=True).sum() if report is not None else 0
+
+            df = preprocessing.preprocess_data(preprocessing_task_request, df)
+
+            if report is not None:
+                memory = df.memory_usage(index=True).sum()
+                report.append({'task': preprocessing_task_request['task'],
+                               'seconds': perf_counter() - start_time,
+                               'memoryBytes': int(memory),
+                               'memoryDeltaBytes': int(memory - start_memory)
+                               })
+
+        return df
+
+
+def compile_preprocessing_plan(preprocessing_tasks: list | None) -> PreprocessingPlan:
+    """Validates the preprocessingTasks of a job specification and compiles them into a
+    plan, fusing adjacent steps that can run as one. Plans are cached by their tasks.
+
+    Args:
+        preprocessing_tasks (list | None): The preprocessingTasks section of the job specification
+
+    Raises:
+        ValueError: An error will appear when a task request is not valid
+
+    Returns:
+        PreprocessingPlan: The compiled plan
+    """
+    return _compile_preprocessing_plan(json.dumps(preprocessing_tasks or [], sort_keys=True))
+
+
+@lru_cache(maxsize=64)
+def _compile_preprocessing_plan(preprocessing_tasks_json: str) -> PreprocessingPlan:
+    preprocessing_task_requests = json.loads(preprocessing_tasks_json)
+    if not isinstance(preprocessing_task_requests, list):
+        raise ValueError('preprocessingTasks must be a list of tasks')
+
+    steps = []
+    for preprocessing_task_request in preprocessing_task_requests:
+        if not isinstance(preprocessing_task_request, dict) or not isinstance(preprocessing_task_request.get('task'), str):
+            raise ValueError(f'A preprocessing task needs the name of its task, not {preprocessing_task_request!r}')
+        preprocessing_task_request.setdefault('args', {})
+        preprocessing = preprocessing_factory(preprocessing_task_request['task'])
+        preprocessing.validate(preprocessing_task_request)
+
+        # Try to fold the task into the step before it
+        if steps and steps[-1][1]['task'] == preprocessing_task_request['task']:
+            fused_task_request = preprocessing.fuse(steps[-1][1], preprocessing_task_request)
+            if fused_task_request is not None:
+                steps[-1] = (preprocessing, fused_task_request)
+                continue
+
+        steps.append((preprocessing, preprocessing_task_request))
+
+    return PreprocessingPlan(steps)
+
+
+# The preprocessing tasks a job specification may name, base classes and the plan are left out
+PREPROCESSING_TASKS = {preprocessing_class.__name__: preprocessing_class
+                       for preprocessing_class in (Interpolation, DropNaNs, LagFeatures, LeadFeatures, Differencing,
+                                                   RollingFeatures, ExpandingFeatures, CalendarFeatures)}
+
+
+@lru_cache(maxsize=None)
 def preprocessing_factory(preprocessing_task_name: str) -> IPreprocessing :
-    """Uses the preprocessing_task_name to dynamically import a module
-    and instantiate a preprocessing class.
+    """Looks the preprocessing_task_name up among the preprocessing tasks
+    and instantiates its class. Preprocessing classes hold no state,
+    so one instance per class is cached and shared.
 
     Args:
-        preprocessing_task_name (str): Name of the preprocessing class/module.
+        preprocessing_task_name (str): Name of the preprocessing class.
 
     Raises:
-        ImportError: An error will appear when something is wrong with the import
+        ValueError: An error will appear when there is no such preprocessing task
 
     Returns:
         Preprocessing:  Instance of the preprocessing class.
     """
-    try:
-        MODULE_NAME = 'src'
-        return getattr(import_module(f'.preprocessing', MODULE_NAME), preprocessing_task_name)()
-    except (ModuleNotFoundError, AttributeError) as e:
-        raise ImportError(f'Error importing preprocessing class {preprocessing_task_name}: {e}')
\ No newline at end of file
+    preprocessing_class = PREPROCESSING_TASKS.get(preprocessing_task_name)
+    if preprocessing_class is None:
+        raise ValueError(f'Unknown preprocessing task {preprocessing_task_name}, expected one of {tuple(PREPROCESSING_TASKS)}')
+
+    return preprocessing_class()
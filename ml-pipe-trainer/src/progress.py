@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for tracking the progress
+of a running job and for cancelling it.
+ """
+#----------------------------------
+#
+#
+from time import monotonic
+import threading
+
+JOB_STATUSES = ('running', 'finished', 'cancelled', 'error')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobProgress():
+    """Progress of one job, updated by the pipeline from the thread running it and
+    read from the event loop. The pipeline calls check_cancelled between its steps,
+    so a cancelled job stops at the next preprocessing step, model, search rung or
+    incremental chunk.
+    """
+
+    def __init__(self, token: str | None = None):
+        self.token = token
+        self.status = 'running'
+        self.error = None
+        self.started_at = monotonic()
+        self.finished_at = None
+
+        # The stage running now and how far through it is, steps is None when it is not known up front
+        self.stage = None
+        self.stage_started_at = None
+        self.step = 0
+        self.steps = None
+        self.step_name = None
+
+        self.models = 0
+        self.models_done = 0
+        self.model_id = None
+
+        self.__cancelled = threading.Event()
+        self.__lock = threading.Lock()
+
+
+    def start_stage(self, stage: str, steps: int | None = None):
+        with self.__lock:
+            self.stage = stage
+            self.stage_started_at = monotonic()
+            self.step = 0
+            self.steps = steps
+            self.step_name = None
+
+
+    def advance(self, step_name: str | None = None):
+        """Moves on to the next step of the stage, unless the job has been cancelled
+
+        Raises:
+            JobCancelled: An error will appear when the job has been cancelled
+        """
+        self.check_cancelled()
+        with self.__lock:
+            self.step += 1
+            self.step_name = step_name
+
+
+    def add_models(self, count: int):
+        with self.__lock:
+            self.models += count
+
+
+    def start_model(self, model_id: str | None):
+        self.check_cancelled()
+        with self.__lock:
+            self.model_id = model_id
+
+
+    def finish_model(self):
+        with self.__lock:
+            self.models_done += 1
+            self.model_id = None
+
+
+    def cancel(self) -> bool:
+        """Asks the job to stop, False if it had already stopped"""
+        if self.status != 'running':
+            return False
+
+        self.__cancelled.set()
+        return True
+
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__cancelled.is_set()
+
+
+    def check_cancelled(self):
+        if self.__cancelled.is_set():
+            raise JobCancelled(f'Job {self.token} was cancelled')
+
+
+    def finish(self, status: str, error: str | None = None):
+        with self.__lock:
+            self.status = status
+            self.error = error
+            self.finished_at = monotonic()
+
+
+    def to_dict(self) -> dict:
+        with self.__lock:
+            now = self.finished_at if self.finished_at is not None else monotonic()
+            return {'token': self.token,
+                    'status': self.status,
+                    'cancelRequested': self.cancelled,
+                    'elapsedSeconds': now - self.started_at,
+                    'stage': {'name': self.stage,
+                              'step': self.step,
+                              'steps': self.steps,
+                              'stepName': self.step_name,
+                              'elapsedSeconds': now - self.stage_started_at if self.stage_started_at is not None else None
+                              },
+                    'models': {'done': self.models_done,
+                               'total': self.models,
+                               'current': self.model_id
+                               },
+                    'error': self.error
+                    }
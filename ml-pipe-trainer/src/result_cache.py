@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for caching the results
+of jobs on local disk so repeated jobs are not retrained.
+ """
+#----------------------------------
+#
+#
+from functools import lru_cache
+from hashlib import sha256
+from importlib.metadata import PackageNotFoundError, version
+from tempfile import gettempdir
+import json
+import os
+import threading
+
+from src.results import JobResults
+
+RESULT_CACHE_DIRECTORY = os.getenv('RESULT_CACHE_DIRECTORY', os.path.join(gettempdir(), 'ml-pipe-result-cache'))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# Libraries whose version changes the results of a job
+RESULT_LIBRARIES = ('numpy', 'pandas', 'scikit-learn')
+
+# Sections of a job specification that change how a job runs but not its results
+EXECUTION_ONLY_KEYS = ('execution',)
+
+
+@lru_cache(maxsize=None)
+def library_versions() -> tuple:
+    versions = []
+    for library in RESULT_LIBRARIES:
+        try:
+            versions.append((library, version(library)))
+        except PackageNotFoundError:
+            versions.append((library, None))
+
+    return tuple(versions)
+
+
+def result_key(dataset_digest: str, job_specification: dict) -> str:
+    """Content address of the results of a job
+
+    Args:
+        dataset_digest (str): sha256 hex digest of the dataset bytes
+
+        job_specification (dict): The job specification
+
+    Returns:
+        str: sha256 hex digest of the dataset, the normalized job specification and the library versions
+    """
+    normalized_job_specification = {key: value for key, value in job_specification.items() if key not in EXECUTION_ONLY_KEYS}
+    key = json.dumps({'dataset': dataset_digest,
+                      'job': normalized_job_specification,
+                      'libraries': library_versions()
+                      }, sort_keys=True, default=str)
+
+    return sha256(key.encode()).hexdigest()
+
+
+class ResultCache():
+    """Results of finished jobs stored on local disk by their result_key. Reading an
+    entry marks it as recently used and the least recently used entries are evicted
+    once the cache grows past its size limit.
+    """
+
+    def __init__(self, directory: str = RESULT_CACHE_DIRECTORY, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def get(self, key: str) -> JobResults | None:
+        path = self.__path(key)
+        with self.__lock:
+            try:
+                with open(path) as file:
+                    results = file.read()
+                os.utime(path) # The modification time orders entries for eviction
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+        return JobResults.from_json(results)
+
+
+    def put(self, key: str, job_results: JobResults):
+        path = self.__path(key)
+        with self.__lock:
+            # Written to the side then moved into place so a reader never sees half an entry
+            temporary_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(temporary_path, 'w') as file:
+                file.write(job_results.to_json())
+            os.replace(temporary_path, path)
+
+            self.__evict()
+
+
+    def stats(self) -> dict:
+        with self.__lock:
+            entries = self.__entries()
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(entries),
+                    'bytes': sum(size for _, size, _ in entries)
+                    }
+
+
+    def __evict(self):
+        entries = sorted(self.__entries(), key=lambda entry: entry[2])
+        total_bytes = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+
+
+    def __entries(self) -> list[tuple[str, int, float]]:
+        entries = []
+        with os.scandir(self.directory) as directory_entries:
+            for entry in directory_entries:
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+
+        return entries
+
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
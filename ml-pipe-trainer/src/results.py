@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+""" This file contains the results of a job and
+the logic for serializing them a chunk at a time.
+ """
+#----------------------------------
+#
+#
+import json
+import zlib
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+RESULT_TABLES = ('models', 'predictions')
+RESULT_FORMATS = {'json': 'application/json',
+                  'ndjson': 'application/x-ndjson',
+                  'arrow': 'application/vnd.apache.arrow.stream'
+                  }
+
+# Compression of the buffers in an Arrow stream, lz4 is also understood by every pyarrow build
+ARROW_COMPRESSION = 'zstd'
+NDJSON_COMPRESSION_LEVEL = 6
+
+
+class JobResults():
+    """The results of a job as two tables. 'models' has a row per model with its
+    score, its artifact and any metrics it asked for. 'predictions' has a row per
+    testing row of each model that set returnPredictions, with the columns
+    model_id, index, y_true, y_pred and residual.
+    """
+
+    def __init__(self, df_models: DataFrame, df_predictions: DataFrame | None = None):
+        self.models = df_models
+        self.predictions = df_predictions if df_predictions is not None else empty_predictions()
+
+
+    @classmethod
+    def from_model_metrics(cls, model_definitions: list, all_model_metrics: list) -> 'JobResults':
+        """Builds the tables from the metrics returned for each model, in the order of the model definitions"""
+        all_performance_metrics, all_predictions = [], []
+        for model_definition, model_metrics in zip(model_definitions, all_model_metrics):
+            performance_metrics = {}
+
+            performance_metrics['model_id'] = model_definition['id']
+
+            # score first, then anything else the model reports such as its metrics or a search leaderboard
+            performance_metrics['score'] = model_metrics.pop('score')
+            predictions = model_metrics.pop('predictions', None)
+            performance_metrics.update(model_metrics)
+
+            all_performance_metrics.append(performance_metrics)
+            if predictions is not None:
+                all_predictions.append(predictions_frame(model_definition['id'], predictions))
+
+        df_predictions = pd.concat(all_predictions, ignore_index=True) if all_predictions else None
+
+        return cls(DataFrame(all_performance_metrics), df_predictions)
+
+
+    def table(self, name: str) -> DataFrame:
+        if name not in RESULT_TABLES:
+            raise ValueError(f'Unknown results table {name}')
+
+        return self.models if name == 'models' else self.predictions
+
+
+    def to_records(self, name: str = 'models') -> list:
+        return json.loads(self.table(name).to_json(orient="records"))
+
+
+    def iterate_ndjson(self, name: str, chunk_rows: int):
+        """A table as gzip compressed newline delimited JSON, a record per line
+
+        Yields:
+            bytes: The next piece of the gzip stream
+        """
+        compressor = zlib.compressobj(NDJSON_COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        df = self.table(name)
+        for offset in range(0, len(df), chunk_rows):
+            lines = df.iloc[offset:offset + chunk_rows].to_json(orient="records", lines=True)
+            compressed = compressor.compress(lines.encode() if lines.endswith('\n') else f'{lines}\n'.encode())
+            if compressed:
+                yield compressed
+
+        yield compressor.flush()
+
+
+    def iterate_arrow(self, name: str, chunk_rows: int):
+        """A table as an Arrow IPC stream with compressed buffers, a record batch per chunk
+
+        Raises:
+            ValueError: An error will appear when pyarrow is missing
+
+        Yields:
+            bytes: The schema, then each record batch, then the end of the stream
+        """
+        if pa is None:
+            raise ValueError('pyarrow is required for arrow results')
+
+        table = pa.Table.from_pandas(_arrow_compatible(self.table(name)), preserve_index=False)
+        sink = _ChunkSink()
+        options = pa.ipc.IpcWriteOptions(compression=ARROW_COMPRESSION)
+        with pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), table.schema, options=options) as writer:
+            yield sink.take()
+            for batch in table.to_batches(max_chunksize=chunk_rows):
+                writer.write_batch(batch)
+                yield sink.take()
+
+        yield sink.take()
+
+
+    def to_json(self) -> str:
+        """Both tables as one JSON document, for the result cache"""
+        return json.dumps({'models': self.models.to_json(orient="records"),
+                           'predictions': self.predictions.to_json(orient="split", index=False)})
+
+
+    @classmethod
+    def from_json(cls, results: str) -> 'JobResults':
+        results = json.loads(results)
+
+        # Entries written before predictions were kept are only the models table
+        if isinstance(results, list):
+            return cls(DataFrame(results))
+
+        # Built straight from the JSON rather than with read_json, which would read ids such as "1" as numbers
+        predictions = json.loads(results['predictions'])
+        df_predictions = DataFrame(predictions['data'], columns=predictions['columns'])
+        if not len(df_predictions):
+            df_predictions = None
+        else:
+            # A residual is null in JSON for classes, which is NaN in a fresh table
+            df_predictions['residual'] = df_predictions['residual'].astype(np.float64)
+
+        return cls(DataFrame(json.loads(results['models'])), df_predictions)
+
+
+def predictions_frame(model_id: str, predictions: dict) -> DataFrame:
+    y_true, y_pred = np.asarray(predictions['yTrue']), np.asarray(predictions['yPred'])
+    index = predictions.get('index')
+
+    df = DataFrame({'model_id': model_id,
+                    'index': np.asarray(index).astype(str) if index is not None else np.arange(len(y_true)).astype(str),
+                    'y_true': y_true,
+                    'y_pred': y_pred
+                    })
+
+    # Residuals only mean something for numbers, classes are left without one
+    if np.issubdtype(y_true.dtype, np.number) and np.issubdtype(y_pred.dtype, np.number):
+        df['residual'] = y_pred.astype(np.float64) - y_true.astype(np.float64)
+    else:
+        df['residual'] = np.nan
+
+    return df
+
+
+def empty_predictions() -> DataFrame:
+    return DataFrame({'model_id': pd.Series(dtype=str),
+                      'index': pd.Series(dtype=str),
+                      'y_true': pd.Series(dtype=np.float64),
+                      'y_pred': pd.Series(dtype=np.float64),
+                      'residual': pd.Series(dtype=np.float64)})
+
+
+def _arrow_compatible(df: DataFrame) -> DataFrame:
+    # Nested columns such as a search leaderboard hold dicts and lists of mixed types,
+    # Arrow needs one type per column so they are sent as JSON strings
+    df = df.copy(deep=False)
+    for column in df.columns:
+        if df[column].dtype == object and df[column].map(lambda value: isinstance(value, (dict, list))).any():
+            df[column] = df[column].map(lambda value: json.dumps(value, default=str) if isinstance(value, (dict, list)) else value)
+
+    return df
+
+
+class _ChunkSink():
+    """File like object the Arrow writer writes to, holding what was written until it is taken"""
+
+    def __init__(self):
+        self.closed = False
+        self.__chunks = []
+
+
+    def write(self, data) -> int:
+        self.__chunks.append(bytes(data))
+        return len(data)
+
+
+    def flush(self):
+        pass
+
+
+    def close(self):
+        self.closed = True
+
+
+    def take(self) -> bytes:
+        chunks, self.__chunks = self.__chunks, []
+        return b''.join(chunks)
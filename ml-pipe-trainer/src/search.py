@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for searching the
+hyperparameters of a model with successive halving.
+ """
+#----------------------------------
+#
+#
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from itertools import product
+from math import ceil, log
+import multiprocessing
+import os
+
+import numpy as np
+
+from src.progress import JobProgress
+from src.shared_dataset import SharedArrays, share_arrays
+
+SEARCH_STRATEGIES = ('grid', 'random', 'bayesian')
+
+# Share of the training rows held back to rank trials when the split has no validation years
+SELECTION_FRACTION = 0.2
+
+
+class HyperparameterSearch():
+    """Runs the search block of a model definition. Candidates are sampled from the
+    search space, then raced with successive halving: every candidate is fitted on a
+    small slice of the most recent training rows, only the best 1/factor move on to
+    a slice factor times larger, until the survivors are fitted on every training row.
+
+    The search block looks like
+        {'strategy': 'grid' | 'random' | 'bayesian',
+         'space': {'max_depth': [4, 8, 16], 'alpha': {'low': 1e-5, 'high': 1e-1, 'log': True}},
+         'budget': 27, 'halving': {'factor': 3, 'minRows': 200}, 'maxWorkers': 4, 'seed': 0}
+
+    Values given as a list are picked from, values given as {'low', 'high'} are drawn
+    from that range, as integers when both ends are integers.
+    """
+
+    def __init__(self, model_definition: dict, dataset: dict, evaluate_trial, progress: JobProgress | None = None):
+        """
+        Args:
+            model_definition (dict): The model definition holding the search block
+
+            dataset (dict): The (X, y) matrices of the model's split
+
+            evaluate_trial (Callable): evaluate_trial(model_definition, dataset, n_training_rows)
+            fits a model on the last n_training_rows of dataset['training'] and scores it on dataset['selection']
+
+            progress (JobProgress | None): Checked for cancellation before each trial, or each rung when trials run in parallel
+        """
+        self.model_definition = model_definition
+        self.progress = progress if progress is not None else JobProgress()
+        self.search = model_definition['search']
+        self.evaluate_trial = evaluate_trial
+
+        self.strategy = self.search.get('strategy', 'random')
+        if self.strategy not in SEARCH_STRATEGIES:
+            raise ValueError(f'Unsupported search strategy {self.strategy}')
+
+        self.space = self.search['space']
+        self.budget = int(self.search.get('budget', 10))
+        self.factor = max(2, int(self.search.get('halving', {}).get('factor', 3)))
+        self.min_rows = int(self.search.get('halving', {}).get('minRows', 100))
+        self.rng = np.random.default_rng(self.search.get('seed'))
+
+        self.dataset = self.__get_selection_dataset(dataset)
+        self.n_training_rows = len(self.dataset['training'][1])
+
+        self.leaderboard = []
+
+
+    def run(self) -> dict:
+        """Runs the search
+
+        Returns:
+            dict: 'bestParams' and the 'leaderboard' of every trial, best first
+        """
+        with self.__trial_executor() as executor:
+            if self.strategy == 'bayesian':
+                # A few rounds, each one sampling around the best trials of the rounds before it
+                rounds = max(1, int(self.search.get('rounds', 3)))
+                for round_number in range(rounds):
+                    budget = self.budget // rounds + (self.budget % rounds if round_number == 0 else 0)
+                    candidates = self.__sample_random(budget) if round_number == 0 else self.__sample_near_best(budget, round_number)
+                    self.__successive_halving(candidates, executor)
+            else:
+                candidates = self.__sample_grid() if self.strategy == 'grid' else self.__sample_random(self.budget)
+                self.__successive_halving(candidates, executor)
+
+        self.leaderboard.sort(key=lambda trial: (trial['rows'], trial['score']), reverse=True)
+
+        return {'bestParams': self.leaderboard[0]['params'], 'leaderboard': self.leaderboard}
+
+
+    def __successive_halving(self, candidates: list[dict], executor):
+        if not candidates:
+            return
+
+        # Enough rungs to narrow the candidates down to one, the last rung uses every row
+        rungs = max(1, ceil(log(len(candidates), self.factor))) if len(candidates) > 1 else 1
+        for rung in range(rungs):
+            is_last_rung = rung == rungs - 1
+            n_rows = self.n_training_rows if is_last_rung else max(min(self.min_rows, self.n_training_rows), self.n_training_rows // self.factor ** (rungs - 1 - rung))
+
+            scores = self.__evaluate(candidates, n_rows, executor)
+            ranked = sorted(zip(scores, range(len(candidates))), reverse=True)
+
+            survivors = max(1, len(candidates) // self.factor)
+            for position, (score, candidate_number) in enumerate(ranked):
+                if is_last_rung or position >= survivors:
+                    self.leaderboard.append({'params': candidates[candidate_number], 'score': score, 'rows': n_rows})
+
+            if is_last_rung:
+                break
+            candidates = [candidates[candidate_number] for _, candidate_number in ranked[:survivors]]
+
+
+    def __evaluate(self, candidates: list[dict], n_rows: int, executor) -> list[float]:
+        trial_definitions = [self.__trial_definition(params) for params in candidates]
+        if executor is None:
+            scores = []
+            for trial_definition in trial_definitions:
+                self.progress.check_cancelled()
+                scores.append(self.evaluate_trial(trial_definition, self.dataset, n_rows))
+            return scores
+
+        self.progress.check_cancelled()
+
+        return list(executor.map(run_trial_in_worker, [self.evaluate_trial] * len(trial_definitions), trial_definitions, [n_rows] * len(trial_definitions)))
+
+
+    def __trial_definition(self, params: dict) -> dict:
+        trial_definition = {key: value for key, value in self.model_definition.items() if key != 'search'}
+        trial_definition['modelParams'] = {**(self.model_definition.get('modelParams') or {}), **params}
+        return trial_definition
+
+
+    def __trial_executor(self):
+        # Trials run in worker processes sharing the split through memory mapped arrays,
+        # unless this is already a worker process or there is only one core to use
+        worker_count = self.__get_worker_count()
+        if worker_count <= 1 or multiprocessing.parent_process() is not None:
+            return nullcontext()
+
+        return trial_executor(self.dataset, worker_count)
+
+
+    def __get_worker_count(self) -> int:
+        cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+        n_jobs = (self.model_definition.get('modelParams') or {}).get('n_jobs') or 1
+        n_jobs = cpu_count if n_jobs < 0 else n_jobs
+
+        return max(1, min(int(self.search.get('maxWorkers', cpu_count)), cpu_count // n_jobs))
+
+
+    def __sample_grid(self) -> list[dict]:
+        names = list(self.space)
+        for name in names:
+            if not isinstance(self.space[name], list):
+                raise ValueError(f'A grid search needs a list of values for {name}')
+
+        grid = [dict(zip(names, values)) for values in product(*(self.space[name] for name in names))]
+        if len(grid) > self.budget:
+            grid = [grid[position] for position in sorted(self.rng.choice(len(grid), self.budget, replace=False))]
+
+        return grid
+
+
+    def __sample_random(self, budget: int) -> list[dict]:
+        return [{name: self.__sample_value(values) for name, values in self.space.items()} for _ in range(budget)]
+
+
+    def __sample_near_best(self, budget: int, round_number: int) -> list[dict]:
+        # Perturb the best finished trials, narrowing the perturbation each round
+        finished = sorted(self.leaderboard, key=lambda trial: (trial['rows'], trial['score']), reverse=True)
+        best = [trial['params'] for trial in finished[:max(1, len(finished) // 4)]]
+        spread = 0.25 / (round_number + 1)
+
+        candidates = []
+        for candidate_number in range(budget):
+            parent = best[candidate_number % len(best)]
+            candidates.append({name: self.__perturb_value(values, parent[name], spread) for name, values in self.space.items()})
+
+        return candidates
+
+
+    def __sample_value(self, values):
+        if isinstance(values, list):
+            return values[self.rng.integers(len(values))]
+
+        low, high, is_log = values['low'], values['high'], values.get('log', False)
+        value = np.exp(self.rng.uniform(np.log(low), np.log(high))) if is_log else self.rng.uniform(low, high)
+        return self.__cast(values, value)
+
+
+    def __perturb_value(self, values, value, spread: float):
+        if isinstance(values, list):
+            # Mostly keep the parents value, sometimes step to a neighbouring one
+            position = values.index(value) + self.rng.choice([-1, 0, 0, 1])
+            return values[int(np.clip(position, 0, len(values) - 1))]
+
+        low, high, is_log = values['low'], values['high'], values.get('log', False)
+        if is_log:
+            value = np.exp(self.rng.normal(np.log(value), spread * (np.log(high) - np.log(low))))
+        else:
+            value = self.rng.normal(value, spread * (high - low))
+        return self.__cast(values, np.clip(value, low, high))
+
+
+    def __cast(self, values: dict, value: float):
+        if isinstance(values['low'], int) and isinstance(values['high'], int):
+            return int(round(value))
+        return float(value)
+
+
+    def __get_selection_dataset(self, dataset: dict) -> dict:
+        X_train, y_train = dataset['training']
+        if dataset.get('validation') is not None:
+            return {'training': (X_train, y_train), 'selection': dataset['validation']}
+
+        # Hold back the most recent training rows to rank the trials on
+        n_selection_rows = max(1, int(len(y_train) * SELECTION_FRACTION))
+        return {'training': (X_train[:-n_selection_rows], y_train[:-n_selection_rows]),
+                'selection': (X_train[-n_selection_rows:], y_train[-n_selection_rows:])}
+
+
+@contextmanager
+def trial_executor(dataset: dict, worker_count: int):
+    """Process pool whose workers map the search dataset from shared memory on start up"""
+    arrays = {f'{split_name}.{part}': values for split_name, XY in dataset.items() for part, values in zip('Xy', XY)}
+
+    with share_arrays(arrays) as shared_arrays:
+        with ProcessPoolExecutor(max_workers = worker_count,
+                                 mp_context = multiprocessing.get_context('spawn'),
+                                 initializer = attach_search_dataset,
+                                 initargs = (shared_arrays,)) as executor:
+            yield executor
+
+
+# The search dataset as seen from inside a worker process
+WORKER_SEARCH_DATASET = None
+
+def attach_search_dataset(shared_arrays: SharedArrays):
+    global WORKER_SEARCH_DATASET
+    arrays = shared_arrays.load()
+    WORKER_SEARCH_DATASET = {split_name: (arrays[f'{split_name}.X'], arrays[f'{split_name}.y']) for split_name in ('training', 'selection')}
+
+
+def run_trial_in_worker(evaluate_trial, trial_definition: dict, n_training_rows: int) -> float:
+    return evaluate_trial(trial_definition, WORKER_SEARCH_DATASET, n_training_rows)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+""" This file contains the production startup of the
+trainer. The app and its libraries are imported and warmed
+up once in a parent process, which then forks the processes
+serving requests so they start warm and share its memory.
+
+    python -m src.serve --host 0.0.0.0 --port 80
+ """
+#----------------------------------
+#
+#
+from argparse import ArgumentParser
+from io import BytesIO
+from time import monotonic, perf_counter, sleep
+import gc
+import os
+import signal
+import socket
+import sys
+
+import pandas as pd
+import uvicorn
+
+# Processes serving requests. A job lives in the process it was posted to, so a worker
+# leased to jobs needs exactly one, more only make sense for a trainer serving predictions
+TRAINER_SERVER_WORKERS = int(os.getenv('TRAINER_SERVER_WORKERS', 1))
+
+# A serving process that dies sooner than this after being forked is forked again only after a pause
+RESTART_BACKOFF_SECONDS = 1
+MIN_UPTIME_SECONDS = 5
+
+# How long serving processes get to stop before they are killed, a running job does not stop them
+STOP_TIMEOUT_SECONDS = 3
+WAIT_POLL_SECONDS = 0.1
+
+
+def preload(fit: bool = True):
+    """Imports the app and every library a job uses, then runs each of them
+    once on tiny inputs so their lazily loaded parts are loaded as well.
+    """
+    from src.main import app
+    from src.training import warm_up
+
+    warm_up(fit = fit)
+
+    # pandas imports its pyarrow CSV reader on first use
+    engine = 'pyarrow' if _has_pyarrow() else 'c'
+    pd.read_csv(BytesIO(b'index,a\n0,1\n'), index_col = 0, engine = engine)
+
+    return app
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    # Bound once here and inherited by every serving process, which all accept on it
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve(app, sock: socket.socket, log_level: str):
+    config = uvicorn.Config(app, log_level = log_level, timeout_graceful_shutdown = 5)
+    uvicorn.Server(config).run(sockets = [sock])
+
+
+class Supervisor():
+    """Forks the serving processes from the warm parent and forks them again if they die"""
+
+    def __init__(self, app, sock: socket.socket, workers: int, log_level: str):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.log_level = log_level
+        self.stopping = False
+        self.stop_deadline = None
+
+        # Serving process ids mapped to when they were forked
+        self.children = {}
+
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for _ in range(self.workers):
+            self.fork()
+
+        while self.children:
+            if self.stopping and monotonic() > self.stop_deadline:
+                self.signal_children(signal.SIGKILL)
+
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+
+            if pid == 0:
+                sleep(WAIT_POLL_SECONDS)
+                continue
+
+            forked_at = self.children.pop(pid, None)
+            if forked_at is None or self.stopping:
+                continue
+
+            print(f'Serving process {pid} exited with {os.waitstatus_to_exitcode(status)}, forking another', file=sys.stderr)
+            if monotonic() - forked_at < MIN_UPTIME_SECONDS:
+                sleep(RESTART_BACKOFF_SECONDS)
+            self.fork()
+
+
+    def fork(self):
+        pid = os.fork()
+        if pid != 0:
+            self.children[pid] = monotonic()
+            return
+
+        # The serving process, uvicorn installs its own signal handlers
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        gc.unfreeze()
+        try:
+            serve(self.app, self.sock, self.log_level)
+        finally:
+            os._exit(0)
+
+
+    def stop(self, signal_number, frame):
+        if not self.stopping:
+            self.stopping = True
+            self.stop_deadline = monotonic() + STOP_TIMEOUT_SECONDS
+        self.signal_children(signal.SIGTERM)
+
+
+    def signal_children(self, signal_number: int):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal_number)
+            except ProcessLookupError:
+                pass
+
+
+def _has_pyarrow() -> bool:
+    try:
+        import pyarrow.csv
+    except ImportError:
+        return False
+    return True
+
+
+def main(argv: list | None = None):
+    parser = ArgumentParser(description='Starts the trainer with its libraries preloaded')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument('--workers', type=int, default=TRAINER_SERVER_WORKERS, help='Processes serving requests')
+    parser.add_argument('--no-warm-up-fit', action='store_true', help='Only import the libraries, without fitting each model once')
+    parser.add_argument('--log-level', default='info')
+    args = parser.parse_args(argv)
+
+    start = perf_counter()
+    app = preload(fit = not args.no_warm_up_fit)
+    print(f'Trainer preloaded in {perf_counter() - start:.2f}s', file=sys.stderr)
+
+    sock = bind_socket(args.host, args.port)
+
+    # Without fork, as on Windows, the one serving process is this one
+    if not hasattr(os, 'fork'):
+        serve(app, sock, args.log_level)
+        return
+
+    # Objects made so far are moved out of the collector's reach, so collections in
+    # the serving processes don't write to, and so copy, the pages they share with us
+    gc.collect()
+    gc.freeze()
+
+    Supervisor(app, sock, max(1, args.workers), args.log_level).run()
+
+
+if __name__ == '__main__':
+    main()
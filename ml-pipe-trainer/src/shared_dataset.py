@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+""" This file contains logic for sharing a dataset
+with worker processes without pickling it for every task.
+ """
+#----------------------------------
+#
+#
+import os
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+# Memory mapped files go to shared memory when the host has it
+SHARED_DATA_DIRECTORY = os.getenv('SHARED_DATA_DIRECTORY', '/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+
+class SharedArrays():
+    """Picklable handle to a set of named arrays. Numeric arrays are written
+    once to .npy files that worker processes memory map read only, arrays
+    holding python objects travel with the handle itself.
+    """
+
+    def __init__(self, arrays: dict, directory: str):
+        self.directory = directory
+        self.names = list(arrays)
+
+        # Array positions mapped to their values when they can't be memory mapped
+        self.inline_arrays = {}
+        for position, values in enumerate(arrays.values()):
+            if values.dtype.hasobject:
+                self.inline_arrays[position] = values
+            else:
+                np.save(self.__path(position), values, allow_pickle = False)
+
+
+    def load(self) -> dict:
+        """Maps the shared arrays into this process
+
+        Returns:
+            dict: The arrays by name, read only
+        """
+        arrays = {}
+        for position, name in enumerate(self.names):
+            values = self.inline_arrays.get(position)
+            arrays[name] = values if values is not None else np.load(self.__path(position), mmap_mode = 'r', allow_pickle = False)
+
+        return arrays
+
+
+    def __path(self, position: int) -> str:
+        return os.path.join(self.directory, f'{position}.npy')
+
+
+@contextmanager
+def share_arrays(arrays: dict):
+    """Writes the arrays out for worker processes and removes them again once they are done
+
+    Args:
+        arrays (dict): The arrays to share by name
+
+    Yields:
+        SharedArrays: Handle to pass to the worker processes
+    """
+    with TemporaryDirectory(prefix = 'shared-dataset-', dir = SHARED_DATA_DIRECTORY) as directory:
+        yield SharedArrays(arrays, directory)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+""" This file contains vectorized NumPy kernels for
+time series features. Each kernel writes its results into
+columns of a preallocated block, so a preprocessing task
+adds all of its features to the dataset at once.
+ """
+#----------------------------------
+#
+#
+import numpy as np
+import pandas as pd
+
+WINDOW_STATISTICS = ('mean', 'sum', 'std', 'var', 'min', 'max', 'count')
+
+# Calendar features and the period each one repeats over, for their sine and cosine encodings
+CALENDAR_FEATURES = {'year': None,
+                     'quarter': 4,
+                     'month': 12,
+                     'weekofyear': 52,
+                     'day': 31,
+                     'dayofweek': 7,
+                     'dayofyear': 365.25,
+                     'hour': 24,
+                     'minute': 60,
+                     'isweekend': None
+                     }
+
+
+def shift_into(out: np.ndarray, x: np.ndarray, periods: int):
+    """Writes x shifted down by periods rows into out, up when periods is negative, as DataFrame.shift"""
+    if periods == 0:
+        out[:] = x
+    elif abs(periods) >= len(x):
+        out[:] = np.nan
+    elif periods > 0:
+        out[:periods] = np.nan
+        out[periods:] = x[:-periods]
+    else:
+        out[periods:] = np.nan
+        out[:periods] = x[-periods:]
+
+
+def diff_into(out: np.ndarray, x: np.ndarray, periods: int):
+    """Writes x minus x shifted by periods rows into out, as DataFrame.diff"""
+    shift_into(out, x, periods)
+    np.subtract(x, out, out=out)
+
+
+class WindowSums():
+    """Cumulative sums of a column, from which the sum, mean and variance of any trailing
+    window are two lookups. As in pandas rolling, NaNs and infinities are left out and
+    counted, so an infinity only affects the windows holding it. The column is centred
+    on its mean first so the sums of squares don't cancel out.
+    """
+
+    def __init__(self, x: np.ndarray):
+        valid = np.isfinite(x)
+        centre = x[valid].mean() if valid.any() else 0.0
+        centred = np.where(valid, x - centre, 0.0)
+
+        # A leading zero so the sum of rows [a, b) is cumsum[b] - cumsum[a]
+        self.centre = centre
+        self.count = np.concatenate(([0], np.cumsum(valid, dtype=np.int64)))
+        self.total = np.concatenate(([0.0], np.cumsum(centred)))
+        self.squares = np.concatenate(([0.0], np.cumsum(centred * centred)))
+
+        # The count statistic still counts infinities, only kept apart when there are any
+        observed = ~np.isnan(x)
+        self.has_infinities = not np.array_equal(observed, valid)
+        self.observed = np.concatenate(([0], np.cumsum(observed, dtype=np.int64))) if self.has_infinities else self.count
+
+
+    def window(self, window: int | None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Count of finite values, centred sum and centred sum of squares of the window
+        ending at each row, every row so far when window is None"""
+        return _trailing(self.count, window), _trailing(self.total, window), _trailing(self.squares, window)
+
+
+    def observed_count(self, window: int | None) -> np.ndarray:
+        """Count of the values that are not NaN in the window ending at each row"""
+        return _trailing(self.observed, window)
+
+
+def _trailing(cumsum: np.ndarray, window: int | None) -> np.ndarray:
+    # The first rows have fewer than window rows before them and take the whole cumsum so far
+    if window is None:
+        return cumsum[1:]
+
+    sums = cumsum[1:].copy()
+    if window < len(sums):
+        sums[window:] -= cumsum[1:len(sums) + 1 - window]
+    return sums
+
+
+def window_statistics_into(out: np.ndarray, x: np.ndarray, window: int | None, statistics: list, min_periods: int, sums: WindowSums | None = None):
+    """Writes statistics of the trailing window ending at each row into the columns of out,
+    one column per statistic in order. A window with fewer than min_periods values is NaN.
+
+    Args:
+        out (ndarray): Block of shape (rows, len(statistics)) to write into
+
+        x (ndarray): The float column
+
+        window (int | None): Rows in the window, None for an expanding window over every row so far
+
+        statistics (list): Names from WINDOW_STATISTICS
+
+        min_periods (int): Fewest values a window needs
+
+        sums (WindowSums | None): Cumulative sums of x already made for another window
+    """
+    sums = sums if sums is not None else WindowSums(x)
+    count, total, squares = sums.window(window)
+    too_few = count < max(min_periods, 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for position, statistic in enumerate(statistics):
+            column = out[:, position]
+            match statistic:
+                case 'count':
+                    # As in pandas, a count is only left out while the window has fewer rows than min_periods
+                    column[:] = sums.observed_count(window) if sums.has_infinities else count
+                    rows = np.arange(1, len(count) + 1) if window is None else np.minimum(np.arange(1, len(count) + 1), window)
+                    column[rows < min_periods] = np.nan
+                    continue
+                case 'sum':
+                    column[:] = total + count * sums.centre
+                case 'mean':
+                    column[:] = total / count + sums.centre
+                case 'var' | 'std':
+                    # Sample variance, the sum of squares about the window mean over count - 1
+                    np.divide(squares - total * total / count, count - 1, out=column)
+                    np.maximum(column, 0.0, out=column)
+                    if statistic == 'std':
+                        np.sqrt(column, out=column)
+                    column[count < 2] = np.nan
+                case 'min' | 'max':
+                    _extreme_into(column, np.where(np.isinf(x), np.nan, x) if sums.has_infinities else x, window, statistic)
+                case _:
+                    raise ValueError(f'Unknown window statistic {statistic}, expected one of {WINDOW_STATISTICS}')
+
+            column[too_few] = np.nan
+
+
+def _extreme_into(out: np.ndarray, x: np.ndarray, window: int | None, statistic: str):
+    # fmin and fmax skip NaNs, a window of only NaNs stays NaN
+    ufunc = np.fmin if statistic == 'min' else np.fmax
+    if window is None:
+        ufunc.accumulate(x, out=out)
+        return
+
+    # van Herk/Gil-Werman: the rows, padded with NaN before the first, are cut into blocks
+    # of one window. Every window spans the end of one block and the start of the next, so
+    # it is the extreme of a suffix and a prefix of blocks, whatever the window size
+    padded_length = -(-(len(x) + window - 1) // window) * window
+    padded = np.full(padded_length, np.nan)
+    padded[window - 1:window - 1 + len(x)] = x
+    blocks = padded.reshape(-1, window)
+    prefix = ufunc.accumulate(blocks, axis=1).ravel()
+    suffix = ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    ufunc(suffix[:len(x)], prefix[window - 1:window - 1 + len(x)], out=out)
+
+
+def calendar_into(out: np.ndarray, index: pd.DatetimeIndex, features: list, cyclical: bool):
+    """Writes calendar features of the index into the columns of out. With cyclical each
+    feature that repeats becomes a sine and cosine column in place of its value."""
+    position = 0
+    for feature in features:
+        values = _calendar_values(index, feature)
+        period = CALENDAR_FEATURES[feature]
+        if cyclical and period is not None:
+            angle = values * (2 * np.pi / period)
+            np.sin(angle, out=out[:, position])
+            np.cos(angle, out=out[:, position + 1])
+            position += 2
+        else:
+            out[:, position] = values
+            position += 1
+
+
+def calendar_columns(features: list, cyclical: bool) -> list:
+    columns = []
+    for feature in features:
+        if cyclical and CALENDAR_FEATURES[feature] is not None:
+            columns += [f'{feature}_sin', f'{feature}_cos']
+        else:
+            columns.append(feature)
+    return columns
+
+
+def _calendar_values(index: pd.DatetimeIndex, feature: str) -> np.ndarray:
+    match feature:
+        case 'weekofyear':
+            return index.isocalendar().week.to_numpy(dtype=np.float64)
+        case 'isweekend':
+            return (index.dayofweek >= 5).astype(np.float64)
+        case _:
+            return getattr(index, feature).to_numpy(dtype=np.float64)
@@ -14,37 +14,101 @@ machine learning (ML) library / framework.
 #
 from abc import ABC, abstractmethod
 from importlib import import_module
+from datetime import datetime, timezone
 from pandas import DataFrame
 from pickle import dumps
-
-from src.data_manipulation import cross_validation, get_XY
+from time import perf_counter
+import numpy as np
+import warnings
+
+from src.artifact_store import ARTIFACT_STORE
+from src.data_manipulation import SplitCache, is_fold_cross_validation, take_rows
+from src.evaluation import evaluate_predictions, get_metric_names
+from src.folds import FoldEvaluation
+from src.progress import JobProgress
+from src.search import HyperparameterSearch
+
+# Rows fitted by warm_up, and parameters keeping its fits to a few milliseconds
+WARM_UP_ROWS = 64
+WARM_UP_MODEL_PARAMS = {'Random Forest': {'n_estimators': 2, 'max_depth': 2},
+                        'MLP': {'hidden_layer_sizes': (4,), 'max_iter': 5},
+                        'SGD': {'max_iter': 5}
+                        }
 
 class TrainingManager():
     ml_framework_dict = {'scikit-learn': 'SKLearnTrainer'}
 
-    def __init__(self, model_definition: dict, df_dataset: DataFrame):
+    def __init__(self, model_definition: dict, df_dataset: DataFrame | None, split_cache: SplitCache | None = None, progress: JobProgress | None = None):
         self.model_definition = model_definition
         self.df_dataset = df_dataset
+        self.split_cache = split_cache if split_cache is not None else SplitCache(df_dataset)
 
-    
-    def train_model(self):
-        model_trainer = self.build_model()
+        # Checked for cancellation between the stages of training, worker processes get one that is never cancelled
+        self.progress = progress if progress is not None else JobProgress()
 
-        dataset = cross_validation(self.df_dataset, self.model_definition['crossValidation'])
+        # Seconds spent in each stage of the last train_model call
+        self.timings = {}
 
+    
+    def train_model(self) -> dict:
+        model_metrics = {}
+        self.timings = {}
+
+        # Checked up front so a misspelled metric fails before the model is trained
+        metric_names = get_metric_names(self.model_definition['predictionProblem'], self.model_definition.get('metrics'))
+
+        dataset = self.split_cache.get_split(self.model_definition['crossValidation'], self.model_definition['target'])
+
+        # With a search block the model is trained with the best hyperparameters the search finds
+        model_definition = self.model_definition
+        if model_definition.get('search'):
+            start = perf_counter()
+            search_results = HyperparameterSearch(model_definition, dataset, evaluate_trial, self.progress).run()
+            self.timings['search'] = perf_counter() - start
+            model_metrics.update(search_results)
+
+            model_definition = {key: value for key, value in model_definition.items() if key != 'search'}
+            model_definition['modelParams'] = {**(model_definition.get('modelParams') or {}), **search_results['bestParams']}
+
+        # With fold cross validation the score comes from a model per fold, the model kept is trained on every row
+        is_fold_model = is_fold_cross_validation(model_definition['crossValidation'])
+        if is_fold_model:
+            start = perf_counter()
+            folds = self.split_cache.get_folds(model_definition['crossValidation'], model_definition['target'])
+            model_metrics.update(FoldEvaluation(model_definition, dataset, folds, metric_names, evaluate_fold, self.progress).run())
+            self.timings['folds'] = perf_counter() - start
+
+        model_trainer = self.build_model(model_definition)
+
+        self.progress.check_cancelled()
+        start = perf_counter()
         model_trainer.train(dataset)
+        self.timings['fit'] = perf_counter() - start
 
-        score = model_trainer.evaluate(dataset)
+        # The testing split is predicted once and every metric is computed from those predictions
+        if not is_fold_model:
+            start = perf_counter()
+            X_test, y_test = dataset['testing']
+            y_pred = model_trainer.predict(X_test)
+            model_metrics.update(evaluate_predictions(model_definition['predictionProblem'], y_test, y_pred, metric_names))
+            if model_definition.get('returnPredictions'):
+                model_metrics['predictions'] = {'yTrue': y_test, 'yPred': y_pred}
+            self.timings['evaluate'] = perf_counter() - start
 
-        #model_weights = model_trainer.get_model_weights()
+        # The trained model is kept so it can be used for predictions later
+        start = perf_counter()
+        feature_names = self.split_cache.get_feature_names(model_definition['crossValidation'], model_definition['target'])
+        model_metrics['artifact'] = save_model(model_trainer, model_definition, feature_names, model_metrics['score'])
+        self.timings['save'] = perf_counter() - start
 
-        return score
+        return model_metrics
 
 
-    def build_model(self):
-        ml_framework = self.ml_framework_dict[self.model_definition['mlFramework']]
+    def build_model(self, model_definition: dict | None = None):
+        model_definition = model_definition if model_definition is not None else self.model_definition
+        ml_framework = self.ml_framework_dict[model_definition['mlFramework']]
 
-        model_trainer = model_trainer_factory(ml_framework, self.model_definition)
+        model_trainer = model_trainer_factory(ml_framework, model_definition)
 
         model_trainer.build()
 
@@ -81,7 +145,7 @@ class IModelTrainer(ABC):
         """Abstract method to define the machine learning (ML) model training process
 
         Args:
-            dataset (dict): Dictionary containing the dataset to use for training/validation/testing
+            dataset (dict): Dictionary containing the (X, y) matrices to use for training/validation/testing
 
         Raises:
             NotImplementedError: An error will appear when the function has not been implemented
@@ -90,11 +154,26 @@ class IModelTrainer(ABC):
     
 
     @abstractmethod
-    def evaluate(self, dataset: dict):
+    def evaluate(self, dataset: dict, split_name: str = 'testing'):
         """Abstract method to define the machine learning (ML) model evaluation process
 
         Args:
-            dataset (dict): Dictionary containing the dataset to use for training/validation/testing
+            dataset (dict): Dictionary containing the (X, y) matrices to use for training/validation/testing
+
+            split_name (str): The split of the dataset to evaluate on
+
+        Raises:
+            NotImplementedError: An error will appear when the function has not been implemented
+        """
+        raise NotImplementedError
+
+
+    @abstractmethod
+    def predict(self, X):
+        """Abstract method to define how the machine learning (ML) model makes predictions
+
+        Args:
+            X (np.ndarray): The feature matrix to predict the targets of
 
         Raises:
             NotImplementedError: An error will appear when the function has not been implemented
@@ -104,8 +183,11 @@ class IModelTrainer(ABC):
 
 class SKLearnTrainer():
 
-    ml_algorithm_key = {'Random Forest': {'regression': 'RandomForestRegressor', 'classification': 'RandomForestClassifier', 'class': 'ensemble'},
-                        'MLP': {'regression': 'MLPRegressor', 'classification': 'MLPClassifier', 'class': 'neural_network'}
+    # 'incremental' marks the algorithms that can be trained a mini-batch at a time with partial_fit
+    ml_algorithm_key = {'Random Forest': {'regression': 'RandomForestRegressor', 'classification': 'RandomForestClassifier', 'class': 'ensemble', 'incremental': False},
+                        'MLP': {'regression': 'MLPRegressor', 'classification': 'MLPClassifier', 'class': 'neural_network', 'incremental': True},
+                        'SGD': {'regression': 'SGDRegressor', 'classification': 'SGDClassifier', 'class': 'linear_model', 'incremental': True},
+                        'Naive Bayes': {'classification': 'GaussianNB', 'class': 'naive_bayes', 'incremental': True}
                         }
 
     def __init__(self, model_definition: dict):
@@ -124,27 +206,34 @@ class SKLearnTrainer():
     
 
     def train(self, dataset):
-        target_features = self.model_definition['target']
-        X_train, y_train = get_XY(dataset['training'], target_features)
+        X_train, y_train = dataset['training']
 
         self.model.fit(X_train, y_train)
 
     
-    def evaluate(self, dataset):
-        target_features = self.model_definition['target']
-        X_test, y_test = get_XY(dataset['testing'], target_features)
+    def evaluate(self, dataset, split_name = 'testing'):
+        X_test, y_test = dataset[split_name]
 
-        '''
-        if self.prediction_problem == 'regression':
-            y_pred = self.model.predict(X_test)
-        else:
-            y_pred = self.model.predict_proba(X_test)
-        '''
-        
-        # NOTE:: This evaluates the model based on a pre-defined metric.
-        # Would be better to make predictions and evaluate based on a chosen metric.
-        # This is just the most simple solution for now.
+        # Only ranks search trials, trained models are scored on their predictions by evaluate_predictions
         return self.model.score(X_test, y_test)
+
+
+    def predict(self, X):
+        return self.model.predict(X)
+    
+
+    def supports_incremental_training(self) -> bool:
+        return self.ml_algorithm_key[self.model_definition['mlAlgorithm']]['incremental']
+
+
+    def train_batch(self, X_batch, y_batch, classes = None):
+        """Trains the model on one mini-batch with partial_fit. Classifiers need every
+        class up front as a batch may not hold all of them.
+        """
+        if self.model_definition['predictionProblem'] == 'classification':
+            self.model.partial_fit(X_batch, y_batch, classes = classes)
+        else:
+            self.model.partial_fit(X_batch, y_batch)
     
 
     def get_model_weights(self):
@@ -152,6 +241,99 @@ class SKLearnTrainer():
         return model_weights
     
 
+def evaluate_trial(model_definition: dict, dataset: dict, n_training_rows: int) -> float:
+    """Trains one hyperparameter search trial on the most recent n_training_rows
+    training rows and scores it on the selection rows.
+    """
+    ml_framework = TrainingManager.ml_framework_dict[model_definition['mlFramework']]
+    model_trainer = model_trainer_factory(ml_framework, model_definition)
+    model_trainer.build()
+
+    X_train, y_train = dataset['training']
+    model_trainer.train({'training': (X_train[-n_training_rows:], y_train[-n_training_rows:])})
+
+    return model_trainer.evaluate(dataset, 'selection')
+
+
+def evaluate_fold(model_definition: dict, dataset: dict, fold_positions: tuple, metric_names: list, return_predictions: bool = False) -> tuple[dict, np.ndarray | None]:
+    """Trains a model on the training rows of one fold and scores it on the fold's testing rows.
+    Rows are taken from dataset['training'] by position, as views where they are contiguous.
+    """
+    ml_framework = TrainingManager.ml_framework_dict[model_definition['mlFramework']]
+    model_trainer = model_trainer_factory(ml_framework, model_definition)
+    model_trainer.build()
+
+    X, y = dataset['training']
+    train_positions, test_positions = fold_positions
+    model_trainer.train({'training': (take_rows(X, train_positions), take_rows(y, train_positions))})
+
+    y_test = take_rows(y, test_positions)
+    y_pred = model_trainer.predict(take_rows(X, test_positions))
+    fold_metrics = evaluate_predictions(model_definition['predictionProblem'], y_test, y_pred, metric_names)
+
+    return fold_metrics, y_pred if return_predictions else None
+
+
+def save_model(model_trainer, model_definition: dict, feature_names: list, score: float) -> str:
+    """Stores a trained model in the artifact store with what is needed to predict with it
+
+    Args:
+        model_trainer (IModelTrainer): The model trainer holding the trained model
+
+        model_definition (dict): The definition the model was trained with
+
+        feature_names (list): The columns the model takes, in order
+
+        score (float): The score of the model on the testing split, or averaged over its folds
+
+    Returns:
+        str: The digest of the artifact
+    """
+    metadata = {'modelId': model_definition['id'],
+                'modelDefinition': model_definition,
+                'features': feature_names,
+                'target': model_definition['target'],
+                'predictionProblem': model_definition['predictionProblem'],
+                'score': score,
+                'createdAt': datetime.now(timezone.utc).isoformat()
+                }
+
+    return ARTIFACT_STORE.put(model_trainer.model, metadata)
+
+
+def warm_up(fit: bool = False):
+    """Imports the modules of every supported ML algorithm so the first job
+    trained by this worker does not pay for the import. With fit, every model
+    is also fitted once on a tiny dataset, which loads the code paths only
+    reached when a model is trained or predicts.
+    """
+    for algorithm in SKLearnTrainer.ml_algorithm_key.values():
+        import_module(f'.{algorithm["class"]}', 'sklearn')
+
+    if not fit:
+        return
+
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(WARM_UP_ROWS, 4))
+    targets = {'regression': X.sum(axis=1), 'classification': (X[:, 0] > 0).astype(np.int64)}
+
+    with warnings.catch_warnings():
+        # A few iterations on a tiny dataset never converge, which is fine here
+        warnings.simplefilter('ignore')
+        for algorithm_name, algorithm in SKLearnTrainer.ml_algorithm_key.items():
+            for prediction_problem in ('regression', 'classification'):
+                if prediction_problem not in algorithm:
+                    continue
+
+                model_trainer = SKLearnTrainer({'mlAlgorithm': algorithm_name,
+                                                'predictionProblem': prediction_problem,
+                                                'modelParams': WARM_UP_MODEL_PARAMS.get(algorithm_name, {})
+                                                })
+                model_trainer.build()
+                model_trainer.train({'training': (X, targets[prediction_problem])})
+                model_trainer.predict(X)
+
+
 def model_trainer_factory(ml_framework: str, model_definition: dict):
     try:
         MODULE_NAME = 'src'
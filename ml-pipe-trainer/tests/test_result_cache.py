@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from src.result_cache import ResultCache
+from src.results import JobResults
+
+
+def fresh_results() -> JobResults:
+    # Ids as the pipeline designer makes them, numbers as strings
+    model_definitions = [{'id': '1'}, {'id': '2', 'returnPredictions': True}, {'id': '3', 'returnPredictions': True}]
+    all_model_metrics = [{'score': 0.5, 'mae': 1.25},
+                         {'score': 0.75, 'mae': 0.5, 'predictions': {'yTrue': np.array([1.0, 2.0]), 'yPred': np.array([1.5, 2.5]), 'index': [10, 11]}},
+                         {'score': 0.25, 'mae': 2.0, 'predictions': {'yTrue': np.array(['a', 'b']), 'yPred': np.array(['a', 'a'])}}]
+    return JobResults.from_model_metrics(model_definitions, all_model_metrics)
+
+
+def test_cached_results_match_fresh_results(tmp_path):
+    cache = ResultCache(directory=str(tmp_path))
+    fresh = fresh_results()
+    cache.put('key', fresh)
+    cached = cache.get('key')
+
+    for name in ('models', 'predictions'):
+        pd.testing.assert_frame_equal(cached.table(name), fresh.table(name))
+        assert cached.to_records(name) == fresh.to_records(name)
+
+    assert cached.to_records()[0]['model_id'] == '1'
+
+
+def test_cached_results_without_predictions(tmp_path):
+    cache = ResultCache(directory=str(tmp_path))
+    fresh = JobResults.from_model_metrics([{'id': '7'}], [{'score': 1.0}])
+    cache.put('key', fresh)
+    cached = cache.get('key')
+
+    pd.testing.assert_frame_equal(cached.table('models'), fresh.table('models'))
+    assert len(cached.table('predictions')) == 0